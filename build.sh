@@ -8,8 +8,9 @@ basenm=$(echo $1 | rev | cut -f 2- -d '.' | rev)
 srcfile="${basenm}.asm"
 outfile="${basenm}.prg"
 lstfile="${basenm}.lst"
+symfile="${basenm}.sym"
 [ -f "$srcfile" ] || { echo "I don't see a $srcfile file here..." ; exit 1 ; }
 
-cmd="$DASM $srcfile -v5 -f1 -o${outfile} -l${lstfile}"
+cmd="$DASM $srcfile -v5 -f1 -o${outfile} -l${lstfile} -s${symfile}"
 echo $cmd
 $cmd
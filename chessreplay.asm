@@ -21,6 +21,9 @@ PIECEPTR = $4D    ; zero page location where I'll store the address of the piece
 CHMOVEPTR = $4F   ; zero page location where I'll store the address of the move being drawn
 SOURCEPTR = $51   ; zero page pointer to the text are on the screen, for scrolling
 SCREENPTR = $53   ; zero page pointer to the text are on the screen, for scrolling
+TREEPTR = $55     ; zero page pointer to the Huffman tree being decoded with
+SYMPTR = $57      ; zero page pointer to the symbols at the leaves of that tree
+LOADPTR = $59     ; zero page pointer to where the next byte of the next game is read to
 
 ; locations and constants for file operations - probably need to be changed for other BASIC ROMs
 KERNALCLOSE = $F2E2
@@ -30,6 +33,8 @@ KERNALOPENFILE = $F563
 
 FILENAMELENLOC = $D1
 FILENUMLOC = $D2
+MEMSIZLOC = $34   ; BASIC's pointer to the top of memory, the game data has to fit below it
+JIFFYLO = $8F     ; low byte of the jiffy clock, counted up 60 times a second by the interrupt
 SECONDARYADDRNUMLOC = $D3
 DEVICENUMLOC = $D4
 FILENAMEPTR = $DA
@@ -71,8 +76,29 @@ PX = 124      ; First player (0=White, 1=Black)
 EOG = 125     ; Draw an end of game PGN: 0-1, 1-0, *, etc.
 NG = 126      ; New game
 EOF = 127     ; End of file
+OP = 128      ; Play an opening block
+EO = 129      ; End of an opening block
 EOR = 254     ; End of record
 
+; A data file starts with DATAMARKER and a flags byte, then each game is a record: a two byte
+; length (low byte first) and that many bytes of data. A compressed file has its Huffman trees
+; between the flags and the first game. Every byte of a compressed file is decoded with the tree
+; for the kind of byte being read - a token, a square, a piece, a letter of move text... These
+; numbers have to match the CONTEXT_ values in pgn_to_pet.py.
+DATAMARKER = $FF
+FLAGCOMPRESSED = 1
+FLAGOPENINGS = 2      ; a table of opening blocks follows any trees - see READOPENINGS
+CTXCMD = 0            ; a token, or the source square of a move
+CTXAFTERMV = 1        ; the token after a piece move
+CTXAFTERPG = 2        ; the token after a PG record
+CTXSQUARE = 3         ; a destination square, or a square to draw a piece on
+CTXPIECE = 4          ; a piece code
+CTXMOVETEXT = 5       ; the letters of a PG record, 5-8 by position in the move
+CTXMOVETEXTLAST = 8
+CTXTEXT = 9           ; all other text and values
+NUMCONTEXTS = 10
+HUFFTABLESIZE = 2048  ; room for the trees, pgn_to_pet.py keeps them within this
+
 TOPOFTEXT = $8000 + (8 * 40) + 23      ; top of text area for the PGN notation of the moves:
                                        ;   8 lines down, 24 columns over
 MOVELINE = $83D8                       ; bottom line of the moves area
@@ -85,9 +111,26 @@ BLACKLOC = $80B8                       ; pointer to the location to print the Bl
 DATELOC = $8108                        ; pointer to the location to print the Date text
 TITLELOC = $83C0                       ; pointer to the location to print the Title text
 
-CHESSGAMESDATA = $0D00                 ; pointer to the location of the chess games data - just needs
-                                       ; to be higher in memory than the end of this assembly code
-                                       ; - see ENDOFCODE
+RINGBUF = [HUFFTABLES + HUFFTABLESIZE + $FF] & $FF00
+                                       ; one page, for streaming a game through - the first page after
+                                       ; the end of this assembly code and the Huffman tables - see
+                                       ; ENDOFCODE
+CHESSGAMESDATA = RINGBUF + $100        ; pointer to the location of the chess games data, a game is
+                                       ; loaded here whole if it fits below the top of memory - or
+                                       ; at GAMESDATA, past the opening blocks, if the file has them
+
+PAUSEJIFFIES = 180                     ; length of a pause, 3 seconds
+FLASHJIFFIES = 9                       ; and of each half of a flash of the moved piece
+
+; what's been read of the game after the one playing, see PREFETCH
+NEXTNONE = 0                           ; nothing yet
+NEXTSIZED = 1                          ; its length, but there's no room to load it until this one ends
+NEXTLOADING = 2                        ; it's being read to NEXTSTART
+NEXTLOADED = 3                         ; all of it
+
+STREAMGAMES = 0                        ; set to 1 to stream every game through RINGBUF, not just the
+                                       ; ones too big to load - the first move comes up sooner, but
+                                       ; the disk is read while the game plays
 
 ; some macros for dealing with pointers
               MAC DEFINE_PTR         ;  {addr, ptr}
@@ -190,12 +233,16 @@ STARTOFCODE:
 
               ; open the datafile
 STARTOVER:    jsr OPENFILE
+              jsr READHEADER
 
-              ; read data from the file representing one complete game
+              ; switch to the next game's data, reading what wasn't read while the last one paused
 NEXTGAME:     jsr READCHGAME
 
-              ; reset the pointer to the beginning of the game data
-              DEFINE_PTR CHESSGAMESDATA, CHMOVEPTR
+              ; compressed games start on a byte boundary, with the bit buffer empty
+              lda #$80
+              sta BITBUF
+              lda #CTXCMD
+              sta CMDCTX
 
               jsr BLANKSCREEN
               jsr BLANKBOARD
@@ -207,11 +254,10 @@ NEXTGAME:     jsr READCHGAME
               ; start of the main loop - read data and draw
               ;
 
-TOPOFLOOP:    ldy #0
-              lda (CHMOVEPTR),y   ; get byte from the data block
-
-              ; advance to next byte - usually data for whatever token this is
-              ADVANCE_PTR CHMOVEPTR
+TOPOFLOOP:    ldx CMDCTX          ; the context for a compressed token
+              jsr NEXTBYTE        ; get byte from the data block
+              ldx #CTXCMD
+              stx CMDCTX
 
               ;
               ; check against different record types
@@ -264,7 +310,7 @@ JMPCMD:       jsr 1000            ; this address gets overwritten by the above c
 JUMPTABLE:    .word THREESECS       ; ZZ
               .word DRAWONEPIECE    ; DP
               .word DRAWNPIECES     ; DN
-              .word BLANKBOARD      ; CB
+              .word CLEARBOARD      ; CB
               .word PRINTPGN        ; PG
               .word PRINTEVENT      ; EV
               .word PRINTDATE       ; DT
@@ -275,6 +321,8 @@ JUMPTABLE:    .word THREESECS       ; ZZ
               .word PRINTEOG        ; EOG
               .word HANDLENG        ; NG
               .word HANDLEEOF       ; EOF
+              .word PLAYOPENING     ; OP
+              .word ENDOPENING      ; EO
 
 ; --------------------------------------------------------------------------------------------------
 
@@ -325,6 +373,107 @@ OPENFILE:     lda #FILENUM
 FILENAMELEN = 9
 FILEN:        .byte 'C, 'H, 'E, 'S, 'S, 'D, 'A, 'T, 'A
 
+; --------------------------------------------------------------------------------------------------
+;
+;  Read the flags at the start of the file, and load the Huffman trees of a compressed file
+;
+READHEADER:   jsr KERNALREADCHAR  ; DATAMARKER
+              jsr KERNALREADCHAR
+              sta DATAFLAGS
+              and #FLAGCOMPRESSED
+              sta COMPRESSMODE
+              beq READOPENINGS
+              jsr READTREES
+              jmp READOPENINGS
+
+READTREES:    jsr KERNALREADCHAR  ; the number of trees, one for each context
+              sta NUMTREES
+              DEFINE_PTR HUFFTABLES, SOURCEPTR
+
+              ldx #0
+TREELOOP:     stx TREENUM
+              lda SOURCEPTR       ; remember where this tree goes
+              sta TREELO,x
+              lda SOURCEPTR+1
+              sta TREEHI,x
+
+              ; each tree is its number of internal nodes N, then N pairs of children
+              jsr KERNALREADCHAR
+              sta SCRATCH
+              asl
+              jsr COPYFROMFILE
+
+              ; then the N + 1 symbols at its leaves
+              ldx TREENUM
+              lda SOURCEPTR
+              sta SYMLO,x
+              lda SOURCEPTR+1
+              sta SYMHI,x
+              ldx SCRATCH
+              inx
+              txa
+              jsr COPYFROMFILE
+
+              ldx TREENUM
+              inx
+              cpx NUMTREES
+              bne TREELOOP
+              rts
+
+; --------------------------------------------------------------------------------------------------
+;
+;  Load the table of opening blocks at CHESSGAMESDATA, the games are loaded after it. It's never
+;  Huffman coded, so it's read as it is. The table has a 2 byte offset from its start for each block,
+;  then the blocks - the first moves that a lot of games share, in the same form as a game's moves,
+;  each ending with an EO token. A game that starts with one has OP and the block number in place
+;  of those moves, and PLAYOPENING plays them from the table.
+;
+READOPENINGS: DEFINE_PTR CHESSGAMESDATA, SOURCEPTR
+              lda DATAFLAGS
+              and #FLAGOPENINGS
+              beq OPENINGSREAD
+
+              ; the length of the table, OPENINGCOUNT counts up to 0 from minus it like NEXTCOUNT
+              jsr KERNALREADCHAR
+              sta OPENINGCOUNT
+              jsr KERNALREADCHAR
+              sta OPENINGCOUNT+1
+              sec
+              lda #0
+              sbc OPENINGCOUNT
+              sta OPENINGCOUNT
+              lda #0
+              sbc OPENINGCOUNT+1
+              sta OPENINGCOUNT+1
+
+OPENINGLOOP:  lda OPENINGCOUNT
+              ora OPENINGCOUNT+1
+              beq OPENINGSREAD
+              jsr KERNALREADCHAR
+              ldy #0
+              sta (SOURCEPTR),y
+              ADVANCE_PTR SOURCEPTR
+              inc OPENINGCOUNT
+              bne OPENINGLOOP
+              inc OPENINGCOUNT+1
+              jmp OPENINGLOOP
+
+OPENINGSREAD: COPY_PTR SOURCEPTR, GAMESDATA
+              rts
+
+; --------------------------------------------------------------------------------------------------
+;
+;  Copy A bytes (1-255) from the file to SOURCEPTR, SOURCEPTR is advanced past them
+;
+COPYFROMFILE: sta COPYCOUNT
+COPYLOOP:     jsr KERNALREADCHAR
+              ldy #0
+              sta (SOURCEPTR),y
+              ADVANCE_PTR SOURCEPTR
+              dec COPYCOUNT
+              bne COPYLOOP
+              rts
+
 ; --------------------------------------------------------------------------------------------------
 
 CLOSEFILE:    lda #FILENUM
@@ -333,25 +482,311 @@ CLOSEFILE:    lda #FILENUM
 
 ; --------------------------------------------------------------------------------------------------
 ;
-;  Read one game's worth of data from the data file
+;  Start the next game - CHMOVEPTR is left pointing at its data, or it's set up to stream
 ;
+;  The game's record starts with its length, so it's read with a counted loop rather than watching
+;  every byte for the NG or EOF token. Most of the time the pauses of the game before have already
+;  read it (see PREFETCH) and this just switches to it. A game that won't fit between CHESSGAMESDATA
+;  and the top of memory is streamed instead - it's read into RINGBUF a page at a time as it plays.
+;
+
+READCHGAME:   lda #0
+              sta STREAMMODE
+
+              lda NEXTSTATE
+              bne GOTLENGTH
+              jsr READLENGTH
+
+GOTLENGTH:    cmp #NEXTSIZED
+              bne FINISHLOAD
+
+              IF STREAMGAMES
+              jmp STREAMGAME
+              ENDIF
+
+              ; the game before is finished with, so all of memory is free for this one
+              COPY_PTR GAMESDATA, NEXTSTART
+              ldx MEMSIZLOC
+              ldy MEMSIZLOC+1
+              jsr NEXTFITS
+              bcs STREAMGAME
+              jsr STARTLOAD
+
+FINISHLOAD:   lda NEXTSTATE
+              cmp #NEXTLOADED
+              beq SWITCHGAME
+              jsr LOADBYTE
+              jmp FINISHLOAD
+
+SWITCHGAME:   COPY_PTR NEXTSTART, CHMOVEPTR
+              COPY_PTR NEXTSTART, GAMESTART
+              COPY_PTR NEXTEND, GAMEEND
+              lda #NEXTNONE
+              sta NEXTSTATE
+              rts
+
+; nothing is read yet for a streamed game, the first byte it needs fills the ring buffer
+STREAMGAME:   sec
+              lda #0
+              sbc NEXTLEN
+              sta GAMELEN
+              lda #0
+              sbc NEXTLEN+1
+              sta GAMELEN+1
+
+              lda #1
+              sta STREAMMODE
+              lda #0
+              sta RINGHEAD
+              sta RINGTAIL
+
+              ; it leaves all of memory free for the game after it
+              COPY_PTR GAMESDATA, GAMESTART
+              COPY_PTR GAMESDATA, GAMEEND
+              lda #NEXTNONE
+              sta NEXTSTATE
+              rts
 
-READCHGAME:   DEFINE_PTR CHESSGAMESDATA, CHMOVEPTR
-READCHAR:     jsr KERNALREADCHAR
+; --------------------------------------------------------------------------------------------------
+;
+;  Do a little of the reading for the games ahead - at most one byte, so it can be called over and
+;  over while waiting for the jiffy clock. The rest of a streamed game goes into RINGBUF as it
+;  makes room, and once all of this game is read the next one is loaded somewhere in memory this
+;  one isn't using. The file is read in order, so there's nothing more to do after that until the
+;  next game starts.
+;
+PREFETCH:     lda STREAMMODE
+              beq PREFETCHNEXT
+              lda GAMELEN
+              ora GAMELEN+1
+              beq PREFETCHNEXT
+              jmp RINGBYTE
+
+PREFETCHNEXT: lda NEXTSTATE
+              beq PREFETCHLEN     ; NEXTNONE
+              cmp #NEXTLOADING
+              bne PREFETCHDONE
+              jmp LOADBYTE
+
+PREFETCHLEN:  jsr READLENGTH
+
+              IF STREAMGAMES
+              rts
+              ENDIF
+
+              ; after the game playing, or else in front of it
+              COPY_PTR GAMEEND, NEXTSTART
+              ldx MEMSIZLOC
+              ldy MEMSIZLOC+1
+              jsr NEXTFITS
+              bcc STARTLOAD
+
+              COPY_PTR GAMESDATA, NEXTSTART
+              ldx GAMESTART
+              ldy GAMESTART+1
+              jsr NEXTFITS
+              bcc STARTLOAD
+PREFETCHDONE: rts
+
+; read the length at the start of the next game's record
+READLENGTH:   jsr KERNALREADCHAR
+              sta NEXTLEN
+              jsr KERNALREADCHAR
+              sta NEXTLEN+1
+              lda #NEXTSIZED
+              sta NEXTSTATE
+              rts
+
+; set NEXTEND to the end of the next game loaded at NEXTSTART, carry clear if that's no further
+; than the address in X (low) and Y (high)
+NEXTFITS:     clc
+              lda NEXTSTART
+              adc NEXTLEN
+              sta NEXTEND
+              lda NEXTSTART+1
+              adc NEXTLEN+1
+              sta NEXTEND+1
+              bcs NOROOM
+              cpy NEXTEND+1
+              bcc NOROOM
+              bne ROOM
+              cpx NEXTEND
+              bcc NOROOM
+ROOM:         clc
+              rts
+NOROOM:       sec
+              rts
+
+; start loading the next game at NEXTSTART, NEXTCOUNT counts up to 0 from minus its length, which
+; saves a compare for every byte
+STARTLOAD:    COPY_PTR NEXTSTART, LOADPTR
+              sec
+              lda #0
+              sbc NEXTLEN
+              sta NEXTCOUNT
+              lda #0
+              sbc NEXTLEN+1
+              sta NEXTCOUNT+1
+              lda #NEXTLOADING
+              sta NEXTSTATE
+              rts
 
-              ; stick byte from the data block
+; read one byte of the next game
+LOADBYTE:     jsr KERNALREADCHAR
               ldy #0
-              sta (CHMOVEPTR),y
+              sta (LOADPTR),y
+              ADVANCE_PTR LOADPTR
+
+              inc NEXTCOUNT
+              bne LOADDONE
+              inc NEXTCOUNT+1
+              bne LOADDONE
+              lda #NEXTLOADED
+              sta NEXTSTATE
+LOADDONE:     rts
+
+; --------------------------------------------------------------------------------------------------
+;
+;  Play the moves of an opening block - the bytes are taken from the block until its EO token
+;
+PLAYOPENING:  ldx #CTXTEXT
+              jsr NEXTBYTE        ; the block number, 0-127
+              asl
+              tay
+              clc
+              lda CHESSGAMESDATA,y
+              adc #<CHESSGAMESDATA
+              sta OPENINGBYTE+1
+              lda CHESSGAMESDATA+1,y
+              adc #>CHESSGAMESDATA
+              sta OPENINGBYTE+2
+              lda #1
+              sta OPENINGMODE
+              rts
+
+; back to the game's own data, the token after the block number is next
+ENDOPENING:   lda #0
+              sta OPENINGMODE
+              rts
+
+; --------------------------------------------------------------------------------------------------
+;
+;  Get the next byte of game data into A. For a compressed file X holds the context the byte is
+;  being read in, which picks the tree to decode it with.
+;
+NEXTBYTE:     lda OPENINGMODE
+              bne OPENINGBYTE
+              lda COMPRESSMODE
+              bne HUFFBYTE
+
+; Get the next byte of the game's record into A, from the loaded game or the ring buffer
+GETRAW:       lda STREAMMODE
+              bne GETRING
+
+              ldy #0
+              lda (CHMOVEPTR),y
               ADVANCE_PTR CHMOVEPTR
+              rts
 
-              ; either new game or EOF means stop the read
-              cmp #NG
-              beq READRETURN
-              cmp #EOF
-              beq READRETURN
+GETRING:      ldy RINGHEAD
+              cpy RINGTAIL
+              bne RINGHASBYTE
+              jsr FILLRING        ; the ring buffer is empty, wait for some more of the game
+              ldy RINGHEAD
+RINGHASBYTE:  lda RINGBUF,y
+              inc RINGHEAD
+              rts
 
-              jmp READCHAR
-READRETURN:   rts
+; Get the next byte of an opening block, the address in the lda is moved along as it's read, like
+; JMPCMD
+OPENINGBYTE:  lda $FFFF           ; this address gets overwritten by PLAYOPENING
+              inc OPENINGBYTE+1
+              bne OPENINGRET
+              inc OPENINGBYTE+2
+OPENINGRET:   rts
+
+; --------------------------------------------------------------------------------------------------
+;
+;  Read a streamed game into the ring buffer until it's full or all of the game has been read.
+;  RINGHEAD is where the next byte is taken from, RINGTAIL where the next one read goes - the
+;  buffer is empty when they're equal, so it holds at most 255 bytes.
+;
+FILLRING:     jsr RINGBYTE
+              bcc FILLRING
+              rts
+
+; read one more byte into the ring buffer, carry set if it's full or the game's all been read
+RINGBYTE:     lda GAMELEN
+              ora GAMELEN+1
+              beq RINGDONE
+
+              ldx RINGTAIL
+              inx
+              cpx RINGHEAD
+              beq RINGDONE
+
+              jsr KERNALREADCHAR
+              ldx RINGTAIL
+              sta RINGBUF,x
+              inc RINGTAIL
+
+              inc GAMELEN
+              bne RINGREAD
+              inc GAMELEN+1
+RINGREAD:     clc
+              rts
+RINGDONE:     sec
+              rts
+
+HUFFBYTE:     lda TREELO,x
+              sta TREEPTR
+              lda TREEHI,x
+              sta TREEPTR+1
+              lda SYMLO,x
+              sta SYMPTR
+              lda SYMHI,x
+              sta SYMPTR+1
+
+              ; walk down the tree a bit at a time, Y is twice the number of the node we're at
+              ldy #0
+HUFFBIT:      jsr NEXTBIT
+              bcc HUFFCHILD
+              iny                 ; 1 bits take the right child, which follows the left one
+HUFFCHILD:    lda (TREEPTR),y
+              bmi HUFFLEAF
+              asl
+              tay
+              jmp HUFFBIT
+
+HUFFLEAF:     and #$7F            ; leaves are $80 + the leaf number
+              beq HUFFESCAPE
+              tay
+              lda (SYMPTR),y
+              rts
+
+HUFFESCAPE:   ; the escape leaf is followed by the byte itself - 8 bits. The 1 in HUFFVAL comes
+              ; out in the carry once all 8 are in.
+              lda #1
+              sta HUFFVAL
+ESCAPELOOP:   jsr NEXTBIT
+              rol HUFFVAL
+              bcc ESCAPELOOP
+              lda HUFFVAL
+              rts
+
+; Shift the next bit of compressed data into the carry. BITBUF holds what's left of the current
+; byte followed by a 1 bit, so it only goes to 0 once that 1 has been shifted out.
+NEXTBIT:      asl BITBUF
+              bne NEXTBITRET
+
+              sty HUFFY           ; the decoder is using Y
+              jsr GETRAW
+              ldy HUFFY
+
+              sec                 ; shift the first bit out and the 1 in behind the rest
+              rol
+              sta BITBUF
+NEXTBITRET:   rts
 
 ; --------------------------------------------------------------------------------------------------
 ;
@@ -362,21 +797,25 @@ READRETURN:   rts
 ; --------------------------------------------------------------------------------------------------
 PRINTEOG:     jsr SCROLLMOVES
               DEFINE_PTR MOVELINE, SCREENPTR
+              ldx #CTXTEXT
               jsr PRINTSTRREC
               rts
 
 ; --------------------------------------------------------------------------------------------------
 PRINTEVENT:   DEFINE_PTR EVENTLOC, SCREENPTR
+              ldx #CTXTEXT
               jsr PRINTSTRREC
               rts
 
 ; --------------------------------------------------------------------------------------------------
 PRINTDATE:    DEFINE_PTR DATELOC, SCREENPTR
+              ldx #CTXTEXT
               jsr PRINTSTRREC
               rts
 
 ; --------------------------------------------------------------------------------------------------
 PRINTWHITEP:  DEFINE_PTR WHITELOC, SCREENPTR
+              ldx #CTXTEXT
               jsr PRINTSTRREC
 
               ; print the "VS" also
@@ -389,6 +828,7 @@ VSTEXT:       .byte $16, $13, EOR
 
 ; --------------------------------------------------------------------------------------------------
 PRINTBLACKP:  DEFINE_PTR BLACKLOC, SCREENPTR
+              ldx #CTXTEXT
               jsr PRINTSTRREC
               rts
 
@@ -396,20 +836,18 @@ PRINTBLACKP:  DEFINE_PTR BLACKLOC, SCREENPTR
 ;
 ;  Store the numerical value of first move - for FEN setups that don't start on move 1
 ;
-STOREFIRSTMV: ldy #0
-              lda (CHMOVEPTR),y
+STOREFIRSTMV: ldx #CTXTEXT
+              jsr NEXTBYTE
               sta MOVENUM
-              ADVANCE_PTR CHMOVEPTR
               rts
 
 ; --------------------------------------------------------------------------------------------------
 ;
 ;  Store WHITE or BLACK as first player
 ;
-STOREFIRSTP:  ldy #0
-              lda (CHMOVEPTR),y
+STOREFIRSTP:  ldx #CTXTEXT
+              jsr NEXTBYTE
               sta MOVECOLOR
-              ADVANCE_PTR CHMOVEPTR
               rts
 
 ; --------------------------------------------------------------------------------------------------
@@ -422,15 +860,21 @@ DRAWCHESSMOVE:
 
               sta SRCSQUARE
 
-              ldy #0
-              lda (CHMOVEPTR),y
+              ldx #CTXSQUARE
+              jsr NEXTBYTE
               sta DSTSQUARE
-              ADVANCE_PTR CHMOVEPTR
 
-              lda (CHMOVEPTR),y
+              ldx #CTXPIECE
+              jsr NEXTBYTE
               sta PIECE
               pha                            ; save the piece on the stack for later
-              ADVANCE_PTR CHMOVEPTR
+
+              ; the move's PGN text comes next
+              ldx #CTXAFTERMV
+              stx CMDCTX
+
+              ; anything set up on the board has to be there before the piece moves
+              jsr SHOWBOARD
 
               ; flash the source square
               lda SRCSQUARE
@@ -446,6 +890,10 @@ DRAWCHESSMOVE:
               jsr DEFPIECEPTR
               ; SQUAREPTR is still set to the source square
               jsr DRAWATSQUARE
+              lda #BS
+              ldx SRCSQUARE
+              sta BOARD,x
+              sta SHOWN,x
 
               ; flash the destination square
               lda DSTSQUARE
@@ -461,6 +909,10 @@ DRAWCHESSMOVE:
               jsr DEFPIECEPTR
               ; SQUAREPTR is still set to the destination square
               jsr DRAWATSQUARE
+              lda PIECE
+              ldx DSTSQUARE
+              sta BOARD,x
+              sta SHOWN,x
               rts
 
 ; --------------------------------------------------------------------------------------------------
@@ -468,14 +920,16 @@ DRAWCHESSMOVE:
 ;  Draws N pieces as defined by bytes in the input stream, CHMOVEPTR is advanced past them
 ;
 DRAWNPIECES:
-PIECESLOOP:   jsr DRAWONEPIECE
-              ldy #0
-              lda (CHMOVEPTR),y
+PIECESLOOP:   ldx #CTXSQUARE
+              jsr NEXTBYTE
+
+              ; the end of record token turns up where the next square would be
               cmp #EOR
-              bne PIECESLOOP
+              beq PIECESDONE
 
-              ; advance past the end of record token before returning to main loop
-              ADVANCE_PTR CHMOVEPTR
+              jsr DRAWPIECEAT
+              jmp PIECESLOOP
+PIECESDONE:   jsr SHOWBOARD
               rts
 
 ; --------------------------------------------------------------------------------------------------
@@ -484,16 +938,22 @@ PIECESLOOP:   jsr DRAWONEPIECE
 ;
 DRAWONEPIECE:
               ; get both bytes from the stream
-              ldy #0
-              lda (CHMOVEPTR),y
-              sta SQNUMBER
-              ADVANCE_PTR CHMOVEPTR
+              ldx #CTXSQUARE
+              jsr NEXTBYTE
+              jsr DRAWPIECEAT
+              jsr SHOWBOARD
+              rts
 
-              lda (CHMOVEPTR),y
-              sta PIECE
-              ADVANCE_PTR CHMOVEPTR
+; put the piece that follows in the stream on the square in A, on the board but not yet the screen
+DRAWPIECEAT:  sta SQNUMBER
 
-              jsr DRAWONEPIECE1
+              ldx #CTXPIECE
+              jsr NEXTBYTE
+              ldx SQNUMBER
+              sta BOARD,x
+
+              lda #1
+              sta BOARDDIRTY
               rts
 
 ; --------------------------------------------------------------------------------------------------
@@ -509,19 +969,41 @@ DRAWONEPIECE1:
 
 ; --------------------------------------------------------------------------------------------------
 ;
-;  Multiply what's in the accumulator by 18
-;
-MULT18:
-              ; 18x = 16x + 2x
-              asl                ; 2A
-              pha                ; put 2A on the stack
-              asl                ; 4A
-              asl                ; 8A
-              asl                ; 16A
-              sta SCRATCH        ; SCRATCH = 16A
-              pla                ; 2A
-              clc
-              adc SCRATCH        ; 16A + 2A
+;  Bring the screen up to date with BOARD, drawing only the squares where it differs from SHOWN.
+;  The pieces are set up on BOARD and drawn all at once, so a new game's starting position, then
+;  a clear board and a FEN setup only ever draws the squares that end up changed.
+;
+SHOWBOARD:    lda BOARDDIRTY
+              beq SHOWNRET
+              lda #0
+              sta BOARDDIRTY
+
+              ldy #0
+SHOWLOOP:     lda BOARD,y
+              cmp SHOWN,y
+              beq SHOWNEXT
+              sta SHOWN,y
+              sta PIECE
+              sty SQNUMBER
+              jsr DRAWONEPIECE1
+              ldy SQNUMBER
+SHOWNEXT:     iny
+              cpy #64
+              bne SHOWLOOP
+SHOWNRET:     rts
+
+; --------------------------------------------------------------------------------------------------
+;
+;  Clear the board - just BOARD, the squares are blanked on the screen when it's next shown
+;
+CLEARBOARD:   lda #BS
+              ldx #63
+CLEARLOOP:    sta BOARD,x
+              dex
+              bpl CLEARLOOP
+
+              lda #1
+              sta BOARDDIRTY
               rts
 
 ; --------------------------------------------------------------------------------------------------
@@ -536,17 +1018,17 @@ DEFPIECEPTR:
               sec
               sbc #101            ; subtract 101 from the piece code and get piece number for the
                                   ; table of piece definitions
-              jsr MULT18          ; multiply by 18 - the width of the pairs of records
+              asl                 ; there's a pair of records for each piece, on white then black
+              tax
 
-              ldx SQCOLOR         ;   0 = BLACK
-              cpx #1              ;   1 = WHITE
-              beq WHPIECE
-              clc
-              adc #9              ; black square, advance the offset by 9
+              lda SQCOLOR         ;   0 = BLACK
+              bne WHPIECE         ;   1 = WHITE
+              inx                 ; black square, the second of the pair
 
-WHPIECE:      DEFINE_PTR PIECESDATA, PIECEPTR
-              tay                 ; Y = offset from the start of the block of pieces codes
-              ADVANCE_PTR_BY_Y PIECEPTR
+WHPIECE:      lda GLYPHLO,x
+              sta PIECEPTR
+              lda GLYPHHI,x
+              sta PIECEPTR+1
               rts
 
 ; --------------------------------------------------------------------------------------------------
@@ -559,18 +1041,13 @@ DEFFLASHPTR:
               lda PIECE
               sec
               sbc #101            ; subtract 101 from the piece code and get piece number for the
-                                  ; table of piece definitions
-              sec
-              sbc #6              ; subtract 6 to shift from white pieces to black in the code table
-                                  ; for the piece codes (we don't have both black and white flashing blocks)
-              bcs NOUNDERFLOW     ; if we didn't underflow, we're good, otherwise add that 6 back
-              adc #6
-
-NOUNDERFLOW:  jsr MULT18          ; multiply by 18 - the width of the pairs of records
+                                  ; table of piece definitions - black and white pieces flash the same
+              tax
 
-              DEFINE_PTR FLASHDATA, PIECEPTR
-              tay                 ; Y = offset from the start of the block of pieces codes
-              ADVANCE_PTR_BY_Y PIECEPTR
+              lda FLASHLO,x
+              sta PIECEPTR
+              lda FLASHHI,x
+              sta PIECEPTR+1
               rts
 
 ; --------------------------------------------------------------------------------------------------
@@ -593,13 +1070,11 @@ FLASHPIECE:   ldx #3
               stx SCRATCH
 FLASHLOOP:
               jsr DRAWATSQUARE
-              lda #1
               jsr FLASHDELAY
 
               ADVANCE_PTR_BY_N PIECEPTR, 9
 
               jsr DRAWATSQUARE
-              lda #1
               jsr FLASHDELAY
 
               RETREAT_PTR_BY_N PIECEPTR, 9
@@ -624,94 +1099,49 @@ DRAWATSQUARE:
               lda (PIECEPTR),y
               sta (SQUAREPTR),y
 
-              ldx #3
-              stx PIECEOFFS
-              ldx #40
-              stx SCREENOFFS
-
-              ldy PIECEOFFS
+              ; each row of the piece is drawn 40 bytes further down the screen
+              ldy #3
               lda (PIECEPTR),y
-              ldy SCREENOFFS
+              ldy #40
               sta (SQUAREPTR),y
-
-              iny
-              sty SCREENOFFS
-
-              ldx PIECEOFFS
-              inx
-              stx PIECEOFFS
-
-              ldy PIECEOFFS
+              ldy #4
               lda (PIECEPTR),y
-              ldy SCREENOFFS
+              ldy #41
               sta (SQUAREPTR),y
-
-              iny
-              sty SCREENOFFS
-
-              ldx PIECEOFFS
-              inx
-              stx PIECEOFFS
-
-              ldy PIECEOFFS
+              ldy #5
               lda (PIECEPTR),y
-              ldy SCREENOFFS
+              ldy #42
               sta (SQUAREPTR),y
 
-              ldx #6
-              stx PIECEOFFS
-              ldx #80
-              stx SCREENOFFS
-
-              ldy PIECEOFFS
+              ldy #6
               lda (PIECEPTR),y
-              ldy SCREENOFFS
+              ldy #80
               sta (SQUAREPTR),y
-
-              iny
-              sty SCREENOFFS
-
-              ldx PIECEOFFS
-              inx
-              stx PIECEOFFS
-
-              ldy PIECEOFFS
+              ldy #7
               lda (PIECEPTR),y
-              ldy SCREENOFFS
+              ldy #81
               sta (SQUAREPTR),y
-
-              iny
-              sty SCREENOFFS
-
-              ldx PIECEOFFS
-              inx
-              stx PIECEOFFS
-
-              ldy PIECEOFFS
+              ldy #8
               lda (PIECEPTR),y
-              ldy SCREENOFFS
+              ldy #82
               sta (SQUAREPTR),y
               rts
 
 ; --------------------------------------------------------------------------------------------------
 ;
-;  Draw the initial chess pieces setup - starting positions for a standard chess game
+;  Set up the initial chess pieces - starting positions for a standard chess game. They're drawn
+;  when the board is next shown.
 ;
-RESETBOARD:
-              DEFINE_PTR STARTPOS, SOURCEPTR
-ANOTHERRESET: ldy #0
-              lda (SOURCEPTR),y
-              ADVANCE_PTR SOURCEPTR
-              cmp #EOR
-              beq RESETDONE
+RESETBOARD:   jsr CLEARBOARD
 
-              sta SQNUMBER
-
-              lda (SOURCEPTR),y
-              ADVANCE_PTR SOURCEPTR
-              sta PIECE
-
-              jsr DRAWONEPIECE1
+              ldy #0
+ANOTHERRESET: ldx STARTPOS,y
+              cpx #EOR
+              beq RESETDONE
+              lda STARTPOS+1,y
+              sta BOARD,x
+              iny
+              iny
               jmp ANOTHERRESET
 RESETDONE:    rts
 
@@ -765,52 +1195,71 @@ PRINTRET:     rts
 ; --------------------------------------------------------------------------------------------------
 ;
 ;  Prints strings embedded in the input data stream, handles advancing the main CHMOVEPTR
+;  X holds the context of the first character, for compressed data
 ;
-PRINTSTRREC:
-              COPY_PTR CHMOVEPTR, SOURCEPTR
-              jsr PRINTSTR
-              ADVANCE_PTR_BY_Y CHMOVEPTR
-              ; moving the pointer by Y locations just advances it to the EOR byte
-              ADVANCE_PTR CHMOVEPTR
-              rts
+PRINTSTRREC:  stx TEXTCTX
+              ldy #0
+              sty STRINDEX
+
+PRINTRECLOOP: ldx TEXTCTX
+              jsr NEXTBYTE
+              cmp #EOR
+              beq PRINTRECRET
+
+              ldy STRINDEX
+              sta (SCREENPTR),y
+              iny
+              sty STRINDEX
+
+              ; move text has a context for each of its first few characters
+              ldx TEXTCTX
+              cpx #CTXMOVETEXT
+              bcc PRINTRECLOOP
+              cpx #CTXMOVETEXTLAST
+              bcs PRINTRECLOOP
+              inc TEXTCTX
+              jmp PRINTRECLOOP
+PRINTRECRET:  rts
 
 ; --------------------------------------------------------------------------------------------------
 ;
 ;  Scroll the area of the screen on the bottom right that shows the text PGN of the moves
 ;
-SCROLLMOVES:
-              ; scroll the text area - cols 25-40, bottom 17 rows
-              DEFINE_PTR TOPOFTEXT, SOURCEPTR
-              DEFINE_PTR TOPOFTEXT, SCREENPTR
-
-              ; add 40 so pointer 2 points at the next line
-              ADVANCE_PTR_BY_N SCREENPTR, 40
-
-              ; setup number of lines to scroll
-              ldx #16
-
-ANOTHERLINE:  ldy #15
-LINELOOP:     lda (SCREENPTR),y
-              sta (SOURCEPTR),y
-              dey
-              bne LINELOOP
+;  The copy is unrolled, a pair of instructions per row with the row's screen address worked out by
+;  the assembler, so it runs down a column without any pointer arithmetic. The rows above the top
+;  line of text are still blank from BLANKSCREEN, and there's no point copying those - the jmp at
+;  SCROLLCOL starts a new game past all of the rows, and backs up a row each time it's run until
+;  the whole pane is in use.
+;
+SCROLLMOVES:  ldy #15
 
-              ; add 40 to both pointers to move to the next line
-              ADVANCE_PTR_BY_N SOURCEPTR, 40
-              ADVANCE_PTR_BY_N SCREENPTR, 40
+SCROLLCOL:    jmp SCROLLEND       ; this address gets overwritten, like JMPCMD
 
-              dex
-              bne ANOTHERLINE
+              ; scroll the text area - cols 25-40, bottom 17 rows
+SCROLLROWS:
+PANEROW       SET 0
+              REPEAT 16
+              lda TOPOFTEXT+[PANEROW+1]*40,y
+              sta TOPOFTEXT+PANEROW*40,y
+PANEROW       SET PANEROW+1
+              REPEND
 
               ; blank the bottom line
-              DEFINE_PTR MOVELINE, SCREENPTR
-
-              lda #$20
-              ldy #15
-LINELOOP2:    sta (SCREENPTR),y
+SCROLLEND:    lda #$20
+              sta MOVELINE,y
               dey
-              bne LINELOOP2
-              rts
+              bne SCROLLCOL
+
+              ; one more row has text in it for next time, 6 bytes of code back
+              lda SCROLLCOL+1
+              cmp #<SCROLLROWS    ; the rows are within 96 bytes, so the low byte will do
+              beq SCROLLRET
+              sec
+              sbc #6
+              sta SCROLLCOL+1
+              bcs SCROLLRET
+              dec SCROLLCOL+2
+SCROLLRET:    rts
 
 ; --------------------------------------------------------------------------------------------------
 ;
@@ -861,7 +1310,12 @@ SETUPBLMOVE:  ; point screen pointer at black's move area
               sty MOVECOLOR
 
 PRINTIT:      ; the text area has been scrolled, pointers are setup, print the move string
+              ldx #CTXMOVETEXT
               jsr PRINTSTRREC
+
+              ; a pause always follows the move text
+              ldx #CTXAFTERPG
+              stx CMDCTX
               rts
 
 DOTSTEXT:     .byte $2E, $2E, EOR
@@ -940,29 +1394,20 @@ PRINTDEC:     pha
 ;   0 = BLACK
 ;   1 = WHITE
 ;
+;  Square 0 is a8, a white square - a square is white when its row and column are both even or
+;  both odd
+;
 BLACKORWHITESQ:
-              ldx SQNUMBER
-              stx SCRATCH
-              ldy #0
-FINDSQUARE:   lda WHSQUARES,y
-              cmp #EOR
-              beq ITSBLACK
-
-              cmp SCRATCH
-              beq ITSWHITE
-              iny
-              jmp FINDSQUARE
-
-ITSWHITE:     ldx #1
-              stx SQCOLOR
-              rts
-ITSBLACK:     ldx #0
-              stx SQCOLOR
+              lda SQNUMBER
+              lsr
+              lsr
+              lsr                 ; the row
+              eor SQNUMBER        ; bit 0 is now set for the squares where one of them is odd
+              and #1
+              eor #1
+              sta SQCOLOR
               rts
 
-WHSQUARES:    .byte  0,  2,  4,  6,  9, 11, 13, 15, 16, 18, 20, 22, 25, 27, 29, 31
-              .byte 32, 34, 36, 38, 41, 43, 45, 47, 48, 50, 52, 54, 57, 59, 61, 63, EOR
-
 ; --------------------------------------------------------------------------------------------------
 ;
 ;  Blank the screen - actually writes 23 bytes beyond the end of the screen data area
@@ -975,6 +1420,12 @@ SCRLOOP:      lda #$20
               sta $8300,y
               iny
               bne SCRLOOP
+
+              ; the moves area is empty, so the first scroll has no rows to copy
+              lda #<SCROLLEND
+              sta SCROLLCOL+1
+              lda #>SCROLLEND
+              sta SCROLLCOL+2
               rts
 
 ; --------------------------------------------------------------------------------------------------
@@ -1019,32 +1470,40 @@ BSCRLOOP:     lda BLANKB1,y
               iny
               cpy #24
               bne BSCRLOOP
+
+              ; every square on the screen is blank now
+              lda #BS
+              ldx #63
+BLANKSHOWN:   sta SHOWN,x
+              dex
+              bpl BLANKSHOWN
               rts
 
 ; --------------------------------------------------------------------------------------------------
 ;
-;  Delay routine - it can be called in two ways, via THREESECS or FLASHDELAY. Basically the main
-;  loop delays enough for the flashing, and the outer loop calls that inner loop 30 times. It is
-;  only approximately 3 seconds (a bit shorter actually). This routine was adapted from code
-;  in _6502 Software Design_ by Leo J. Scanlon
+;  Delay routine - it can be called in two ways, via THREESECS or FLASHDELAY. Either way it waits
+;  for the jiffy clock to count off the time, and reads ahead in the data file while it does.
+;  Only the low byte of the clock is needed, the waits are all shorter than 256 jiffies.
 ;
-THREESECS:    lda #30
-FLASHDELAY:   ldx #$14
-              ldy #$75
-WAIT:         dex
-              bne WAIT
-              dey
-              bne WAIT
+THREESECS:    jsr SHOWBOARD       ; a position set up on the board should be seen while it waits
+              lda #PAUSEJIFFIES
+              bne WAITJIFFIES
+FLASHDELAY:   lda #FLASHJIFFIES
+WAITJIFFIES:  sta WAITLEN
+              lda JIFFYLO
+              sta WAITSTART
+
+WAIT:         jsr PREFETCH
+              lda JIFFYLO
               sec
-              sbc #1
-              bne FLASHDELAY
+              sbc WAITSTART       ; jiffies gone by, even if the clock wrapped around
+              cmp WAITLEN
+              bcc WAIT
               rts
 
 ; --------------------------------------------------------------------------------------------------
 
 ; variables
-PIECEOFFS:    .byte $00
-SCREENOFFS:   .byte $00
 SCRATCH:      .byte $00
 SCRATCH2:     .byte $00
 MOVENUM:      .byte $00
@@ -1054,6 +1513,44 @@ DSTSQUARE:    .byte $00
 PIECE:        .byte $00
 SQNUMBER:     .byte $00
 SQCOLOR:      .byte $00
+BOARDDIRTY:   .byte $00           ; 1 if BOARD has changed since it was last shown
+BOARD:        ds 64               ; the piece on each square, BS for an empty one
+SHOWN:        ds 64               ; and the piece drawn on the screen there
+
+; variables for reading the data file
+COMPRESSMODE: .byte $00           ; 1 if the data file is compressed
+GAMELEN:      .word $0000         ; minus the length of the streamed game left to read
+STREAMMODE:   .byte $00           ; 1 if the game is being streamed through RINGBUF
+OPENINGMODE:  .byte $00           ; 1 while the moves are played from an opening block
+DATAFLAGS:    .byte $00           ; the flags at the start of the data file
+RINGHEAD:     .byte $00
+RINGTAIL:     .byte $00
+BITBUF:       .byte $00           ; bits left of the current compressed byte, then a 1
+HUFFY:        .byte $00
+HUFFVAL:      .byte $00
+CMDCTX:       .byte $00           ; context of the next token
+TEXTCTX:      .byte $00           ; context of the next character of text
+STRINDEX:     .byte $00
+NUMTREES:     .byte $00
+TREENUM:      .byte $00
+COPYCOUNT:    .byte $00
+TREELO:       ds NUMCONTEXTS      ; where each context's tree was loaded
+TREEHI:       ds NUMCONTEXTS
+SYMLO:        ds NUMCONTEXTS      ; and the symbols at its leaves
+SYMHI:        ds NUMCONTEXTS
+
+; variables for reading ahead
+NEXTSTATE:    .byte NEXTNONE      ; how much of the next game has been read
+NEXTLEN:      .word $0000         ; its length
+NEXTCOUNT:    .word $0000         ; minus the length of it left to read
+NEXTSTART:    .word $0000         ; where it's loaded
+NEXTEND:      .word $0000
+GAMESTART:    .word $0000         ; where the game playing is loaded
+GAMESDATA:    .word $0000         ; where games can be loaded, past any opening blocks
+OPENINGCOUNT: .word $0000         ; minus the length of the opening blocks left to read
+GAMEEND:      .word $0000
+WAITSTART:    .byte $00           ; the jiffy clock when a wait started
+WAITLEN:      .byte $00
 
 ; --------------------------------------------------------------------------------------------------
 ;
@@ -1149,7 +1646,46 @@ FLASHK2:      .byte $A0, $DB, $A0, $A8, $D1, $A9, $FC, $62, $FE
 FLASHP1:      .byte $20, $2E, $20, $20, $E4, $20, $7C, $E2, $7E
 FLASHP2:      .byte $A0, $AE, $A0, $A0, $64, $A0, $FC, $62, $FE
 
+; --------------------------------------------------------------------------------------------------
+;
+; the address of each piece's data block, on a white square then a black one, for each piece code
+; from BR to BS - worked out here rather than multiplying the piece number by 18 for every draw
+;
+GLYPHLO:
+GLYPH         SET 0
+              REPEAT 26
+              .byte <[PIECESDATA + GLYPH * 9]
+GLYPH         SET GLYPH + 1
+              REPEND
+
+GLYPHHI:
+GLYPH         SET 0
+              REPEAT 26
+              .byte >[PIECESDATA + GLYPH * 9]
+GLYPH         SET GLYPH + 1
+              REPEND
+
+; and the first of the two flash blocks for each piece code from BR to WP
+FLASHLO:
+GLYPH         SET 0
+              REPEAT 12
+              .byte <[FLASHDATA + [GLYPH - [GLYPH / 6] * 6] * 18]
+GLYPH         SET GLYPH + 1
+              REPEND
+
+FLASHHI:
+GLYPH         SET 0
+              REPEAT 12
+              .byte >[FLASHDATA + [GLYPH - [GLYPH / 6] * 6] * 18]
+GLYPH         SET GLYPH + 1
+              REPEND
+
 ; After assembly, the address of ENDOFCODE can allow for a sanity check as to how far into BASIC
 ; memory space we've grown
 
 ENDOFCODE:
+
+; the Huffman trees of a compressed data file are loaded here, they're not part of the program file
+              SEG.U tables
+              org ENDOFCODE
+HUFFTABLES:   ds HUFFTABLESIZE
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+
+import argparse
+
+
+#
+#  Builds Commodore .d64 disk images (the 35 track, single sided 1541 format) without needing VICE's c1541.
+#
+#  Tracks are numbered from 1 and sectors from 0, with 21, 19, 18 or 17 sectors per track depending on the zone.
+#  Track 18 holds the BAM (sector 0) and the directory (sectors 1 onward).  Every sector starts with a two byte link
+#  to the next sector of the same file or directory, so each sector carries 254 bytes of data.
+#
+SECTOR_SIZE = 256
+SECTOR_DATA_SIZE = 254
+NUM_TRACKS = 35
+DIR_TRACK = 18
+DIR_INTERLEAVE = 3
+DIR_ENTRY_SIZE = 32
+FILE_TYPES = {'DEL': 0x80, 'SEQ': 0x81, 'PRG': 0x82, 'USR': 0x83}
+PAD = 0xA0
+
+
+def sectors_in_track(track):
+    if track <= 17:
+        return 21
+    if track <= 24:
+        return 19
+    if track <= 30:
+        return 18
+    return 17
+
+
+class D64Image:
+    #
+    #  Files are laid out the way the drive's own DOS would: starting on the tracks next to the directory and working
+    #  outward, and placing each sector of a file interleave sectors after the one before it.  An interleave of 10 is
+    #  what the 1541 and the PET 4040 use themselves - by the time the drive has handed one sector to the computer,
+    #  the next sector of the file is coming up under the head, so a file loads without waiting for extra revolutions.
+    #
+    def __init__(self, disk_name, disk_id, interleave=10):
+        self.disk_name = disk_name
+        self.disk_id = disk_id
+        self.interleave = interleave
+        self.sectors = {}
+        self.free = {}
+        for track in range(1, NUM_TRACKS + 1):
+            for sector in range(0, sectors_in_track(track)):
+                self.sectors[(track, sector)] = bytearray(SECTOR_SIZE)
+            self.free[track] = set(range(0, sectors_in_track(track)))
+
+        self.dir_entries = []
+        self.free[DIR_TRACK].discard(0)
+
+        # data goes on the tracks nearest the directory first, so the head never has far to travel
+        self.track_order = []
+        for distance in range(1, NUM_TRACKS):
+            for track in (DIR_TRACK - distance, DIR_TRACK + distance):
+                if 1 <= track <= NUM_TRACKS:
+                    self.track_order.append(track)
+        return
+
+    def blocks_free(self):
+        # like the drive, the directory track isn't counted
+        return sum(len(self.free[track]) for track in self.track_order)
+
+    def allocate_sector(self, track, sector, interleave):
+        #
+        #  Find the next free sector for a file whose previous sector was track/sector.  Returns None when the disk
+        #  is full.
+        #
+        tracks = self.track_order
+        if track is not None:
+            tracks = self.track_order[self.track_order.index(track):]
+
+        for next_track in tracks:
+            free = self.free[next_track]
+            if len(free) == 0:
+                continue
+            num_sectors = sectors_in_track(next_track)
+            if next_track == track:
+                wanted = (sector + interleave) % num_sectors
+            elif sector is not None:
+                wanted = sector % num_sectors
+            else:
+                wanted = 0
+
+            # take the wanted sector, or the first free one after it
+            for offset in range(0, num_sectors):
+                candidate = (wanted + offset) % num_sectors
+                if candidate in free:
+                    free.discard(candidate)
+                    return (next_track, candidate)
+        return None
+
+    def add_file(self, name, data, file_type='PRG'):
+        if len(self.dir_entries) >= (sectors_in_track(DIR_TRACK) - 1) * (SECTOR_SIZE // DIR_ENTRY_SIZE):
+            raise Exception(f"Directory full, can't add {name}")
+
+        num_blocks = max(1, (len(data) + SECTOR_DATA_SIZE - 1) // SECTOR_DATA_SIZE)
+        if num_blocks > self.blocks_free():
+            raise Exception(f"Disk full, {name} needs {num_blocks} blocks and only {self.blocks_free()} are free")
+
+        # pick every sector first, so each one can be linked to the next
+        chain = []
+        track = None
+        sector = None
+        for block in range(0, num_blocks):
+            track, sector = self.allocate_sector(track, sector, self.interleave)
+            chain.append((track, sector))
+
+        for block in range(0, num_blocks):
+            chunk = data[block * SECTOR_DATA_SIZE:(block + 1) * SECTOR_DATA_SIZE]
+            buf = self.sectors[chain[block]]
+            if block + 1 < num_blocks:
+                buf[0], buf[1] = chain[block + 1]
+            else:
+                # the last sector has track 0 and the position of its last byte in place of a link
+                buf[0] = 0
+                buf[1] = len(chunk) + 1
+            buf[2:2 + len(chunk)] = chunk
+
+        self.dir_entries.append((self.petscii_name(name), FILE_TYPES[file_type], chain[0], num_blocks))
+        return
+
+    def petscii_name(self, name):
+        # file and disk names are upper case PETSCII, padded out to 16 characters with shifted spaces
+        name = name.upper().encode('ascii', errors='replace')[:16]
+        return name + bytes([PAD]) * (16 - len(name))
+
+    def write_directory(self):
+        entries_per_sector = SECTOR_SIZE // DIR_ENTRY_SIZE
+        num_dir_sectors = max(1, (len(self.dir_entries) + entries_per_sector - 1) // entries_per_sector)
+
+        dir_chain = []
+        sector = 1
+        for i in range(0, num_dir_sectors):
+            while sector not in self.free[DIR_TRACK]:
+                sector = (sector + 1) % sectors_in_track(DIR_TRACK)
+            self.free[DIR_TRACK].discard(sector)
+            dir_chain.append(sector)
+            sector = (sector + DIR_INTERLEAVE) % sectors_in_track(DIR_TRACK)
+
+        for i, dir_sector in enumerate(dir_chain):
+            buf = self.sectors[(DIR_TRACK, dir_sector)]
+            if i + 1 < len(dir_chain):
+                buf[0] = DIR_TRACK
+                buf[1] = dir_chain[i + 1]
+            else:
+                buf[0] = 0
+                buf[1] = 0xFF
+
+            for slot, entry in enumerate(self.dir_entries[i * entries_per_sector:(i + 1) * entries_per_sector]):
+                name, type_code, (track, sector), num_blocks = entry
+                base = slot * DIR_ENTRY_SIZE
+                buf[base + 2] = type_code
+                buf[base + 3] = track
+                buf[base + 4] = sector
+                buf[base + 5:base + 21] = name
+                buf[base + 30] = num_blocks & 0xFF
+                buf[base + 31] = num_blocks >> 8
+        return dir_chain[0]
+
+    def write_bam(self, first_dir_sector):
+        buf = self.sectors[(DIR_TRACK, 0)]
+        buf[0] = DIR_TRACK
+        buf[1] = first_dir_sector
+        buf[2] = ord('A')
+        buf[3] = 0
+
+        # one entry per track: the count of free sectors and then a bitmap of them, a set bit means free
+        for track in range(1, NUM_TRACKS + 1):
+            bitmap = 0
+            for sector in self.free[track]:
+                bitmap |= 1 << sector
+            base = 4 * track
+            buf[base] = len(self.free[track])
+            buf[base + 1] = bitmap & 0xFF
+            buf[base + 2] = (bitmap >> 8) & 0xFF
+            buf[base + 3] = (bitmap >> 16) & 0xFF
+
+        buf[0x90:0xA0] = self.petscii_name(self.disk_name)
+        buf[0xA0] = PAD
+        buf[0xA1] = PAD
+        buf[0xA2:0xA4] = self.petscii_name(self.disk_id)[:2]
+        buf[0xA4] = PAD
+        buf[0xA5:0xA7] = b'2A'
+        buf[0xA7:0xAB] = bytes([PAD]) * 4
+        return
+
+    def image_bytes(self):
+        first_dir_sector = self.write_directory()
+        self.write_bam(first_dir_sector)
+        image = bytearray()
+        for track in range(1, NUM_TRACKS + 1):
+            for sector in range(0, sectors_in_track(track)):
+                image += self.sectors[(track, sector)]
+        return image
+
+    def save(self, filename):
+        with open(filename, 'wb') as fhw:
+            fhw.write(self.image_bytes())
+        return
+
+
+def build_chessreplay_d64(filename, prg_filename='chessreplay.prg', data_filename='chessdata', interleave=10):
+    # the same disk maked64.sh used to build with c1541
+    image = D64Image('chessreplay', 'rr', interleave=interleave)
+    with open(prg_filename, 'rb') as fh:
+        image.add_file('chessreplay', fh.read())
+    with open(data_filename, 'rb') as fh:
+        image.add_file('chessdata', fh.read())
+    image.save(filename)
+    return image.blocks_free()
+
+
+if __name__ == '__main__':
+    argp = argparse.ArgumentParser(description='Builds a .d64 disk image holding the Chess Replayer and its data file.')
+    argp.add_argument('d64', help='Name of the .d64 image to write')
+    argp.add_argument('--prg', default='chessreplay.prg', help='The assembled replayer (default: chessreplay.prg)')
+    argp.add_argument('--data', default='chessdata', help='The chess data file (default: chessdata)')
+    argp.add_argument('--interleave', type=int, default=10, help='Sector interleave for file data (default: 10)')
+    args = argp.parse_args()
+
+    blocks_free = build_chessreplay_d64(args.d64, args.prg, args.data, interleave=args.interleave)
+    print(f"wrote {args.d64}, {blocks_free} blocks free")
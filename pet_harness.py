@@ -0,0 +1,778 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+
+import pgn_to_pet
+
+#
+#  Runs the assembled Chess Replayer without an emulator: a 6502 core, the bits of the PET's memory map it touches,
+#  and stand-ins for the KERNAL file routines that hand it bytes from a chessdata file.  The replayer is loaded from
+#  its .prg and the addresses of its routines are taken from the symbol file dasm writes with -s.  The stand-ins
+#  take no cycles themselves, so the counts are only the replayer's own work and leave out the time the real KERNAL
+#  and disk drive would spend.
+#
+#  The jiffy clock is counted up every JIFFY_CYCLES cycles, which is 60 times a second on a 1MHz PET, so the pauses
+#  take as many cycles as they would on the real machine.
+#
+JIFFY_CYCLES = 16667
+SCREEN_START = 0x8000
+SCREEN_SIZE = 1000
+JIFFY_CLOCK = 0x8D
+BASIC_SYS_TOKEN = 0x9E
+
+# the routines the report breaks the cycles down by
+TIMED_ROUTINES = ('READCHGAME', 'PREFETCH', 'NEXTBYTE', 'DRAWCHESSMOVE', 'SHOWBOARD', 'PRINTPGN', 'SCROLLMOVES',
+                  'THREESECS', 'FLASHDELAY')
+DELAY_ROUTINES = ('THREESECS', 'FLASHDELAY')
+
+FLAG_C = 0x01
+FLAG_Z = 0x02
+FLAG_I = 0x04
+FLAG_D = 0x08
+FLAG_B = 0x10
+FLAG_U = 0x20
+FLAG_V = 0x40
+FLAG_N = 0x80
+
+
+def read_dasm_symbols(filename):
+    # dasm's symbol file has a line per symbol, its name and then its value in hex
+    symbols = {}
+    with open(filename, 'r') as fh:
+        for line in fh:
+            fields = line.split()
+            if len(fields) < 2 or line.startswith('---'):
+                continue
+            try:
+                symbols[fields[0]] = int(fields[1], 16)
+            except ValueError:
+                # string symbols
+                continue
+    return symbols
+
+
+def screen_code_to_text(code):
+    # letters, digits and punctuation come out as themselves, graphics characters as '#' and reversed ones as '*'
+    if code >= 128:
+        return '*' if code != 0xA0 else '#'
+    if code < 32:
+        return chr(code + 64)
+    if code < 64:
+        return chr(code)
+    return '#'
+
+
+class CPU6502:
+    #
+    #  A 6502 core covering the documented opcodes, counting cycles the way the real chip does - including the extra
+    #  cycle for crossing a page on indexed reads and for taken branches.  Memory is a flat 64K bytearray, there's no
+    #  I/O behind it.
+    #
+    def __init__(self, memory):
+        self.mem = memory
+        self.a = 0
+        self.x = 0
+        self.y = 0
+        self.sp = 0xFF
+        self.p = FLAG_U | FLAG_I
+        self.pc = 0
+        self.cycles = 0
+        self.ops = self.build_op_table()
+        return
+
+    def read_word(self, addr):
+        return self.mem[addr & 0xFFFF] | (self.mem[(addr + 1) & 0xFFFF] << 8)
+
+    def read_word_zp(self, addr):
+        return self.mem[addr & 0xFF] | (self.mem[(addr + 1) & 0xFF] << 8)
+
+    def push(self, value):
+        self.mem[0x100 + self.sp] = value & 0xFF
+        self.sp = (self.sp - 1) & 0xFF
+        return
+
+    def pull(self):
+        self.sp = (self.sp + 1) & 0xFF
+        return self.mem[0x100 + self.sp]
+
+    def set_nz(self, value):
+        self.p = (self.p & ~(FLAG_N | FLAG_Z)) | (value & FLAG_N) | (0 if value else FLAG_Z)
+        return value
+
+    def step(self):
+        opcode = self.mem[self.pc]
+        entry = self.ops[opcode]
+        if entry is None:
+            raise Exception(f"illegal opcode ${opcode:02X} at ${self.pc:04X}")
+        handler, mode, cycles = entry
+        self.pc = (self.pc + 1) & 0xFFFF
+        self.cycles += cycles
+        handler(mode)
+        return
+
+    def addr(self, mode, page_penalty=False):
+        # the effective address of the operand, stepping the pc past it
+        pc = self.pc
+        mem = self.mem
+        if mode == 'imm':
+            self.pc = (pc + 1) & 0xFFFF
+            return pc
+        if mode == 'zp':
+            self.pc = (pc + 1) & 0xFFFF
+            return mem[pc]
+        if mode == 'zpx':
+            self.pc = (pc + 1) & 0xFFFF
+            return (mem[pc] + self.x) & 0xFF
+        if mode == 'zpy':
+            self.pc = (pc + 1) & 0xFFFF
+            return (mem[pc] + self.y) & 0xFF
+        if mode == 'abs':
+            self.pc = (pc + 2) & 0xFFFF
+            return mem[pc] | (mem[(pc + 1) & 0xFFFF] << 8)
+        if mode == 'absx' or mode == 'absy':
+            self.pc = (pc + 2) & 0xFFFF
+            base = mem[pc] | (mem[(pc + 1) & 0xFFFF] << 8)
+            effective = (base + (self.x if mode == 'absx' else self.y)) & 0xFFFF
+            if page_penalty and (base & 0xFF00) != (effective & 0xFF00):
+                self.cycles += 1
+            return effective
+        if mode == 'indx':
+            self.pc = (pc + 1) & 0xFFFF
+            return self.read_word_zp((mem[pc] + self.x) & 0xFF)
+        if mode == 'indy':
+            self.pc = (pc + 1) & 0xFFFF
+            base = self.read_word_zp(mem[pc])
+            effective = (base + self.y) & 0xFFFF
+            if page_penalty and (base & 0xFF00) != (effective & 0xFF00):
+                self.cycles += 1
+            return effective
+        if mode == 'ind':
+            self.pc = (pc + 2) & 0xFFFF
+            pointer = mem[pc] | (mem[(pc + 1) & 0xFFFF] << 8)
+            # the 6502 never carries into the high byte when fetching an indirect jump's vector
+            return mem[pointer] | (mem[(pointer & 0xFF00) | ((pointer + 1) & 0xFF)] << 8)
+        raise Exception(f"bad mode {mode}")
+
+    def read_operand(self, mode):
+        return self.mem[self.addr(mode, True)]
+
+    def op_lda(self, mode):
+        self.a = self.set_nz(self.read_operand(mode))
+        return
+
+    def op_ldx(self, mode):
+        self.x = self.set_nz(self.read_operand(mode))
+        return
+
+    def op_ldy(self, mode):
+        self.y = self.set_nz(self.read_operand(mode))
+        return
+
+    def op_sta(self, mode):
+        self.mem[self.addr(mode)] = self.a
+        return
+
+    def op_stx(self, mode):
+        self.mem[self.addr(mode)] = self.x
+        return
+
+    def op_sty(self, mode):
+        self.mem[self.addr(mode)] = self.y
+        return
+
+    def op_adc(self, mode):
+        value = self.read_operand(mode)
+        carry = self.p & FLAG_C
+        if self.p & FLAG_D:
+            lo = (self.a & 0x0F) + (value & 0x0F) + carry
+            hi = (self.a >> 4) + (value >> 4)
+            if lo > 9:
+                lo += 6
+                hi += 1
+            binary = self.a + value + carry
+            overflow = (~(self.a ^ value) & (self.a ^ binary)) & 0x80
+            if hi > 9:
+                hi += 6
+            result = ((hi << 4) | (lo & 0x0F)) & 0xFF
+            self.p = (self.p & ~(FLAG_C | FLAG_V)) | (FLAG_C if hi > 15 else 0) | (FLAG_V if overflow else 0)
+            self.a = self.set_nz(result)
+            return
+        result = self.a + value + carry
+        overflow = (~(self.a ^ value) & (self.a ^ result)) & 0x80
+        self.p = (self.p & ~(FLAG_C | FLAG_V)) | (FLAG_C if result > 0xFF else 0) | (FLAG_V if overflow else 0)
+        self.a = self.set_nz(result & 0xFF)
+        return
+
+    def op_sbc(self, mode):
+        value = self.read_operand(mode)
+        borrow = 1 - (self.p & FLAG_C)
+        result = self.a - value - borrow
+        overflow = ((self.a ^ value) & (self.a ^ result)) & 0x80
+        if self.p & FLAG_D:
+            lo = (self.a & 0x0F) - (value & 0x0F) - borrow
+            hi = (self.a >> 4) - (value >> 4)
+            if lo < 0:
+                lo -= 6
+                hi -= 1
+            if hi < 0:
+                hi -= 6
+            decimal = ((hi << 4) | (lo & 0x0F)) & 0xFF
+            self.p = (self.p & ~(FLAG_C | FLAG_V)) | (FLAG_C if result >= 0 else 0) | (FLAG_V if overflow else 0)
+            self.a = self.set_nz(decimal)
+            return
+        self.p = (self.p & ~(FLAG_C | FLAG_V)) | (FLAG_C if result >= 0 else 0) | (FLAG_V if overflow else 0)
+        self.a = self.set_nz(result & 0xFF)
+        return
+
+    def compare(self, register, mode):
+        value = self.read_operand(mode)
+        result = register - value
+        self.p = (self.p & ~FLAG_C) | (FLAG_C if result >= 0 else 0)
+        self.set_nz(result & 0xFF)
+        return
+
+    def op_cmp(self, mode):
+        self.compare(self.a, mode)
+        return
+
+    def op_cpx(self, mode):
+        self.compare(self.x, mode)
+        return
+
+    def op_cpy(self, mode):
+        self.compare(self.y, mode)
+        return
+
+    def op_and(self, mode):
+        self.a = self.set_nz(self.a & self.read_operand(mode))
+        return
+
+    def op_ora(self, mode):
+        self.a = self.set_nz(self.a | self.read_operand(mode))
+        return
+
+    def op_eor(self, mode):
+        self.a = self.set_nz(self.a ^ self.read_operand(mode))
+        return
+
+    def op_bit(self, mode):
+        value = self.read_operand(mode)
+        self.p = ((self.p & ~(FLAG_N | FLAG_V | FLAG_Z)) | (value & (FLAG_N | FLAG_V))
+                  | (0 if self.a & value else FLAG_Z))
+        return
+
+    def read_modify_write(self, mode, func):
+        if mode == 'acc':
+            self.a = self.set_nz(func(self.a))
+            return
+        address = self.addr(mode)
+        self.mem[address] = self.set_nz(func(self.mem[address]))
+        return
+
+    def op_asl(self, mode):
+        def shift(value):
+            self.p = (self.p & ~FLAG_C) | ((value >> 7) & 1)
+            return (value << 1) & 0xFF
+        self.read_modify_write(mode, shift)
+        return
+
+    def op_lsr(self, mode):
+        def shift(value):
+            self.p = (self.p & ~FLAG_C) | (value & 1)
+            return value >> 1
+        self.read_modify_write(mode, shift)
+        return
+
+    def op_rol(self, mode):
+        def shift(value):
+            carry = self.p & FLAG_C
+            self.p = (self.p & ~FLAG_C) | ((value >> 7) & 1)
+            return ((value << 1) | carry) & 0xFF
+        self.read_modify_write(mode, shift)
+        return
+
+    def op_ror(self, mode):
+        def shift(value):
+            carry = self.p & FLAG_C
+            self.p = (self.p & ~FLAG_C) | (value & 1)
+            return (value >> 1) | (carry << 7)
+        self.read_modify_write(mode, shift)
+        return
+
+    def op_inc(self, mode):
+        self.read_modify_write(mode, lambda value: (value + 1) & 0xFF)
+        return
+
+    def op_dec(self, mode):
+        self.read_modify_write(mode, lambda value: (value - 1) & 0xFF)
+        return
+
+    def op_inx(self, mode):
+        self.x = self.set_nz((self.x + 1) & 0xFF)
+        return
+
+    def op_iny(self, mode):
+        self.y = self.set_nz((self.y + 1) & 0xFF)
+        return
+
+    def op_dex(self, mode):
+        self.x = self.set_nz((self.x - 1) & 0xFF)
+        return
+
+    def op_dey(self, mode):
+        self.y = self.set_nz((self.y - 1) & 0xFF)
+        return
+
+    def op_tax(self, mode):
+        self.x = self.set_nz(self.a)
+        return
+
+    def op_tay(self, mode):
+        self.y = self.set_nz(self.a)
+        return
+
+    def op_txa(self, mode):
+        self.a = self.set_nz(self.x)
+        return
+
+    def op_tya(self, mode):
+        self.a = self.set_nz(self.y)
+        return
+
+    def op_tsx(self, mode):
+        self.x = self.set_nz(self.sp)
+        return
+
+    def op_txs(self, mode):
+        self.sp = self.x
+        return
+
+    def op_pha(self, mode):
+        self.push(self.a)
+        return
+
+    def op_php(self, mode):
+        self.push(self.p | FLAG_B | FLAG_U)
+        return
+
+    def op_pla(self, mode):
+        self.a = self.set_nz(self.pull())
+        return
+
+    def op_plp(self, mode):
+        self.p = (self.pull() & ~FLAG_B) | FLAG_U
+        return
+
+    def branch(self, taken):
+        offset = self.mem[self.pc]
+        self.pc = (self.pc + 1) & 0xFFFF
+        if taken:
+            target = (self.pc + (offset - 256 if offset & 0x80 else offset)) & 0xFFFF
+            self.cycles += 1 if (target & 0xFF00) == (self.pc & 0xFF00) else 2
+            self.pc = target
+        return
+
+    def op_bcc(self, mode):
+        self.branch(not self.p & FLAG_C)
+        return
+
+    def op_bcs(self, mode):
+        self.branch(self.p & FLAG_C)
+        return
+
+    def op_beq(self, mode):
+        self.branch(self.p & FLAG_Z)
+        return
+
+    def op_bne(self, mode):
+        self.branch(not self.p & FLAG_Z)
+        return
+
+    def op_bmi(self, mode):
+        self.branch(self.p & FLAG_N)
+        return
+
+    def op_bpl(self, mode):
+        self.branch(not self.p & FLAG_N)
+        return
+
+    def op_bvc(self, mode):
+        self.branch(not self.p & FLAG_V)
+        return
+
+    def op_bvs(self, mode):
+        self.branch(self.p & FLAG_V)
+        return
+
+    def op_jmp(self, mode):
+        self.pc = self.addr(mode)
+        return
+
+    def op_jsr(self, mode):
+        target = self.addr('abs')
+        return_addr = (self.pc - 1) & 0xFFFF
+        self.push(return_addr >> 8)
+        self.push(return_addr & 0xFF)
+        self.pc = target
+        return
+
+    def op_rts(self, mode):
+        lo = self.pull()
+        hi = self.pull()
+        self.pc = (((hi << 8) | lo) + 1) & 0xFFFF
+        return
+
+    def op_rti(self, mode):
+        self.p = (self.pull() & ~FLAG_B) | FLAG_U
+        lo = self.pull()
+        hi = self.pull()
+        self.pc = (hi << 8) | lo
+        return
+
+    def op_brk(self, mode):
+        return_addr = (self.pc + 1) & 0xFFFF
+        self.push(return_addr >> 8)
+        self.push(return_addr & 0xFF)
+        self.push(self.p | FLAG_B | FLAG_U)
+        self.p |= FLAG_I
+        self.pc = self.read_word(0xFFFE)
+        return
+
+    def op_nop(self, mode):
+        pass
+        return
+
+    def flag_op(self, flag, value):
+        def handler(mode):
+            self.p = (self.p | flag) if value else (self.p & ~flag)
+        return handler
+
+    def build_op_table(self):
+        table = [None] * 256
+        # opcode: (instruction, addressing mode, base cycles)
+        spec = {
+            0x69: ('adc', 'imm', 2), 0x65: ('adc', 'zp', 3), 0x75: ('adc', 'zpx', 4), 0x6D: ('adc', 'abs', 4),
+            0x7D: ('adc', 'absx', 4), 0x79: ('adc', 'absy', 4), 0x61: ('adc', 'indx', 6), 0x71: ('adc', 'indy', 5),
+            0x29: ('and', 'imm', 2), 0x25: ('and', 'zp', 3), 0x35: ('and', 'zpx', 4), 0x2D: ('and', 'abs', 4),
+            0x3D: ('and', 'absx', 4), 0x39: ('and', 'absy', 4), 0x21: ('and', 'indx', 6), 0x31: ('and', 'indy', 5),
+            0x0A: ('asl', 'acc', 2), 0x06: ('asl', 'zp', 5), 0x16: ('asl', 'zpx', 6), 0x0E: ('asl', 'abs', 6),
+            0x1E: ('asl', 'absx', 7),
+            0x90: ('bcc', 'rel', 2), 0xB0: ('bcs', 'rel', 2), 0xF0: ('beq', 'rel', 2), 0x30: ('bmi', 'rel', 2),
+            0xD0: ('bne', 'rel', 2), 0x10: ('bpl', 'rel', 2), 0x50: ('bvc', 'rel', 2), 0x70: ('bvs', 'rel', 2),
+            0x24: ('bit', 'zp', 3), 0x2C: ('bit', 'abs', 4), 0x00: ('brk', 'imp', 7),
+            0xC9: ('cmp', 'imm', 2), 0xC5: ('cmp', 'zp', 3), 0xD5: ('cmp', 'zpx', 4), 0xCD: ('cmp', 'abs', 4),
+            0xDD: ('cmp', 'absx', 4), 0xD9: ('cmp', 'absy', 4), 0xC1: ('cmp', 'indx', 6), 0xD1: ('cmp', 'indy', 5),
+            0xE0: ('cpx', 'imm', 2), 0xE4: ('cpx', 'zp', 3), 0xEC: ('cpx', 'abs', 4),
+            0xC0: ('cpy', 'imm', 2), 0xC4: ('cpy', 'zp', 3), 0xCC: ('cpy', 'abs', 4),
+            0xC6: ('dec', 'zp', 5), 0xD6: ('dec', 'zpx', 6), 0xCE: ('dec', 'abs', 6), 0xDE: ('dec', 'absx', 7),
+            0xCA: ('dex', 'imp', 2), 0x88: ('dey', 'imp', 2),
+            0x49: ('eor', 'imm', 2), 0x45: ('eor', 'zp', 3), 0x55: ('eor', 'zpx', 4), 0x4D: ('eor', 'abs', 4),
+            0x5D: ('eor', 'absx', 4), 0x59: ('eor', 'absy', 4), 0x41: ('eor', 'indx', 6), 0x51: ('eor', 'indy', 5),
+            0xE6: ('inc', 'zp', 5), 0xF6: ('inc', 'zpx', 6), 0xEE: ('inc', 'abs', 6), 0xFE: ('inc', 'absx', 7),
+            0xE8: ('inx', 'imp', 2), 0xC8: ('iny', 'imp', 2),
+            0x4C: ('jmp', 'abs', 3), 0x6C: ('jmp', 'ind', 5), 0x20: ('jsr', 'abs', 6),
+            0xA9: ('lda', 'imm', 2), 0xA5: ('lda', 'zp', 3), 0xB5: ('lda', 'zpx', 4), 0xAD: ('lda', 'abs', 4),
+            0xBD: ('lda', 'absx', 4), 0xB9: ('lda', 'absy', 4), 0xA1: ('lda', 'indx', 6), 0xB1: ('lda', 'indy', 5),
+            0xA2: ('ldx', 'imm', 2), 0xA6: ('ldx', 'zp', 3), 0xB6: ('ldx', 'zpy', 4), 0xAE: ('ldx', 'abs', 4),
+            0xBE: ('ldx', 'absy', 4),
+            0xA0: ('ldy', 'imm', 2), 0xA4: ('ldy', 'zp', 3), 0xB4: ('ldy', 'zpx', 4), 0xAC: ('ldy', 'abs', 4),
+            0xBC: ('ldy', 'absx', 4),
+            0x4A: ('lsr', 'acc', 2), 0x46: ('lsr', 'zp', 5), 0x56: ('lsr', 'zpx', 6), 0x4E: ('lsr', 'abs', 6),
+            0x5E: ('lsr', 'absx', 7), 0xEA: ('nop', 'imp', 2),
+            0x09: ('ora', 'imm', 2), 0x05: ('ora', 'zp', 3), 0x15: ('ora', 'zpx', 4), 0x0D: ('ora', 'abs', 4),
+            0x1D: ('ora', 'absx', 4), 0x19: ('ora', 'absy', 4), 0x01: ('ora', 'indx', 6), 0x11: ('ora', 'indy', 5),
+            0x48: ('pha', 'imp', 3), 0x08: ('php', 'imp', 3), 0x68: ('pla', 'imp', 4), 0x28: ('plp', 'imp', 4),
+            0x2A: ('rol', 'acc', 2), 0x26: ('rol', 'zp', 5), 0x36: ('rol', 'zpx', 6), 0x2E: ('rol', 'abs', 6),
+            0x3E: ('rol', 'absx', 7),
+            0x6A: ('ror', 'acc', 2), 0x66: ('ror', 'zp', 5), 0x76: ('ror', 'zpx', 6), 0x6E: ('ror', 'abs', 6),
+            0x7E: ('ror', 'absx', 7),
+            0x40: ('rti', 'imp', 6), 0x60: ('rts', 'imp', 6),
+            0xE9: ('sbc', 'imm', 2), 0xE5: ('sbc', 'zp', 3), 0xF5: ('sbc', 'zpx', 4), 0xED: ('sbc', 'abs', 4),
+            0xFD: ('sbc', 'absx', 4), 0xF9: ('sbc', 'absy', 4), 0xE1: ('sbc', 'indx', 6), 0xF1: ('sbc', 'indy', 5),
+            0x85: ('sta', 'zp', 3), 0x95: ('sta', 'zpx', 4), 0x8D: ('sta', 'abs', 4), 0x9D: ('sta', 'absx', 5),
+            0x99: ('sta', 'absy', 5), 0x81: ('sta', 'indx', 6), 0x91: ('sta', 'indy', 6),
+            0x86: ('stx', 'zp', 3), 0x96: ('stx', 'zpy', 4), 0x8E: ('stx', 'abs', 4),
+            0x84: ('sty', 'zp', 3), 0x94: ('sty', 'zpx', 4), 0x8C: ('sty', 'abs', 4),
+            0xAA: ('tax', 'imp', 2), 0xA8: ('tay', 'imp', 2), 0xBA: ('tsx', 'imp', 2), 0x8A: ('txa', 'imp', 2),
+            0x9A: ('txs', 'imp', 2), 0x98: ('tya', 'imp', 2),
+        }
+        flags = {0x18: (FLAG_C, False), 0x38: (FLAG_C, True), 0x58: (FLAG_I, False), 0x78: (FLAG_I, True),
+                 0xB8: (FLAG_V, False), 0xD8: (FLAG_D, False), 0xF8: (FLAG_D, True)}
+        for opcode, (name, mode, cycles) in spec.items():
+            table[opcode] = (getattr(self, 'op_' + name), mode, cycles)
+        for opcode, (flag, value) in flags.items():
+            table[opcode] = (self.flag_op(flag, value), 'imp', 2)
+        return table
+
+
+class PetHarness:
+    #
+    #  Plays a chessdata file through the replayer and keeps count of where the cycles go.
+    #
+    #  Cycles are charged to each token from the moment the main loop goes to read it (TOPOFLOOP) until it comes back
+    #  for the next one, so a token's cycles include decoding it and everything it draws.  The routines in
+    #  TIMED_ROUTINES are timed from their first instruction until the rts that returns from them, including
+    #  whatever they call.  Time spent in the delay routines is left out of everything else, tokens and routines
+    #  alike, so the drawing costs can be seen without 3 second pauses swamping them.
+    #
+    def __init__(self, prg, symbols, data, memtop=0x8000, jiffy_cycles=JIFFY_CYCLES):
+        self.mem = bytearray(0x10000)
+        load_address = prg[0] | (prg[1] << 8)
+        self.mem[load_address:load_address + len(prg) - 2] = prg[2:]
+        self.symbols = symbols
+        self.data = data
+        self.data_pos = None
+        self.jiffy_cycles = jiffy_cycles
+        self.next_jiffy = jiffy_cycles
+        self.stream_name = pgn_to_pet.PgnToPet().stream_name
+
+        self.cpu = CPU6502(self.mem)
+        self.cpu.pc = self.find_sys_address(prg, load_address)
+        self.mem[symbols['MEMSIZLOC']] = memtop & 0xFF
+        self.mem[symbols['MEMSIZLOC'] + 1] = memtop >> 8
+
+        # the KERNAL isn't there, these stand in for the entry points the replayer calls
+        self.hooks = {symbols['KERNALOPENFILE']: self.kernal_open, symbols['KERNALSETINPUT']: self.kernal_rts,
+                      symbols['KERNALREADCHAR']: self.kernal_readchar, symbols['KERNALCLOSE']: self.kernal_close}
+        self.hooks[symbols['TOPOFLOOP']] = self.start_token
+        self.hooks[symbols['DOJUMP']] = self.name_token
+        self.hooks[symbols['DRAWCHESSMOVE']] = self.name_move_token
+        self.hooks[symbols['NEXTGAME']] = self.start_game
+        self.routine_names = {symbols[name]: name for name in TIMED_ROUTINES}
+
+        self.opens = 0
+        self.reads = 0
+        self.games_started = 0
+        self.frames = []
+        self.delay_cycles = 0
+        self.token = None
+        self.token_start = (0, 0)
+        self.token_counts = {}
+        self.token_cycles = {}
+        self.move_starts = [[]]
+        self.routine_calls = dict.fromkeys(TIMED_ROUTINES, 0)
+        self.routine_cycles = dict.fromkeys(TIMED_ROUTINES, 0)
+        self.routine_max = dict.fromkeys(TIMED_ROUTINES, 0)
+        return
+
+    def find_sys_address(self, prg, load_address):
+        # the BASIC stub at the front of the program is a SYS to the machine code
+        sys_pos = prg.index(BASIC_SYS_TOKEN, 2) + 1
+        digits = ''
+        while chr(prg[sys_pos]).isdigit() or prg[sys_pos] == ord(' '):
+            digits += chr(prg[sys_pos])
+            sys_pos += 1
+        return int(digits)
+
+    def kernal_rts(self):
+        self.cpu.op_rts(None)
+        return
+
+    def kernal_open(self):
+        self.opens += 1
+        self.data_pos = 0
+        self.kernal_rts()
+        return
+
+    def kernal_close(self):
+        self.data_pos = None
+        self.kernal_rts()
+        return
+
+    def kernal_readchar(self):
+        # past the end of the file the KERNAL hands back carriage returns
+        if self.data_pos is None or self.data_pos >= len(self.data):
+            self.cpu.a = 0x0D
+        else:
+            self.cpu.a = self.data[self.data_pos]
+            self.data_pos += 1
+        self.reads += 1
+        self.kernal_rts()
+        return
+
+    def start_token(self):
+        self.end_token()
+        self.token_start = (self.cpu.cycles, self.delay_cycles)
+        return
+
+    def end_token(self):
+        if self.token is None:
+            return
+        start_cycles, start_delay = self.token_start
+        cycles = self.cpu.cycles - start_cycles - (self.delay_cycles - start_delay)
+        self.token_counts[self.token] = self.token_counts.get(self.token, 0) + 1
+        self.token_cycles[self.token] = self.token_cycles.get(self.token, 0) + cycles
+        self.token = None
+        return
+
+    def name_token(self):
+        # the token less 114 is in the accumulator here
+        self.token = self.stream_name[self.cpu.a + self.symbols['ZZ']]
+        if self.token == 'PG':
+            self.move_starts[-1].append(self.token_start)
+        return
+
+    def name_move_token(self):
+        self.token = 'move'
+        return
+
+    def start_game(self):
+        # the NG token's cycles run all the way to the new game's first token
+        self.games_started += 1
+        self.move_starts.append([])
+        return
+
+    def enter_routine(self, name):
+        cpu = self.cpu
+        # a routine that jumps back to its own start is still the same call
+        if len(self.frames) > 0 and self.frames[-1][0] == name and self.frames[-1][1] == cpu.sp:
+            return
+        self.frames.append((name, cpu.sp, cpu.cycles, self.delay_cycles))
+        return
+
+    def leave_routines(self):
+        # an rts has just run, which returns from any routine whose return address was at or above the stack pointer
+        cpu = self.cpu
+        while len(self.frames) > 0 and self.frames[-1][1] < cpu.sp:
+            name, sp, start_cycles, start_delay = self.frames.pop()
+            cycles = cpu.cycles - start_cycles
+            if name not in DELAY_ROUTINES:
+                cycles -= self.delay_cycles - start_delay
+            self.routine_calls[name] += 1
+            self.routine_cycles[name] += cycles
+            self.routine_max[name] = max(self.routine_max[name], cycles)
+            # delays can be nested in one another, only the outermost one counts
+            if name in DELAY_ROUTINES and not any(frame[0] in DELAY_ROUTINES for frame in self.frames):
+                self.delay_cycles += cycles
+        return
+
+    def tick_jiffies(self):
+        mem = self.mem
+        while self.cpu.cycles >= self.next_jiffy:
+            self.next_jiffy += self.jiffy_cycles
+            clock = ((mem[JIFFY_CLOCK] << 16) | (mem[JIFFY_CLOCK + 1] << 8) | mem[JIFFY_CLOCK + 2]) + 1
+            mem[JIFFY_CLOCK] = (clock >> 16) & 0xFF
+            mem[JIFFY_CLOCK + 1] = (clock >> 8) & 0xFF
+            mem[JIFFY_CLOCK + 2] = clock & 0xFF
+        return
+
+    def run(self, games=None, max_cycles=None):
+        #
+        #  Runs until the given number of games have been played, the replayer goes back to the start of the data
+        #  file, or max_cycles is reached.
+        #
+        cpu = self.cpu
+        mem = self.mem
+        hooks = self.hooks
+        routine_names = self.routine_names
+        while max_cycles is None or cpu.cycles < max_cycles:
+            pc = cpu.pc
+            if pc in hooks:
+                hooks[pc]()
+                if self.opens > 1 or (games is not None and self.games_started > games):
+                    break
+                if cpu.pc != pc:
+                    # a KERNAL routine was stood in for
+                    continue
+            if pc in routine_names:
+                self.enter_routine(routine_names[pc])
+
+            returning = mem[pc] == 0x60
+            cpu.step()
+            if returning and len(self.frames) > 0:
+                self.leave_routines()
+            if cpu.cycles >= self.next_jiffy:
+                self.tick_jiffies()
+        self.end_token()
+        return
+
+    def screen_dump(self):
+        return bytes(self.mem[SCREEN_START:SCREEN_START + SCREEN_SIZE])
+
+    def screen_text(self):
+        screen = self.screen_dump()
+        return '\n'.join(''.join(screen_code_to_text(code) for code in screen[row:row + 40])
+                         for row in range(0, SCREEN_SIZE, 40))
+
+    def move_cycles(self):
+        # the cycles from each PG record to the next in the same game, less any delays, which covers a whole move
+        cycles = []
+        for game_starts in self.move_starts:
+            for (start_cycles, start_delay), (end_cycles, end_delay) in zip(game_starts, game_starts[1:]):
+                cycles.append(end_cycles - start_cycles - (end_delay - start_delay))
+        return cycles
+
+    def print_report(self):
+        print(f"cycles: {self.cpu.cycles}, games: {self.token_counts.get('NG', 0)}, bytes read: {self.reads}, "
+              f"cycles in delays: {self.delay_cycles}")
+        print()
+        print(f"{'token':<8} {'count':>8} {'cycles':>12} {'per token':>10}")
+        for token, count in sorted(self.token_counts.items(), key=lambda item: self.token_cycles[item[0]],
+                                   reverse=True):
+            print(f"{token:<8} {count:>8} {self.token_cycles[token]:>12} {self.token_cycles[token] // count:>10}")
+        print("(cycles in delays are left out)")
+
+        move_cycles = self.move_cycles()
+        if len(move_cycles) > 0:
+            print()
+            print(f"moves: {len(move_cycles)}, cycles per move: {sum(move_cycles) // len(move_cycles)} on average, "
+                  f"{max(move_cycles)} at most (cycles in delays are left out)")
+        print()
+        print(f"{'routine':<14} {'calls':>8} {'cycles':>12} {'per call':>10} {'most':>10}")
+        for name in TIMED_ROUTINES:
+            calls = self.routine_calls[name]
+            if calls == 0:
+                continue
+            cycles = self.routine_cycles[name]
+            print(f"{name:<14} {calls:>8} {cycles:>12} {cycles // calls:>10} {self.routine_max[name]:>10}")
+        print("(cycles in delays are left out, except from the delay routines themselves)")
+        return
+
+
+if __name__ == '__main__':
+    helptext = """
+Runs chessreplay.prg against a chessdata file on an emulated 6502, with no
+PET or emulator needed, and reports how many cycles it spends on each token,
+on each move and in its main routines.  The screen is printed at the end.
+
+The replayer's routines are found with the symbol file dasm writes with -s,
+which build.sh puts next to the .prg.
+"""
+    argp = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=helptext)
+    argp.add_argument('prg', nargs='?', default='chessreplay.prg',
+                      help='The assembled replayer (default: chessreplay.prg)')
+    argp.add_argument('--symbols', metavar='FILE',
+                      help="dasm's symbol file for the replayer (default: the .prg's name ending in .sym)")
+    argp.add_argument('--data', metavar='FILE', default='chessdata',
+                      help='The chess data file to play (default: chessdata)')
+    argp.add_argument('--games', type=int, default=1,
+                      help='Number of games to play (default: 1), 0 plays the whole file')
+    argp.add_argument('--max-cycles', type=int, help='Stop after this many cycles')
+    argp.add_argument('--memtop', default='8000',
+                      help='Top of memory in hex, as BASIC would leave it on the PET (default: 8000, a 32K PET)')
+    argp.add_argument('--jiffy-cycles', type=int, default=JIFFY_CYCLES,
+                      help=f'Cycles between jiffy clock ticks (default: {JIFFY_CYCLES}). Make it smaller to run the '
+                           f'pauses faster.')
+    argp.add_argument('--screen', metavar='FILE', help='Also write the 1000 bytes of screen memory to this file')
+    args = argp.parse_args()
+
+    symbols_filename = args.symbols
+    if symbols_filename is None:
+        symbols_filename = os.path.splitext(args.prg)[0] + '.sym'
+
+    with open(args.prg, 'rb') as fh:
+        prg = fh.read()
+    with open(args.data, 'rb') as fh:
+        data = fh.read()
+
+    harness = PetHarness(prg, read_dasm_symbols(symbols_filename), data, memtop=int(args.memtop, 16),
+                         jiffy_cycles=args.jiffy_cycles)
+    harness.run(games=args.games if args.games > 0 else None, max_cycles=args.max_cycles)
+    harness.print_report()
+    print()
+    print(harness.screen_text())
+
+    if args.screen is not None:
+        with open(args.screen, 'wb') as fh:
+            fh.write(harness.screen_dump())
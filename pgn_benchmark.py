@@ -0,0 +1,818 @@
+#!/usr/bin/env python3
+
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import random
+import resource
+import struct
+import sys
+import tempfile
+import time
+
+import pgn_to_pet
+
+
+#
+#  Benchmarks pgn_to_pet.py on synthetic PGN corpora.
+#
+#  The corpora are random but legal games, made reproducible by seeding each game's random number generator from the
+#  corpus seed and the game's number.  That also makes a smaller corpus the start of any bigger one with the same seed,
+#  so results for 1k games and 1M games describe the same kind of games.  Every corpus has FEN starts, comments,
+#  nested variations, NAGs and move annotations, and the games are steered towards promotions, en passant captures
+#  and castling so those code paths get a real workout.
+#
+#  Squares are numbered the same way as in pgn_to_pet.py - 0 is a8, 7 is h8, 56 is a1 and 63 is h1.
+#
+
+def build_steps(offsets):
+    steps = []
+    for sq in range(0, 64):
+        row, col = divmod(sq, 8)
+        targets = []
+        for drow, dcol in offsets:
+            if 0 <= row + drow < 8 and 0 <= col + dcol < 8:
+                targets.append((row + drow) * 8 + col + dcol)
+        steps.append(tuple(targets))
+    return steps
+
+
+def build_rays(directions):
+    rays = []
+    for sq in range(0, 64):
+        row, col = divmod(sq, 8)
+        sq_rays = []
+        for drow, dcol in directions:
+            ray = []
+            r = row + drow
+            c = col + dcol
+            while 0 <= r < 8 and 0 <= c < 8:
+                ray.append(r * 8 + c)
+                r += drow
+                c += dcol
+            if len(ray) > 0:
+                sq_rays.append(tuple(ray))
+        rays.append(tuple(sq_rays))
+    return rays
+
+
+KNIGHT_STEPS = build_steps(((-2, -1), (-2, 1), (2, -1), (2, 1), (-1, 2), (1, 2), (-1, -2), (1, -2)))
+KING_STEPS = build_steps(((-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)))
+ROOK_RAYS = build_rays(((-1, 0), (1, 0), (0, -1), (0, 1)))
+BISHOP_RAYS = build_rays(((-1, -1), (-1, 1), (1, -1), (1, 1)))
+QUEEN_RAYS = [ROOK_RAYS[sq] + BISHOP_RAYS[sq] for sq in range(0, 64)]
+SLIDER_RAYS = {'R': ROOK_RAYS, 'B': BISHOP_RAYS, 'Q': QUEEN_RAYS}
+
+START_FEN = 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1'
+
+# castling: the king's destination, the rook's start and destination, and the squares that must be empty
+CASTLES = {'K': (62, 63, 61, (61, 62)), 'Q': (58, 56, 59, (57, 58, 59)),
+           'k': (6, 7, 5, (5, 6)), 'q': (2, 0, 3, (1, 2, 3))}
+
+# the castling rights lost when a piece moves from or to these squares
+CASTLING_SQUARES = {60: 'KQ', 63: 'K', 56: 'Q', 4: 'kq', 7: 'k', 0: 'q'}
+
+COMMENTS = ('a good move', 'the only move', 'White is better here', 'a blunder? perhaps', 'threatening mate',
+            'Black must be careful here', 'see the notes', 'a novelty at the time', 'the critical position')
+MOVE_ANNOTATIONS = ('!', '?', '!?', '?!', '!!', '??')
+EVENTS = ('Synthetic Open', 'Corpus Cup', 'Bench Masters', 'Regression Rapid', '?')
+RESULTS = ('1-0', '0-1', '1/2-1/2', '*')
+
+
+def square_name(sq):
+    return 'abcdefgh'[sq % 8] + str(8 - sq // 8)
+
+
+class GamePosition:
+    #
+    #  Just enough of a chess position to play random legal games.  Pieces are FEN letters, upper case for white.
+    #  Moves are tuples of (source, destination, promotion piece or None, flag), where the flag is 'castle' or 'ep' for
+    #  the moves that touch a third square.
+    #
+    def __init__(self, fen=START_FEN):
+        fields = fen.split()
+        self.squares = [''] * 64
+        sq = 0
+        for ch in fields[0]:
+            if ch == '/':
+                continue
+            if ch.isdigit():
+                sq += int(ch)
+            else:
+                self.squares[sq] = ch
+                sq += 1
+        self.white_to_move = fields[1] == 'w'
+        self.castling = '' if fields[2] == '-' else fields[2]
+        self.ep_square = None if fields[3] == '-' else (8 - int(fields[3][1])) * 8 + ord(fields[3][0]) - 97
+        self.halfmove = int(fields[4])
+        self.fullmove = int(fields[5])
+        return
+
+    def fen(self):
+        rows = []
+        for row in range(0, 8):
+            text = ''
+            empty = 0
+            for piece in self.squares[row * 8:row * 8 + 8]:
+                if piece == '':
+                    empty += 1
+                    continue
+                if empty > 0:
+                    text += str(empty)
+                    empty = 0
+                text += piece
+            if empty > 0:
+                text += str(empty)
+            rows.append(text)
+        side = 'w' if self.white_to_move else 'b'
+        castling = self.castling or '-'
+        ep = '-' if self.ep_square is None else square_name(self.ep_square)
+        return f"{'/'.join(rows)} {side} {castling} {ep} {self.halfmove} {self.fullmove}"
+
+    def is_attacked(self, sq, by_white):
+        squares = self.squares
+        knight, king, pawn = ('N', 'K', 'P') if by_white else ('n', 'k', 'p')
+        for target in KNIGHT_STEPS[sq]:
+            if squares[target] == knight:
+                return True
+        for target in KING_STEPS[sq]:
+            if squares[target] == king:
+                return True
+
+        # a white pawn attacks upwards, so it sits on the row below the square it attacks
+        row, col = divmod(sq, 8)
+        pawn_row = row + 1 if by_white else row - 1
+        if 0 <= pawn_row < 8:
+            for pawn_col in (col - 1, col + 1):
+                if 0 <= pawn_col < 8 and squares[pawn_row * 8 + pawn_col] == pawn:
+                    return True
+
+        for rays, attackers in ((ROOK_RAYS, 'RQ'), (BISHOP_RAYS, 'BQ')):
+            if by_white is False:
+                attackers = attackers.lower()
+            for ray in rays[sq]:
+                for target in ray:
+                    piece = squares[target]
+                    if piece != '':
+                        if piece in attackers:
+                            return True
+                        break
+        return False
+
+    def king_square(self, white):
+        return self.squares.index('K' if white else 'k')
+
+    def in_check(self):
+        return self.is_attacked(self.king_square(self.white_to_move), not self.white_to_move)
+
+    def pseudo_moves(self):
+        squares = self.squares
+        white = self.white_to_move
+        moves = []
+        for src in range(0, 64):
+            piece = squares[src]
+            if piece == '' or piece.isupper() != white:
+                continue
+            kind = piece.upper()
+
+            if kind == 'P':
+                self.add_pawn_moves(src, moves)
+                continue
+
+            if kind == 'N' or kind == 'K':
+                for dst in (KNIGHT_STEPS if kind == 'N' else KING_STEPS)[src]:
+                    target = squares[dst]
+                    if target == '' or target.isupper() != white:
+                        moves.append((src, dst, None, None))
+                if kind == 'K':
+                    self.add_castling_moves(src, moves)
+                continue
+
+            for ray in SLIDER_RAYS[kind][src]:
+                for dst in ray:
+                    target = squares[dst]
+                    if target == '':
+                        moves.append((src, dst, None, None))
+                        continue
+                    if target.isupper() != white:
+                        moves.append((src, dst, None, None))
+                    break
+        return moves
+
+    def add_pawn_moves(self, src, moves):
+        squares = self.squares
+        white = self.white_to_move
+        row, col = divmod(src, 8)
+        step = -8 if white else 8
+        promotes = row == (1 if white else 6)
+        dst = src + step
+
+        targets = []
+        if squares[dst] == '':
+            targets.append((dst, None))
+            if row == (6 if white else 1) and squares[dst + step] == '':
+                targets.append((dst + step, None))
+        for dcol in (-1, 1):
+            if 0 <= col + dcol < 8:
+                target = squares[dst + dcol]
+                if target != '' and target.isupper() != white:
+                    targets.append((dst + dcol, None))
+                elif dst + dcol == self.ep_square:
+                    targets.append((dst + dcol, 'ep'))
+
+        for dst, flag in targets:
+            if promotes:
+                for promotion in ('Q', 'R', 'B', 'N'):
+                    moves.append((src, dst, promotion, None))
+            else:
+                moves.append((src, dst, None, flag))
+        return
+
+    def add_castling_moves(self, src, moves):
+        for right in (('K', 'Q') if self.white_to_move else ('k', 'q')):
+            if right not in self.castling:
+                continue
+            king_dst, rook_src, rook_dst, between = CASTLES[right]
+            if self.squares[rook_src] != ('R' if right.isupper() else 'r'):
+                continue
+            if any(self.squares[sq] != '' for sq in between):
+                continue
+            # the king can't castle out of, through or into check
+            by_white = not self.white_to_move
+            if any(self.is_attacked(sq, by_white) for sq in (src, rook_dst, king_dst)):
+                continue
+            moves.append((src, king_dst, None, 'castle'))
+        return
+
+    def make_move(self, move):
+        src, dst, promotion, flag = move
+        squares = self.squares
+        piece = squares[src]
+        undo = (squares[dst], self.castling, self.ep_square, self.halfmove, self.fullmove)
+
+        capture = squares[dst] != ''
+        squares[dst] = piece
+        squares[src] = ''
+        if flag == 'ep':
+            squares[dst + (8 if self.white_to_move else -8)] = ''
+            capture = True
+        elif flag == 'castle':
+            for king_dst, rook_src, rook_dst, between in CASTLES.values():
+                if king_dst == dst:
+                    squares[rook_dst] = squares[rook_src]
+                    squares[rook_src] = ''
+        if promotion is not None:
+            squares[dst] = promotion if self.white_to_move else promotion.lower()
+
+        self.ep_square = None
+        if piece in ('P', 'p') and abs(dst - src) == 16:
+            self.ep_square = (src + dst) // 2
+        for sq in (src, dst):
+            if sq in CASTLING_SQUARES:
+                self.castling = ''.join(x for x in self.castling if x not in CASTLING_SQUARES[sq])
+        self.halfmove = 0 if capture or piece in ('P', 'p') else self.halfmove + 1
+        if self.white_to_move is False:
+            self.fullmove += 1
+        self.white_to_move = not self.white_to_move
+        return undo
+
+    def unmake_move(self, move, undo):
+        src, dst, promotion, flag = move
+        squares = self.squares
+        self.white_to_move = not self.white_to_move
+        captured, self.castling, self.ep_square, self.halfmove, self.fullmove = undo
+
+        piece = squares[dst]
+        if promotion is not None:
+            piece = 'P' if self.white_to_move else 'p'
+        squares[src] = piece
+        squares[dst] = captured
+        if flag == 'ep':
+            squares[dst + (8 if self.white_to_move else -8)] = 'p' if self.white_to_move else 'P'
+        elif flag == 'castle':
+            for king_dst, rook_src, rook_dst, between in CASTLES.values():
+                if king_dst == dst:
+                    squares[rook_src] = squares[rook_dst]
+                    squares[rook_dst] = ''
+        return
+
+    def is_legal(self, move):
+        undo = self.make_move(move)
+        legal = not self.is_attacked(self.king_square(not self.white_to_move), self.white_to_move)
+        self.unmake_move(move, undo)
+        return legal
+
+    def has_legal_move(self):
+        return any(self.is_legal(move) for move in self.pseudo_moves())
+
+    def move_san(self, move, pseudo_moves):
+        src, dst, promotion, flag = move
+        piece = self.squares[src].upper()
+        if flag == 'castle':
+            return 'O-O' if dst % 8 == 6 else 'O-O-O'
+
+        capture = self.squares[dst] != '' or flag == 'ep'
+        if piece == 'P':
+            san = (square_name(src)[0] + 'x' if capture else '') + square_name(dst)
+            if promotion is not None:
+                san += '=' + promotion
+            return san
+
+        # other pieces of the same kind that could also legally go there need the move to say which one it is
+        others = [m[0] for m in pseudo_moves if m[1] == dst and m[0] != src and
+                  self.squares[m[0]] == self.squares[src] and self.is_legal(m)]
+        which = ''
+        if len(others) > 0:
+            if all(other % 8 != src % 8 for other in others):
+                which = square_name(src)[0]
+            elif all(other // 8 != src // 8 for other in others):
+                which = square_name(src)[1]
+            else:
+                which = square_name(src)
+        return piece + which + ('x' if capture else '') + square_name(dst)
+
+    def random_legal_move(self, rng, pseudo_moves):
+        #
+        #  Picks a random legal move, or returns None when there isn't one.  Moves that make for interesting encoding -
+        #  castling, en passant, promotions and pawn moves in general - are picked more often than their share.
+        #
+        special = [m for m in pseudo_moves if m[3] is not None or m[2] is not None]
+        rng.shuffle(special)
+        for move in special:
+            if rng.random() < 0.7 and self.is_legal(move):
+                return move
+
+        if rng.random() < 0.3:
+            pawns = [m for m in pseudo_moves if self.squares[m[0]] in ('P', 'p')]
+            rng.shuffle(pawns)
+            for move in pawns:
+                if self.is_legal(move):
+                    return move
+
+        candidates = list(pseudo_moves)
+        rng.shuffle(candidates)
+        for move in candidates:
+            if self.is_legal(move):
+                return move
+        return None
+
+
+class CorpusGenerator:
+    def __init__(self, seed=1, fen_rate=0.1, annotation_rate=0.04, variation_rate=0.03, max_plies=200):
+        self.seed = seed
+        self.fen_rate = fen_rate
+        self.annotation_rate = annotation_rate
+        self.variation_rate = variation_rate
+        self.max_plies = max_plies
+        return
+
+    def game_rng(self, game_num):
+        # every game has its own generator, so any game can be made on its own and in any order
+        return random.Random(self.seed * 1000003 + game_num)
+
+    def random_line(self, position, rng, plies):
+        #
+        #  Plays a few random moves from position and takes them back again.  Returns them as (white to move, move
+        #  number, SAN) tuples, for use as a variation.
+        #
+        line = []
+        played = []
+        for ply in range(0, plies):
+            pseudo_moves = position.pseudo_moves()
+            move = position.random_legal_move(rng, pseudo_moves)
+            if move is None:
+                break
+            line.append((position.white_to_move, position.fullmove, position.move_san(move, pseudo_moves)))
+            played.append((move, position.make_move(move)))
+        for move, undo in reversed(played):
+            position.unmake_move(move, undo)
+        return line
+
+    def line_tokens(self, line):
+        tokens = []
+        for i, (white, move_num, san) in enumerate(line):
+            if white:
+                tokens.append(f"{move_num}.")
+            elif i == 0:
+                tokens.append(f"{move_num}...")
+            tokens.append(san)
+        return tokens
+
+    def variation_tokens(self, position, rng):
+        # the variation is an alternative to the move that was just played, so it's played from the position before it
+        tokens = self.line_tokens(self.random_line(position, rng, rng.randint(1, 8)))
+        if len(tokens) < 2:
+            return []
+
+        # sometimes with a variation of its own, as an alternative to the variation's first move
+        if rng.random() < 0.3:
+            nested = self.line_tokens(self.random_line(position, rng, rng.randint(1, 4)))
+            if len(nested) >= 2:
+                tokens = tokens[:2] + ['('] + nested + [')'] + tokens[2:]
+        return ['('] + tokens + [')']
+
+    def game_text(self, game_num):
+        rng = self.game_rng(game_num)
+        position = GamePosition()
+
+        # a FEN start is just a few random moves into a game, stopping short of any that would end it
+        fen = None
+        if rng.random() < self.fen_rate:
+            for ply in range(0, rng.randint(4, 40)):
+                move = position.random_legal_move(rng, position.pseudo_moves())
+                undo = position.make_move(move)
+                if position.has_legal_move() is False:
+                    position.unmake_move(move, undo)
+                    break
+            fen = position.fen()
+
+        tokens = []
+        result = None
+        need_move_num = True
+        last_san = None
+        for ply in range(0, rng.randint(10, self.max_plies)):
+            pseudo_moves = position.pseudo_moves()
+            move = position.random_legal_move(rng, pseudo_moves)
+            if move is None:
+                if position.in_check():
+                    tokens[last_san] = tokens[last_san].replace('+', '#')
+                    result = '0-1' if position.white_to_move else '1-0'
+                else:
+                    result = '1/2-1/2'
+                break
+
+            if position.white_to_move:
+                tokens.append(f"{position.fullmove}.")
+            elif need_move_num:
+                tokens.append(f"{position.fullmove}...")
+            need_move_num = False
+
+            san = position.move_san(move, pseudo_moves)
+            variation = []
+            if rng.random() < self.variation_rate:
+                variation = self.variation_tokens(position, rng)
+            position.make_move(move)
+            if position.in_check():
+                san += '+'
+            if rng.random() < self.annotation_rate:
+                san += rng.choice(MOVE_ANNOTATIONS)
+            last_san = len(tokens)
+            tokens.append(san)
+
+            if rng.random() < self.annotation_rate:
+                tokens.append(f"${rng.randint(1, 139)}")
+            if rng.random() < self.annotation_rate:
+                tokens.append('{' + rng.choice(COMMENTS) + '}')
+                need_move_num = True
+            if len(variation) > 0:
+                tokens += variation
+                need_move_num = True
+
+        if result is None:
+            result = rng.choice(RESULTS)
+        tokens.append(result)
+
+        date = '????.??.??'
+        if rng.random() < 0.8:
+            date = f"{rng.randint(1950, 2024)}.{rng.randint(1, 12):02}.{rng.randint(1, 28):02}"
+        tags = [('Event', rng.choice(EVENTS)), ('Site', 'Nowhere'), ('Date', date), ('Round', str(game_num + 1)),
+                ('White', f"Player {rng.randint(1, 5000)}"), ('Black', f"Player {rng.randint(1, 5000)}"),
+                ('Result', result)]
+        if fen is not None:
+            tags += [('SetUp', '1'), ('FEN', fen)]
+
+        lines = [f'[{tag} "{value}"]' for tag, value in tags]
+        lines.append('')
+        line = ''
+        for token in tokens:
+            if len(line) + len(token) + 1 > 79:
+                lines.append(line)
+                line = token
+            else:
+                line = f"{line} {token}" if line else token
+        lines.append(line)
+        lines.append('')
+        return '\n'.join(lines) + '\n'
+
+    def games_text(self, first_game, num_games):
+        return ''.join(self.game_text(game_num) for game_num in range(first_game, first_game + num_games))
+
+    def write_corpus(self, filename, num_games, jobs=1, chunk_size=256):
+        chunks = [(first, min(chunk_size, num_games - first)) for first in range(0, num_games, chunk_size)]
+        with open(filename + '.tmp', 'w') as fh:
+            if jobs > 1:
+                with multiprocessing.Pool(jobs) as pool:
+                    for text in pool.imap(self.games_text_for_chunk, chunks):
+                        fh.write(text)
+            else:
+                for chunk in chunks:
+                    fh.write(self.games_text_for_chunk(chunk))
+
+        # only a complete corpus ever has the real name, so an interrupted run doesn't leave a short one behind
+        os.replace(filename + '.tmp', filename)
+        return
+
+    def games_text_for_chunk(self, chunk):
+        first_game, num_games = chunk
+        return self.games_text(first_game, num_games)
+
+
+#
+#  The stages of a conversion, each timed on its own.  Reading splits the PGN file into games, the next few are the
+#  PgnToPet methods that encode_game calls for every game (the generate_ methods are lumped together), and the two
+#  data file builds run once at the end.  Scanning is PgnOffsetIndex finding where each game starts, which the game
+#  index uses instead of reading, and isn't part of the total.
+#
+GAME_STAGES = (('metadata', ('parse_pgn_file_for_metadata',)),
+               ('fen', ('populate_board', 'board_to_draw_commands')),
+               ('tokens', ('parse_pgn_file_for_moves_tokens', 'create_pgn_moves_struct')),
+               ('board', ('add_board_movements',)),
+               ('generate', ('generate_metadata_outputs', 'generate_fen_draw_outputs', 'generate_first_move_data',
+                             'generate_pause', 'generate_moves_data', 'generate_eog')))
+STAGE_NAMES = ['scan', 'read'] + [name for name, methods in GAME_STAGES] + ['datafile', 'compress', 'total']
+
+
+def peak_rss_kb():
+    # ru_maxrss is in kilobytes on Linux but bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak //= 1024
+    return peak
+
+
+class StageTimer:
+    #
+    #  Accumulates the wall time spent in each stage, and how far the process's peak RSS rose while it ran.  The peak
+    #  only ever goes up, so the growth shows which stages are the ones holding on to memory.
+    #
+    #  A stage's methods can call each other (generate_moves_data calls generate_pause), so only the outermost call
+    #  into a stage is timed.
+    #
+    def __init__(self):
+        self.seconds = {name: 0.0 for name in STAGE_NAMES}
+        self.rss_growth_kb = {name: 0 for name in STAGE_NAMES}
+        self.peak_rss_kb = {name: 0 for name in STAGE_NAMES}
+        self.active = set()
+        return
+
+    def wrap(self, stage, method):
+        def timed(*args, **kwargs):
+            if stage in self.active:
+                return method(*args, **kwargs)
+            self.active.add(stage)
+            rss_before = peak_rss_kb()
+            start = time.perf_counter()
+            result = method(*args, **kwargs)
+            self.seconds[stage] += time.perf_counter() - start
+            self.note_rss(stage, rss_before)
+            self.active.discard(stage)
+            return result
+        return timed
+
+    def note_rss(self, stage, rss_before):
+        rss_after = peak_rss_kb()
+        self.rss_growth_kb[stage] += rss_after - rss_before
+        self.peak_rss_kb[stage] = max(self.peak_rss_kb[stage], rss_after)
+        return
+
+    def timed_games(self, games):
+        # the reading stage is a generator, so it's timed a game at a time as the games are pulled from it
+        while True:
+            rss_before = peak_rss_kb()
+            start = time.perf_counter()
+            game_block = next(games, None)
+            self.seconds['read'] += time.perf_counter() - start
+            self.note_rss('read', rss_before)
+            if game_block is None:
+                break
+            yield game_block
+        return
+
+
+def run_benchmark(corpus_filename):
+    #
+    #  Converts the corpus the way pgn_to_pet.py does, with each stage's methods wrapped in timers.  Returns the
+    #  results as a dictionary of stage name to its measurements.
+    #
+    timer = StageTimer()
+    ptp = pgn_to_pet.PgnToPet()
+    for stage, methods in GAME_STAGES:
+        for method in methods:
+            setattr(ptp, method, timer.wrap(stage, getattr(ptp, method)))
+
+    corpus_bytes = os.path.getsize(corpus_filename)
+    totals = {'games': 0, 'bytes': 0, 'seconds': 0.0}
+    sizes = {}
+    start = time.perf_counter()
+    with tempfile.TemporaryDirectory() as tmpdir, tempfile.TemporaryFile(dir=tmpdir) as spill:
+        # the games are encoded as the plain file is written, and the compressed file is written from the spill
+        for stage, compress in (('datafile', False), ('compress', True)):
+            if compress is True:
+                spill.seek(0)
+                segments = ptp.read_spilled_segments(spill)
+            else:
+                segments = encoded_corpus(ptp, timer, corpus_filename, spill, totals)
+
+            # the time spent reading, encoding and spilling the games isn't charged to the data file
+            encode_seconds = totals['seconds']
+            rss_before = peak_rss_kb()
+            stage_start = time.perf_counter()
+            sizes[stage] = ptp.write_pet_datafile(os.path.join(tmpdir, 'chessdata'), compress=compress,
+                                                  segments=segments)
+            timer.seconds[stage] += time.perf_counter() - stage_start - (totals['seconds'] - encode_seconds)
+            timer.note_rss(stage, rss_before)
+    timer.seconds['total'] = time.perf_counter() - start
+    timer.peak_rss_kb['total'] = peak_rss_kb()
+
+    # the EOF token is added by write_pet_datafile, the same as it is for pgn_to_pet.py
+    sizes['generate'] = totals['bytes'] + 1
+
+    rss_before = peak_rss_kb()
+    stage_start = time.perf_counter()
+    with pgn_to_pet.PgnOffsetIndex(corpus_filename) as offsets:
+        timer.seconds['scan'] = time.perf_counter() - stage_start
+        timer.note_rss('scan', rss_before)
+        game_num = first_split_difference(ptp, corpus_filename, offsets)
+    if game_num is not None:
+        raise Exception(f"PgnOffsetIndex splits {corpus_filename} differently from read_pgn_games at game {game_num}")
+
+    num_games = totals['games']
+    results = {}
+    for stage in STAGE_NAMES:
+        seconds = timer.seconds[stage]
+        results[stage] = {
+            'seconds': seconds,
+            'games_per_sec': num_games / seconds if seconds > 0 else None,
+            'bytes_per_sec': corpus_bytes / seconds if seconds > 0 else None,
+            'peak_rss_kb': timer.peak_rss_kb[stage],
+            'rss_growth_kb': timer.rss_growth_kb[stage],
+            'bytes_per_game': sizes[stage] / num_games if stage in sizes and num_games > 0 else None,
+        }
+    return {'games': num_games, 'corpus_bytes': corpus_bytes, 'stages': results}
+
+
+def encoded_corpus(ptp, timer, corpus_filename, spill, totals):
+    #
+    #  Generator for the encoded games of the corpus, read and encoded a game at a time the same as pgn_to_pet.py
+    #  does, so the benchmark never holds more than one game.  Each one is also spilled the way write_pet_datafile
+    #  spills them, for the compressed file to be written from without encoding the games again.  The time spent
+    #  in here between games goes in totals, so it isn't charged to the data file.
+    #
+    with open(corpus_filename, 'r') as fh:
+        games = timer.timed_games(ptp.read_pgn_games(fh))
+        while True:
+            resume_time = time.perf_counter()
+            game_block = next(games, None)
+            if game_block is None:
+                totals['seconds'] += time.perf_counter() - resume_time
+                break
+            segment = ptp.encode_game(game_block)
+            spill.write(struct.pack('<I', len(segment)))
+            spill.write(segment)
+            totals['games'] += 1
+            totals['bytes'] += len(segment)
+            totals['seconds'] += time.perf_counter() - resume_time
+            yield segment
+    return
+
+
+def first_split_difference(ptp, corpus_filename, offsets):
+    #
+    #  Checks that each game the offset index finds is the same as the next game read_pgn_games reads from the whole
+    #  file.  Returns the number of the first game that isn't, or None if they all are.
+    #
+    with open(corpus_filename, 'r') as fh:
+        games = ptp.read_pgn_games(fh)
+        for game_num in range(0, len(offsets)):
+            text = offsets.game_text(game_num).decode('utf-8', errors='replace')
+            if list(ptp.read_pgn_games(io.StringIO(text, newline=None))) != [next(games, None)]:
+                return game_num
+        if next(games, None) is not None:
+            return len(offsets)
+    return None
+
+
+def format_rate(value, unit=''):
+    if value is None:
+        return '-'
+    for limit, suffix in ((1e9, 'G'), (1e6, 'M'), (1e3, 'k')):
+        if value >= limit:
+            return f"{value / limit:.1f}{suffix}{unit}"
+    return f"{value:.1f}{unit}"
+
+
+def print_results(label, run):
+    print(f"{label}: {run['games']} games, {run['corpus_bytes']} bytes of PGN")
+    print(f"  {'stage':<10}{'seconds':>10}{'games/s':>10}{'bytes/s':>10}{'peak RSS':>10}{'RSS +':>10}"
+          f"{'bytes/game':>12}")
+    for stage in STAGE_NAMES:
+        result = run['stages'][stage]
+        bytes_per_game = '-' if result['bytes_per_game'] is None else f"{result['bytes_per_game']:.1f}"
+        print(f"  {stage:<10}{result['seconds']:>10.3f}{format_rate(result['games_per_sec']):>10}"
+              f"{format_rate(result['bytes_per_sec'], 'B'):>10}{result['peak_rss_kb'] / 1024:>8.1f}MB"
+              f"{result['rss_growth_kb'] / 1024:>8.1f}MB{bytes_per_game:>12}")
+    return
+
+
+def compare_to_baseline(label, run, baseline, tolerance):
+    #
+    #  Compares a run with the baseline run for the same corpus.  A stage is a regression when it converts games more
+    #  slowly, or encodes them into more bytes, by more than the tolerance.  Returns the list of regressions.
+    #
+    regressions = []
+    print(f"{label}: compared with the baseline")
+    for stage in STAGE_NAMES:
+        result = run['stages'][stage]
+        base = baseline['stages'].get(stage)
+        if base is None:
+            continue
+
+        notes = []
+        if result['games_per_sec'] and base['games_per_sec']:
+            change = result['games_per_sec'] / base['games_per_sec'] - 1
+            notes.append(f"speed {change:+.1%}")
+            if change < -tolerance:
+                regressions.append(f"{label} {stage}: {-change:.1%} slower")
+        if result['bytes_per_game'] is not None and base['bytes_per_game']:
+            change = result['bytes_per_game'] / base['bytes_per_game'] - 1
+            notes.append(f"bytes/game {change:+.1%}")
+            if change > tolerance:
+                regressions.append(f"{label} {stage}: {change:.1%} more bytes per game")
+        print(f"  {stage:<10}{', '.join(notes)}")
+    return regressions
+
+
+def corpus_filename(corpus_dir, num_games, seed):
+    return os.path.join(corpus_dir, f"synthetic_{num_games}_{seed}.pgn")
+
+
+if __name__ == '__main__':
+    helptext = """
+Benchmarks pgn_to_pet.py on synthetic PGN corpora.
+
+Each corpus is made of random legal games, with FEN starts, comments, nested
+variations, NAGs, promotions, en passant and castling.  A corpus is the same
+every time for the same number of games and seed, and it's kept in the corpus
+directory so it only has to be generated once.  The conversion is timed stage
+by stage and can be compared against a baseline saved by an earlier run.
+"""
+    argp = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=helptext)
+    argp.add_argument('-g', '--games', type=int, nargs='+', default=[1000],
+                      help='Number of games in each corpus to benchmark (default: 1000)')
+    argp.add_argument('--seed', type=int, default=1, help='Seed for the random games (default: 1)')
+    argp.add_argument('--corpus-dir', metavar='DIR', default='benchcorpus',
+                      help='Where the generated corpora are kept (default: benchcorpus)')
+    argp.add_argument('-j', '--jobs', type=int, default=1,
+                      help='Number of worker processes used to generate a corpus (default: 1). The benchmark itself '
+                           'always runs in one process.')
+    argp.add_argument('--baseline', metavar='FILE',
+                      help='Compare the results with the ones saved in this file, and exit with status 1 if any stage '
+                           'has regressed')
+    argp.add_argument('--save-baseline', metavar='FILE', help='Save the results to this file, to use as a baseline')
+    argp.add_argument('--tolerance', type=float, default=0.1,
+                      help='How much worse than the baseline a stage can get before it counts as a regression '
+                           '(default: 0.1, i.e. 10%%)')
+    args = argp.parse_args()
+
+    os.makedirs(args.corpus_dir, exist_ok=True)
+    generator = CorpusGenerator(seed=args.seed)
+
+    baseline = {}
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as fh:
+            baseline = json.load(fh)
+
+    runs = {}
+    regressions = []
+    for num_games in args.games:
+        filename = corpus_filename(args.corpus_dir, num_games, args.seed)
+        if os.path.exists(filename) is False:
+            print(f"generating {filename}")
+            generator.write_corpus(filename, num_games, jobs=args.jobs)
+
+        label = f"{num_games} games, seed {args.seed}"
+        runs[label] = run_benchmark(filename)
+        print_results(label, runs[label])
+        if label in baseline:
+            regressions += compare_to_baseline(label, runs[label], baseline[label], args.tolerance)
+        elif args.baseline is not None:
+            print(f"{label}: not in the baseline")
+
+    if args.save_baseline is not None:
+        # runs for corpora this time around replace their old results, the others are kept
+        saved = {}
+        if os.path.exists(args.save_baseline):
+            with open(args.save_baseline, 'r') as fh:
+                saved = json.load(fh)
+        saved.update(runs)
+        with open(args.save_baseline, 'w') as fh:
+            json.dump(saved, fh, indent=2, sort_keys=True)
+        print(f"saved the results to {args.save_baseline}")
+
+    if len(regressions) > 0:
+        print('regressions:')
+        for regression in regressions:
+            print(f"  {regression}")
+        sys.exit(1)
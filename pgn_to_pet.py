@@ -1,79 +1,1968 @@
 #!/usr/bin/env python3
 
 import argparse
+import array
+import bz2
+import collections
+import cProfile
+import gzip
+import hashlib
+import heapq
+import io
+import itertools
+import lzma
+import mmap
+import multiprocessing
+import os
+import pstats
+import re
+import sqlite3
 import struct
+import sys
+import tempfile
+import time
+
+import d64image
+
+#
+#  Precomputed attack tables used to work out which piece a move came from.  Squares are numbered the same way as in
+#  the output stream - 0 is a8, 7 is h8, 56 is a1 and 63 is h1 - and bit N of a bitboard is square N.
+#
+
+def build_leaper_attacks(offsets):
+    attacks = []
+    for sq in range(0, 64):
+        row, col = divmod(sq, 8)
+        mask = 0
+        for row_offset, col_offset in offsets:
+            to_row = row + row_offset
+            to_col = col + col_offset
+            if 0 <= to_row < 8 and 0 <= to_col < 8:
+                mask |= 1 << (to_row * 8 + to_col)
+        attacks.append(mask)
+    return attacks
+
+
+def slide_attacks(sq, directions, occupied):
+    # walk each ray out from the square, stopping at (and including) the first occupied square
+    row, col = divmod(sq, 8)
+    mask = 0
+    for row_offset, col_offset in directions:
+        to_row = row + row_offset
+        to_col = col + col_offset
+        while 0 <= to_row < 8 and 0 <= to_col < 8:
+            bit = 1 << (to_row * 8 + to_col)
+            mask |= bit
+            if occupied & bit:
+                break
+            to_row += row_offset
+            to_col += col_offset
+    return mask
+
+
+def build_line_attacks(directions):
+    #
+    #  For one line through each square (a rank, a file or a diagonal) build a lookup of the squares a sliding piece
+    #  attacks, indexed by the occupancy of that line.  The square at the far end of each ray can never block
+    #  anything beyond it, so it is left out of the occupancy mask - that keeps each table at no more than 64 entries.
+    #
+    masks = []
+    tables = []
+    for sq in range(0, 64):
+        row, col = divmod(sq, 8)
+        mask = 0
+        for row_offset, col_offset in directions:
+            to_row = row + row_offset
+            to_col = col + col_offset
+            while 0 <= to_row + row_offset < 8 and 0 <= to_col + col_offset < 8:
+                mask |= 1 << (to_row * 8 + to_col)
+                to_row += row_offset
+                to_col += col_offset
+
+        # enumerate every subset of the mask
+        table = {}
+        occupied = 0
+        while True:
+            table[occupied] = slide_attacks(sq, directions, occupied)
+            occupied = (occupied - mask) & mask
+            if occupied == 0:
+                break
+        masks.append(mask)
+        tables.append(table)
+    return (masks, tables)
+
+
+KNIGHT_ATTACKS = build_leaper_attacks(((-2, -1), (-2, 1), (2, -1), (2, 1), (-1, 2), (1, 2), (-1, -2), (1, -2)))
+KING_ATTACKS = build_leaper_attacks(((-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)))
+# the squares a white (or black) pawn would have to be on to attack each square
+WHITE_PAWN_ATTACKERS = build_leaper_attacks(((1, -1), (1, 1)))
+BLACK_PAWN_ATTACKERS = build_leaper_attacks(((-1, -1), (-1, 1)))
+ROOK_LINES = (build_line_attacks(((0, 1), (0, -1))), build_line_attacks(((1, 0), (-1, 0))))
+BISHOP_LINES = (build_line_attacks(((1, 1), (-1, -1))), build_line_attacks(((1, -1), (-1, 1))))
+ROW_MASKS = [0xFF << (row * 8) for row in range(0, 8)]
+COL_MASKS = [0x0101010101010101 << col for col in range(0, 8)]
+
+
+def rook_attacks(sq, occupied):
+    attacks = 0
+    for masks, tables in ROOK_LINES:
+        attacks |= tables[sq][occupied & masks[sq]]
+    return attacks
+
+
+def bishop_attacks(sq, occupied):
+    attacks = 0
+    for masks, tables in BISHOP_LINES:
+        attacks |= tables[sq][occupied & masks[sq]]
+    return attacks
+
+
+def lowest_square(bitboard):
+    return (bitboard & -bitboard).bit_length() - 1
+
+
+#
+#  An indexed chessdata file has a table of where each game starts, and how long it is, appended after the EOF token.
+#  The replayer stops reading at EOF so it never sees any of this.  The file ends with a fixed size footer:
+#
+#      magic 'CRIX', version (2 bytes), flags (2 bytes), game count (4 bytes), offset of the table (4 bytes)
+#
+#  and the table has an offset (4 bytes) and length (4 bytes) for each game's record.  The flags are the same as the
+#  ones at the start of the file.  Everything is little-endian.
+#
+INDEX_MAGIC = b'CRIX'
+INDEX_VERSION = 1
+INDEX_FOOTER = struct.Struct('<4sHHII')
+INDEX_ENTRY = struct.Struct('<II')
+
+#
+#  A chessdata file starts with DATA_MARKER and a flags byte.  Then each game is a record: a 2 byte length
+#  (little-endian) followed by that many bytes of the game's stream, so the replayer can load a game with a counted
+#  read and knows up front whether it will fit.  The EOF token gets a record of its own after the last game.
+#
+#  In a compressed file (DATA_FLAG_COMPRESSED) the flags are followed by the number of Huffman trees and the trees
+#  themselves, and the records hold Huffman code, padded out to a whole byte.  Every byte of the stream is coded with
+#  the tree for the context it's read in - the replayer always knows what sort of byte comes next (a token, a square,
+#  a piece, a letter of move text...), so each sort gets a code of its own.
+#
+#  Each tree is its number of internal nodes N, then N pairs of left and right children, then the N + 1 symbols at
+#  its leaves.  A child below $80 is the internal node with that number, $80 + n is leaf n.  Leaf 0 is the escape
+#  code, which is followed by the 8 bits of a byte the tree has no code for.
+#
+#  The context numbers and table size limit have to match the CTX definitions and HUFFTABLESIZE in chessreplay.asm.
+#
+#  A file with opening blocks (DATA_FLAG_OPENINGS) has a table of them next, after any trees: its length (2 bytes,
+#  little-endian) and then the table, which the replayer loads into memory as it is.  The table starts with a 2 byte
+#  offset for each block, from the start of the table, and then the blocks.  A block is the stream of the first few
+#  moves of a game from the standard start position, ending with an EO token.  A game that opens that way has an OP
+#  token and the block number in place of those moves, and the replayer plays them from the block - see OpeningTrie.
+#  The table is never Huffman coded, and the byte after the block number is read in CONTEXT_CMD.
+#
+DATA_MARKER = 0xFF
+DATA_FLAG_COMPRESSED = 1
+DATA_FLAG_OPENINGS = 2
+OPENING_MAX_BLOCKS = 128
+OPENING_MAX_PLIES = 30
+OPENING_MAX_NODES = 1 << 20
+CONTEXT_CMD, CONTEXT_AFTER_MOVE, CONTEXT_AFTER_PG, CONTEXT_SQUARE, CONTEXT_PIECE = range(0, 5)
+CONTEXT_MOVE_TEXT, CONTEXT_MOVE_TEXT_LAST = 5, 8
+CONTEXT_TEXT = 9
+NUM_CONTEXTS = 10
+HUFFMAN_TABLE_LIMIT = 2048
+
+#
+#  PGN files compressed with any of these are recognised by their first few bytes and decompressed as they're read.
+#
+COMPRESSED_PGN_FORMATS = ((b'\x1f\x8b', gzip), (b'BZh', bz2), (b'\xfd7zXZ\x00', lzma))
+
+#
+#  A game can only end at blank lines, so PgnOffsetIndex looks for those with BLANK_LINES and then checks whether the
+#  game in front has ended there.  Once whole {...} comments are taken out of the game's movetext, its variations can
+#  be checked by deleting everything but their brackets (NOT_BRACKETS) and then the brackets that pair up
+#  (BRACKET_PAIRS).  The offsets of the games can be saved next to a PGN file, in a file named after it with
+#  OFFSETS_SUFFIX on the end: a fixed size header
+#
+#      magic 'PGNX', version (2 bytes), PGN file size (8 bytes), modification time in ns (8 bytes), game count (4 bytes)
+#
+#  followed by an 8 byte offset for each game.  Everything is little-endian.
+#
+BLANK_LINES = re.compile(rb'\n(?:[ \t\r\f\v]*\n)+')
+NON_BLANK = re.compile(rb'\S')
+WHOLE_COMMENTS = re.compile(rb'\{[^}]*\}')
+NOT_BRACKETS = bytes(byte for byte in range(0, 256) if byte not in b'()[]}')
+BRACKET_PAIRS = re.compile(rb'[(\[][)\]}]')
+HARD_MOVETEXT = re.compile(rb'[{;%]')
+MOVETEXT_BRACKETS = re.compile(rb'[\[\]{}();]')
+OFFSETS_MAGIC = b'PGNX'
+OFFSETS_VERSION = 2
+OFFSETS_HEADER = struct.Struct('<4sHQQI')
+OFFSETS_SUFFIX = '.offsets'
+
+#
+#  Movetext is tokenized a whole game at a time with these, rather than a character at a time.  Comments ({...} and
+#  ; to the end of the line), stray tags and NAGs are blanked out first, then variations from the innermost outward,
+#  and what's left splits on whitespace into moves (with any move number stuck to the front split off) and results.
+#  Lines starting with % are escaped and never get this far.
+#
+MOVETEXT_COMMENTS = re.compile(r'\{[^}]*\}?|;[^\n]*|\[[^\]]*\]?|\$\d*')
+MOVETEXT_VARIATION = re.compile(r'\([^()]*\)')
+MOVETEXT_WORD = re.compile(r'(\d+\.+(?=[^\s.]))?(\S+)')
+MOVETEXT_RESULT = re.compile(r'[-01½/2*]+')
+
+#
+#  For --stats, what's blanked out of the movetext is left behind as one of these markers instead of a space, so it
+#  can be counted once the variations are gone - anything inside a variation goes along with it.  They're all
+#  whitespace as far as MOVETEXT_WORD is concerned, so the tokens come out the same.  MOVETEXT_ANY_WORD splits the
+#  movetext into the tokens that were there to start with, comments and all.
+#
+MARKER_COMMENT, MARKER_NAG, MARKER_TAG, MARKER_VARIATION = '\x1c', '\x1d', '\x1e', '\x1f'
+MOVETEXT_MARKERS = {'{': f" {MARKER_COMMENT} ", ';': f" {MARKER_COMMENT} ", '$': f" {MARKER_NAG} ",
+                    '[': f" {MARKER_TAG} "}
+MOVETEXT_ANY_WORD = re.compile(r'\$[^\s{}();$]*|[^\s{}();$]+')
+BRACKETS = re.compile(r'[\[\]{}();]')
+
+# piece codes as they appear in the output stream, black pieces are 101-106 and white pieces are 6 higher
+PIECE_CODES = {'r': 101, 'n': 102, 'b': 103, 'q': 104, 'k': 105, 'p': 106,
+               'R': 107, 'N': 108, 'B': 109, 'Q': 110, 'K': 111, 'P': 112}
+PIECE_LETTERS = {code: letter for letter, code in PIECE_CODES.items()}
+BLACK_ROOK, BLACK_KNIGHT, BLACK_BISHOP, BLACK_QUEEN, BLACK_KING, BLACK_PAWN = range(101, 107)
+WHITE_ROOK, WHITE_KNIGHT, WHITE_BISHOP, WHITE_QUEEN, WHITE_KING, WHITE_PAWN = range(107, 113)
+BLANK_SQUARE = 113
+
+
+class Board:
+    #
+    #  A chess board as a 64 byte array of piece codes, one per square (0 for an empty square), along with one
+    #  bitboard per piece code and a bitboard of every occupied square.  The bitboards are kept in step with the
+    #  squares as moves are made, and are used to resolve source squares.
+    #
+    __slots__ = ('squares', 'pieces', 'occupied')
+
+    def __init__(self):
+        self.squares = bytearray(64)
+        self.pieces = [0] * BLANK_SQUARE
+        self.occupied = 0
+        return
+
+    def clear_square(self, sq):
+        piece = self.squares[sq]
+        if piece != 0:
+            bit = 1 << sq
+            self.pieces[piece] ^= bit
+            self.occupied ^= bit
+            self.squares[sq] = 0
+        return
+
+    def set_piece(self, sq, piece):
+        self.clear_square(sq)
+        bit = 1 << sq
+        self.pieces[piece] |= bit
+        self.occupied |= bit
+        self.squares[sq] = piece
+        return
+
+    def move_piece(self, src, dst):
+        squares = self.squares
+        piece = squares[src]
+        captured = squares[dst]
+        src_bit = 1 << src
+        dst_bit = 1 << dst
+        if captured != 0:
+            self.pieces[captured] ^= dst_bit
+        self.pieces[piece] ^= src_bit | dst_bit
+        self.occupied = (self.occupied ^ src_bit) | dst_bit
+        squares[src] = 0
+        squares[dst] = piece
+        return
+
+    def attackers_of(self, sq, piece):
+        # every piece with this code that could move to sq, ignoring pins
+        kind = piece if piece < WHITE_ROOK else piece - 6
+        if kind == BLACK_KNIGHT:
+            attacks = KNIGHT_ATTACKS[sq]
+        elif kind == BLACK_KING:
+            attacks = KING_ATTACKS[sq]
+        elif kind == BLACK_ROOK:
+            attacks = rook_attacks(sq, self.occupied)
+        elif kind == BLACK_BISHOP:
+            attacks = bishop_attacks(sq, self.occupied)
+        else:
+            attacks = rook_attacks(sq, self.occupied) | bishop_attacks(sq, self.occupied)
+        return attacks & self.pieces[piece]
+
+    def is_attacked(self, sq, by_white):
+        pieces = self.pieces
+        occupied = self.occupied
+        if by_white:
+            pawns = pieces[WHITE_PAWN] & WHITE_PAWN_ATTACKERS[sq]
+            offset = 6
+        else:
+            pawns = pieces[BLACK_PAWN] & BLACK_PAWN_ATTACKERS[sq]
+            offset = 0
+        queens = pieces[BLACK_QUEEN + offset]
+        return (pawns != 0 or (KNIGHT_ATTACKS[sq] & pieces[BLACK_KNIGHT + offset]) != 0
+                or (KING_ATTACKS[sq] & pieces[BLACK_KING + offset]) != 0
+                or (rook_attacks(sq, occupied) & (pieces[BLACK_ROOK + offset] | queens)) != 0
+                or (bishop_attacks(sq, occupied) & (pieces[BLACK_BISHOP + offset] | queens)) != 0)
+
+    def is_pinned(self, src, dst, piece):
+        # would moving this piece from src to dst open a line from an enemy rook, bishop or queen to its own king?
+        pieces = self.pieces
+        if piece >= WHITE_ROOK:
+            king = pieces[WHITE_KING]
+            enemy_straight = pieces[BLACK_ROOK] | pieces[BLACK_QUEEN]
+            enemy_diagonal = pieces[BLACK_BISHOP] | pieces[BLACK_QUEEN]
+        else:
+            king = pieces[BLACK_KING]
+            enemy_straight = pieces[WHITE_ROOK] | pieces[WHITE_QUEEN]
+            enemy_diagonal = pieces[WHITE_BISHOP] | pieces[WHITE_QUEEN]
+        if king == 0:
+            return False
+
+        king_sq = lowest_square(king)
+        dst_bit = 1 << dst
+        occupied = (self.occupied & ~(1 << src)) | dst_bit
+
+        # an enemy piece captured on dst can't be giving check
+        if rook_attacks(king_sq, occupied) & enemy_straight & ~dst_bit:
+            return True
+        if bishop_attacks(king_sq, occupied) & enemy_diagonal & ~dst_bit:
+            return True
+        return False
+
+    def find_source_square(self, piece, dst, src_row=None, src_col=None):
+        candidates = self.attackers_of(dst, piece)
+
+        # any rank or file given in the move text narrows things down
+        if src_row is not None:
+            candidates &= ROW_MASKS[src_row]
+        if src_col is not None:
+            candidates &= COL_MASKS[src_col]
+
+        # the move text only disambiguates between legal moves, so a pinned piece is never the one that moved
+        if candidates & (candidates - 1):
+            unpinned = candidates
+            remaining = candidates
+            while remaining:
+                src = lowest_square(remaining)
+                remaining &= remaining - 1
+                if self.is_pinned(src, dst, piece):
+                    unpinned &= ~(1 << src)
+            if unpinned:
+                candidates = unpinned
+
+        if candidates == 0:
+            raise Exception(f"Parser error. No {PIECE_LETTERS[piece]} can move to square {dst}")
+        return lowest_square(candidates)
+
+
+class PgnMove:
+    # one move (or the end of game result, when player is None) from the PGN text, along with its board moves
+    __slots__ = ('player', 'move_text', 'move_num', 'board_moves')
+
+    def __init__(self, player, move_text, move_num):
+        self.player = player
+        self.move_text = move_text
+        self.move_num = move_num
+        self.board_moves = None
+        return
+
+    def __repr__(self):
+        return f"PgnMove({self.player}, {self.move_text!r}, {self.move_num}, {self.board_moves})"
+
+
+class PieceMove:
+    # a piece moving from one square to another, flashed at both squares by the replayer
+    __slots__ = ('src', 'dst', 'piece')
+
+    def __init__(self, src, dst, piece):
+        self.src = src
+        self.dst = dst
+        self.piece = piece
+        return
+
+    def __repr__(self):
+        return f"PieceMove({self.src}, {self.dst}, {self.piece})"
+
+
+class PieceDraw:
+    # a piece (or a blank square) drawn straight onto a square - promotions, en passant captures and FEN setups
+    __slots__ = ('square', 'piece')
+
+    def __init__(self, square, piece):
+        self.square = square
+        self.piece = piece
+        return
+
+    def __repr__(self):
+        return f"PieceDraw({self.square}, {self.piece})"
+
+
+class ConversionCache:
+    #
+    #  An on-disk cache of encoded games, kept in a SQLite file.  Each game's encoded segment is stored under a hash
+    #  of that game's raw PGN text, so a game that hasn't changed since an earlier run is never parsed or resolved
+    #  again.  When the stored segments grow past max_bytes, the least recently used ones are evicted.
+    #
+
+    # bump this whenever the encoding of a game changes, so segments from an older encoder are never reused
+    format_version = 2
+
+    def __init__(self, filename, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.db = sqlite3.connect(filename)
+        self.db.execute('CREATE TABLE IF NOT EXISTS segments '
+                        '(key BLOB PRIMARY KEY, segment BLOB NOT NULL, last_used INTEGER NOT NULL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS segments_by_last_used ON segments (last_used)')
+        self.clock, self.total_bytes = self.db.execute(
+            'SELECT COALESCE(MAX(last_used), 0), COALESCE(SUM(LENGTH(segment)), 0) FROM segments').fetchone()
+        return
+
+    def key_for(self, game_block):
+        header_lines, move_lines = game_block
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(f"{self.format_version}\0".encode())
+        for line in header_lines:
+            digest.update(line.encode('utf-8', errors='surrogateescape'))
+        digest.update(b'\0')
+        for line in move_lines:
+            digest.update(line.encode('utf-8', errors='surrogateescape'))
+        return digest.digest()
+
+    def get(self, key):
+        row = self.db.execute('SELECT segment FROM segments WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.clock += 1
+        self.db.execute('UPDATE segments SET last_used = ? WHERE key = ?', (self.clock, key))
+        return row[0]
+
+    def put(self, key, segment):
+        self.clock += 1
+        cursor = self.db.execute('INSERT OR IGNORE INTO segments (key, segment, last_used) VALUES (?, ?, ?)',
+                                 (key, bytes(segment), self.clock))
+        if cursor.rowcount == 1:
+            self.total_bytes += len(segment)
+        return
+
+    def evict(self):
+        # drop the least recently used segments until the cache is back under its size limit
+        excess = self.total_bytes - self.max_bytes
+        if excess <= 0:
+            return
+        evicted = []
+        for key, size in self.db.execute('SELECT key, LENGTH(segment) FROM segments ORDER BY last_used'):
+            if excess <= 0:
+                break
+            evicted.append((key,))
+            excess -= size
+            self.total_bytes -= size
+        self.db.executemany('DELETE FROM segments WHERE key = ?', evicted)
+        return
+
+    def close(self):
+        self.evict()
+        self.db.commit()
+        self.db.close()
+        return
+
+
+class GameIndex:
+    #
+    #  An index of the games in a set of PGN files, kept in a SQLite file.  Each game's main tags are stored along
+    #  with where the game's text sits in its file, so games can be picked out with an SQL expression and read
+    #  straight from their files without parsing anything else.  A file is indexed again whenever its size or
+    #  modification time changes.
+    #
+
+    # the tags that can be used in a --where expression, by column name
+    columns = {'event': 'Event', 'white': 'White', 'black': 'Black', 'date': 'Date', 'result': 'Result', 'eco': 'ECO'}
+
+    def __init__(self, filename):
+        self.db = sqlite3.connect(filename)
+        self.db.execute('CREATE TABLE IF NOT EXISTS files '
+                        '(file_id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL, size INTEGER NOT NULL, '
+                        'mtime_ns INTEGER NOT NULL)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS games '
+                        '(file_id INTEGER NOT NULL, offset INTEGER NOT NULL, length INTEGER NOT NULL, '
+                        + ', '.join(f"{column} TEXT" for column in self.columns) + ', PRIMARY KEY (file_id, offset))')
+        for column in ('event', 'white', 'black', 'date', 'eco'):
+            self.db.execute(f"CREATE INDEX IF NOT EXISTS games_by_{column} ON games ({column})")
+        return
+
+    def file_id(self, filename):
+        row = self.db.execute('SELECT file_id FROM files WHERE name = ?', (os.path.abspath(filename),)).fetchone()
+        if row is None:
+            raise Exception(f"{filename} isn't in the game index")
+        return row[0]
+
+    def update(self, filename, converter):
+        #
+        #  Indexes the file if it's new or has changed since it was last indexed.  Only the tags are parsed, the moves
+        #  are only looked at to find where each game ends, and not at all in an uncompressed file.  Returns the
+        #  number of games indexed, 0 if the file was already up to date.
+        #
+        name = os.path.abspath(filename)
+        status = os.stat(filename)
+        row = self.db.execute('SELECT file_id, size, mtime_ns FROM files WHERE name = ?', (name,)).fetchone()
+        if row is not None:
+            if row[1:] == (status.st_size, status.st_mtime_ns):
+                return 0
+            self.db.execute('DELETE FROM games WHERE file_id = ?', (row[0],))
+            self.db.execute('DELETE FROM files WHERE file_id = ?', (row[0],))
+
+        cursor = self.db.execute('INSERT INTO files (name, size, mtime_ns) VALUES (?, ?, ?)',
+                                 (name, status.st_size, status.st_mtime_ns))
+        file_id = cursor.lastrowid
+        num_games = 0
+        rows = []
+        for offset, length, header_lines in converter.pgn_game_spans(filename):
+            meta = converter.parse_pgn_file_for_metadata(header_lines)
+            rows.append((file_id, offset, length) + tuple(meta.get(tag) for tag in self.columns.values()))
+            if len(rows) == 10000:
+                num_games += self.insert_games(rows)
+                rows = []
+        num_games += self.insert_games(rows)
+        self.db.commit()
+        return num_games
+
+    def insert_games(self, rows):
+        self.db.executemany(f"INSERT INTO games VALUES ({', '.join('?' * (3 + len(self.columns)))})", rows)
+        return len(rows)
+
+    def count(self, filenames, where):
+        # checks the expression too, so a bad one is caught before any conversion starts
+        file_ids = [self.file_id(filename) for filename in filenames]
+        try:
+            return self.db.execute(f"SELECT COUNT(*) FROM games WHERE file_id IN ({', '.join('?' * len(file_ids))}) "
+                                   f"AND ({where})", file_ids).fetchone()[0]
+        except sqlite3.Error as e:
+            raise Exception(f"Can't select games with \"{where}\": {e}")
+
+    def select(self, filename, where):
+        # where each matching game sits in the file, in file order
+        cursor = self.db.execute(f"SELECT offset, length FROM games WHERE file_id = ? AND ({where}) ORDER BY offset",
+                                 (self.file_id(filename),))
+        for span in cursor:
+            yield span
+        return
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+        return
+
+
+class PgnOffsetIndex:
+    #
+    #  Finds where each game starts in an uncompressed PGN file without reading it a line at a time.  The file is
+    #  memory-mapped and scanned for BLANK_LINES in one pass, only looking into the movetext in front of each one, and
+    #  after that any game can be sliced straight out of the mapping by its number.  The games are split up the same
+    #  way read_pgn_games splits them.  Each game's span runs on to the start of the next one, so the spans cover the
+    #  whole file.
+    #
+    #  Saved offsets (see save) are used instead of scanning if the PGN file's size and modification time still match.
+    #
+    def __init__(self, filename):
+        self.filename = filename
+        self.fh = open(filename, 'rb')
+        status = os.fstat(self.fh.fileno())
+        self.file_size = status.st_size
+        self.mtime_ns = status.st_mtime_ns
+        # an empty file can't be mapped
+        self.data = b''
+        if self.file_size > 0:
+            self.data = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+        for prefix, module in COMPRESSED_PGN_FORMATS:
+            if self.data[0:len(prefix)] == prefix:
+                self.close()
+                raise Exception(f"{filename} is compressed, the offsets of its games can only be found in an "
+                                f"uncompressed file")
+
+        self.offsets = self.load()
+        self.loaded = self.offsets is not None
+        if self.offsets is None:
+            self.offsets = self.scan()
+        return
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def scan(self):
+        #
+        #  The first blank lines in a game end its tags, and the next ones only end the game if nothing is still open
+        #  in its movetext - the same as in read_pgn_games.  The next game starts just after the first of those blank
+        #  lines, which is where read_pgn_games ends the game in front.  Blank lines at the top or bottom of the file
+        #  go with the game next to them, they aren't a game of their own.
+        #
+        offsets = array.array('Q')
+        start = 0
+        moves_start = None
+        for match in BLANK_LINES.finditer(self.data):
+            if moves_start is None:
+                if NON_BLANK.search(self.data, start, match.start()) is not None:
+                    moves_start = match.end()
+            elif self.movetext_is_open(moves_start, match.start()) is False:
+                offsets.append(start)
+                start = self.data.find(b'\n', match.start() + 1) + 1
+                moves_start = None
+        if NON_BLANK.search(self.data, start, self.file_size) is not None:
+            offsets.append(start)
+        return offsets
+
+    def movetext_is_open(self, start, end):
+        #
+        #  Most movetext has nothing in it but whole comments and variations, which can't leave anything open, so
+        #  it's checked without following it bracket by bracket unless there's an unclosed comment, a ; comment or an
+        #  escaped line.  With no variations or ; comments, only a { after the last } can still be open.  Once the
+        #  brackets of the variations pair up, whatever is left open can't have a closing bracket after it, as one
+        #  with nothing open is skipped the same as in read_pgn_games.  A } outside a comment closes a variation
+        #  there too.
+        #
+        data = self.data
+        if data.find(b'(', start, end) < 0 and data.find(b'[', start, end) < 0 and data.find(b';', start, end) < 0 \
+                and data.find(b'%', start, end) < 0:
+            return data.rfind(b'{', start, end) > data.rfind(b'}', start, end)
+
+        movetext = data[start:end]
+        stripped = WHOLE_COMMENTS.sub(b'', movetext)
+        if HARD_MOVETEXT.search(stripped) is None:
+            brackets = stripped.translate(None, NOT_BRACKETS)
+            num_paired = 1
+            while num_paired > 0:
+                brackets, num_paired = BRACKET_PAIRS.subn(b'', brackets)
+            return brackets.find(b'(') >= 0 or brackets.find(b'[') >= 0
+
+        in_comment = False
+        depth = 0
+        for line in movetext.split(b'\n'):
+            if line.startswith(b'%'):
+                continue
+            for bracket in MOVETEXT_BRACKETS.findall(line):
+                if in_comment:
+                    in_comment = bracket != b'}'
+                elif bracket == b'{':
+                    in_comment = True
+                elif bracket == b';':
+                    break
+                elif bracket in (b'[', b'('):
+                    depth += 1
+                elif depth > 0:
+                    depth -= 1
+        return in_comment or depth > 0
+
+    def load(self):
+        # the saved offsets, or None if there aren't any or they're out of date
+        try:
+            with open(self.filename + OFFSETS_SUFFIX, 'rb') as fh:
+                header = fh.read(OFFSETS_HEADER.size)
+                if len(header) < OFFSETS_HEADER.size:
+                    return None
+                magic, version, file_size, mtime_ns, game_count = OFFSETS_HEADER.unpack(header)
+                if (magic, version, file_size, mtime_ns) != (OFFSETS_MAGIC, OFFSETS_VERSION, self.file_size,
+                                                             self.mtime_ns):
+                    return None
+                offsets = array.array('Q')
+                offsets.fromfile(fh, game_count)
+        except (OSError, EOFError):
+            return None
+        if sys.byteorder == 'big':
+            offsets.byteswap()
+        return offsets
+
+    def save(self):
+        # written alongside and then renamed, so a half written file is never picked up
+        filename = self.filename + OFFSETS_SUFFIX
+        offsets = array.array('Q', self.offsets)
+        if sys.byteorder == 'big':
+            offsets.byteswap()
+        with open(filename + '.tmp', 'wb') as fhw:
+            fhw.write(OFFSETS_HEADER.pack(OFFSETS_MAGIC, OFFSETS_VERSION, self.file_size, self.mtime_ns,
+                                          len(offsets)))
+            offsets.tofile(fhw)
+        os.replace(filename + '.tmp', filename)
+        return filename
+
+    def game_span(self, game_num):
+        # byte offset and length of a game, games are numbered from 0
+        if game_num < 0 or game_num >= len(self.offsets):
+            raise IndexError(f"game {game_num} is out of range, {self.filename} has {len(self.offsets)} games")
+        start = self.offsets[game_num]
+        end = self.offsets[game_num + 1] if game_num + 1 < len(self.offsets) else self.file_size
+        return start, end - start
+
+    def spans(self):
+        for game_num in range(0, len(self.offsets)):
+            yield self.game_span(game_num)
+        return
+
+    def game_text(self, game_num):
+        start, length = self.game_span(game_num)
+        return self.data[start:start + length]
+
+    def tag_lines(self, game_num):
+        #
+        #  The lines of a game up to the first blank line after them, decoded - the same as the header lines
+        #  read_pgn_games would give for the game.  The moves are never looked at.
+        #
+        start, length = self.game_span(game_num)
+        end = start + length
+        lines = []
+        while start < end:
+            line_end = self.data.find(b'\n', start, end)
+            line_end = end if line_end < 0 else line_end + 1
+            line = self.data[start:line_end]
+            start = line_end
+            if len(line.strip()) == 0:
+                if len(lines) > 0:
+                    break
+                continue
+            lines.append(line.decode('utf-8', errors='replace'))
+        return lines
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.fh.close()
+        return
+
+
+class GameHashSet:
+    #
+    #  A set of 64-bit game hashes kept in one flat array, open addressed with linear probing.  Millions of games
+    #  take about 16 bytes each, rather than the 60 or so that a Python set of ints would need.  0 marks an empty
+    #  slot, so a hash of 0 is stored as 1.
+    #
+    def __init__(self, capacity=1 << 16):
+        self.slots = array.array('Q', bytes(8 * capacity))
+        self.mask = capacity - 1
+        self.size = 0
+        return
+
+    def __len__(self):
+        return self.size
+
+    def add(self, value):
+        # returns False if the value was already in the set
+        value = value or 1
+        slots = self.slots
+        mask = self.mask
+        i = value & mask
+        while slots[i] != 0:
+            if slots[i] == value:
+                return False
+            i = (i + 1) & mask
+        slots[i] = value
+        self.size += 1
+
+        # kept at most half full, so the probe runs stay short
+        if self.size * 2 > mask:
+            self.grow()
+        return True
+
+    def grow(self):
+        old_slots = self.slots
+        self.slots = array.array('Q', bytes(16 * len(old_slots)))
+        self.mask = 2 * len(old_slots) - 1
+        self.size = 0
+        for value in old_slots:
+            if value != 0:
+                self.add(value)
+        return
+
+
+class OpeningNode:
+    # one move of an opening, the move's stream bytes are the key it's kept under in its parent's children
+    def __init__(self, parent, ply):
+        self.parent = parent
+        self.ply = ply
+        self.children = {}
+        self.count = 0
+        self.num_bytes = 0 if parent is None else parent.num_bytes + len(ply)
+        self.covered = 0
+        self.block_num = None
+        return
+
+
+class OpeningTrie:
+    #
+    #  Counts how many games start with each sequence of moves, as a trie of the moves' stream bytes, then picks out
+    #  the openings worth storing once as blocks in the chessdata file (see DATA_FLAG_OPENINGS).
+    #
+    #  A game is played from the deepest block on its path, so a block only saves bytes on the games that don't get
+    #  a deeper one - each block is chosen for the bytes it saves over whatever block those games would use otherwise,
+    #  less the room it takes up.  That saving only goes down as other blocks are chosen, so the candidates are kept
+    #  in a heap and only the one on top is worked out again.
+    #
+    #  The games that share nothing past a move are counted under nodes of their own, and once there are more than
+    #  max_nodes of those they're pruned, so a huge corpus doesn't grow the trie without end.  A line pruned that way
+    #  that turns up again starts over at a count of 1.
+    #
+    def __init__(self, max_plies=OPENING_MAX_PLIES, max_nodes=OPENING_MAX_NODES):
+        self.root = OpeningNode(None, b'')
+        self.max_plies = max_plies
+        self.max_nodes = max_nodes
+        self.num_nodes = 0
+        self.blocks = []
+        self.game_byte_size = 1.0
+        return
+
+    def add(self, plies):
+        node = self.root
+        node.count += 1
+        for ply in plies[:self.max_plies]:
+            child = node.children.get(ply)
+            if child is None:
+                child = OpeningNode(node, ply)
+                node.children[ply] = child
+                self.num_nodes += 1
+            child.count += 1
+            node = child
+        if self.num_nodes > self.max_nodes:
+            self.prune(self.root)
+        return
+
+    def prune(self, node):
+        for ply, child in list(node.children.items()):
+            if child.count == 1:
+                del node.children[ply]
+                self.num_nodes -= self.subtree_size(child)
+            else:
+                self.prune(child)
+        return
+
+    def subtree_size(self, node):
+        return 1 + sum(self.subtree_size(child) for child in node.children.values())
+
+    def block_gain(self, node):
+        #
+        #  The bytes saved by making a block of this node.  Each game that would use it trades the moves of the block
+        #  for an OP token and a block number (2 bytes), or the moves past the block it already had, and the block
+        #  costs its bytes, an EO token and an offset (3 bytes).  The games' bytes are scaled by game_byte_size, as
+        #  they're Huffman coded in a compressed file but the blocks aren't.
+        #
+        base = 2
+        ancestor = node.parent
+        while ancestor is not None:
+            if ancestor.block_num is not None:
+                base = ancestor.num_bytes
+                break
+            ancestor = ancestor.parent
+        return (node.count - node.covered) * (node.num_bytes - base) * self.game_byte_size - (node.num_bytes + 3)
+
+    def choose_blocks(self, byte_limit, game_byte_size=1.0, max_blocks=OPENING_MAX_BLOCKS):
+        self.game_byte_size = game_byte_size
+        heap = []
+        pending = [self.root]
+        while len(pending) > 0:
+            node = pending.pop()
+            for child in node.children.values():
+                if child.count > 1:
+                    heapq.heappush(heap, (-self.block_gain(child), id(child), child))
+                    pending.append(child)
+
+        table_bytes = 0
+        while len(heap) > 0 and len(self.blocks) < max_blocks:
+            stale_gain, key, node = heapq.heappop(heap)
+            gain = self.block_gain(node)
+            if gain <= 0:
+                continue
+            if len(heap) > 0 and gain < -heap[0][0]:
+                heapq.heappush(heap, (-gain, key, node))
+                continue
+            if table_bytes + node.num_bytes + 3 > byte_limit:
+                continue
+
+            node.block_num = len(self.blocks)
+            self.blocks.append(node)
+            table_bytes += node.num_bytes + 3
+
+            # the games under this node are all covered now, as far as the blocks above it are concerned
+            newly_covered = node.count - node.covered
+            ancestor = node.parent
+            while ancestor is not None:
+                ancestor.covered += newly_covered
+                if ancestor.block_num is not None:
+                    break
+                ancestor = ancestor.parent
+        return self.blocks
+
+    def deepest_block(self, plies):
+        # the block the game should be played from, and how many of its moves that covers
+        node = self.root
+        found = (None, 0)
+        for ply_num, ply in enumerate(plies[:self.max_plies], start=1):
+            node = node.children.get(ply)
+            if node is None:
+                break
+            if node.block_num is not None:
+                found = (node.block_num, ply_num)
+        return found
+
+    def block_bytes(self, node):
+        plies = []
+        while node.parent is not None:
+            plies.append(node.ply)
+            node = node.parent
+        return b''.join(reversed(plies))
+
+
+class HuffmanCoder:
+    #
+    #  Builds a Huffman code for each context from the byte counts of a whole file, then codes streams with them.  A
+    #  tree only has room for 127 symbols, since the replayer marks leaves with the high bit, so the rarest bytes of a
+    #  busy context are sent as an escape code and the byte itself.
+    #
+    max_symbols = 127
+
+    def __init__(self, num_contexts):
+        self.counts = [collections.Counter() for context in range(0, num_contexts)]
+        self.trees = None
+        self.codes = None
+        return
+
+    def count(self, contexts, stream):
+        for context, byte in zip(contexts, stream):
+            self.counts[context][byte] += 1
+        return
+
+    def build(self, table_limit):
+        symbol_limits = [self.max_symbols] * len(self.counts)
+        while True:
+            self.trees = [self.build_tree(counts, limit) for counts, limit in zip(self.counts, symbol_limits)]
+            sizes = [len(self.tree_bytes(tree)) for tree in self.trees]
+            if sum(sizes) <= table_limit:
+                break
+
+            # too big for the replayer, escape a few more of the rarest bytes in the biggest tree
+            largest = sizes.index(max(sizes))
+            symbol_limits[largest] = min(symbol_limits[largest], len(self.counts[largest])) - 8
+        self.codes = [self.tree_codes(tree) for tree in self.trees]
+        return
+
+    def build_tree(self, counts, symbol_limit):
+        #
+        #  Leaves are a byte value, or None for the escape code, and internal nodes are a (left, right) tuple.  Ties
+        #  are broken by the order things went into the heap, so the same counts always give the same tree.
+        #
+        symbols = sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+        coded = symbols[:max(1, symbol_limit)]
+        escaped = sum(count for symbol, count in symbols[len(coded):])
+        if len(coded) == 0:
+            # a context that never turns up still needs a tree
+            coded = [(0, 0)]
+
+        heap = [(escaped, 0, None)]
+        for order, (symbol, count) in enumerate(coded, start=1):
+            heap.append((count, order, symbol))
+        heapq.heapify(heap)
+        order = len(heap)
+        while len(heap) > 1:
+            left_count, left_order, left = heapq.heappop(heap)
+            right_count, right_order, right = heapq.heappop(heap)
+            heapq.heappush(heap, (left_count + right_count, order, (left, right)))
+            order += 1
+        return heap[0][2]
+
+    def tree_bytes(self, tree):
+        # internal nodes are numbered breadth first, so the root is node 0
+        nodes = [tree]
+        leaves = [0]
+        children = bytearray()
+        index = 0
+        while index < len(nodes):
+            for child in nodes[index]:
+                if isinstance(child, tuple):
+                    children.append(len(nodes))
+                    nodes.append(child)
+                elif child is None:
+                    children.append(0x80)
+                else:
+                    children.append(0x80 | len(leaves))
+                    leaves.append(child)
+            index += 1
+        return bytes([len(nodes)]) + children + bytes(leaves)
+
+    def tree_codes(self, tree):
+        # each byte's code as a string of 0s and 1s, and the escape code under None
+        codes = {}
+        pending = [(tree, '')]
+        while len(pending) > 0:
+            node, code = pending.pop()
+            if isinstance(node, tuple):
+                pending.append((node[0], code + '0'))
+                pending.append((node[1], code + '1'))
+            else:
+                codes[node] = code
+        return codes
+
+    def table_bytes(self):
+        return b''.join(self.tree_bytes(tree) for tree in self.trees)
+
+    def encode(self, contexts, stream):
+        bits = []
+        for context, byte in zip(contexts, stream):
+            code = self.codes[context].get(byte)
+            if code is None:
+                code = self.codes[context][None] + f"{byte:08b}"
+            bits.append(code)
+        bits = ''.join(bits)
+
+        # padded out to a whole number of bytes, the first bit is the top bit of the first byte
+        bits += '0' * (-len(bits) % 8)
+        return int(bits, 2).to_bytes(len(bits) // 8, 'big') if len(bits) > 0 else b''
+
+
+class ChessDataReader:
+    #
+    #  Reads games straight out of an indexed chessdata file, seeking to any game without decoding the ones in front
+    #  of it.  Each game comes back as its encoded bytes, from its first token through to its NG token - or its
+    #  Huffman code, in a compressed file (see compressed).
+    #
+    def __init__(self, filename):
+        self.filename = filename
+        self.fh = open(filename, 'rb')
+        self.fh.seek(0, 2)
+        file_size = self.fh.tell()
+
+        magic = None
+        if file_size >= INDEX_FOOTER.size:
+            self.fh.seek(file_size - INDEX_FOOTER.size)
+            magic, version, flags, self.game_count, table_offset = INDEX_FOOTER.unpack(self.fh.read(INDEX_FOOTER.size))
+        if magic != INDEX_MAGIC:
+            self.fh.close()
+            raise Exception(f"{filename} has no game index - write it with pgn_to_pet.py --index")
+        if version > INDEX_VERSION:
+            self.fh.close()
+            raise Exception(f"{filename} has a version {version} game index, this reader only knows version "
+                            f"{INDEX_VERSION}")
+
+        self.compressed = (flags & DATA_FLAG_COMPRESSED) != 0
+        self.fh.seek(table_offset)
+        self.table = self.fh.read(self.game_count * INDEX_ENTRY.size)
+        return
+
+    def __len__(self):
+        return self.game_count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def game_location(self, game_num):
+        # byte offset and length of a game, games are numbered from 0
+        if game_num < 0 or game_num >= self.game_count:
+            raise IndexError(f"game {game_num} is out of range, {self.filename} has {self.game_count} games")
+        return INDEX_ENTRY.unpack_from(self.table, game_num * INDEX_ENTRY.size)
+
+    def read_game(self, game_num):
+        offset, length = self.game_location(game_num)
+        self.fh.seek(offset)
+        return self.fh.read(length)
+
+    def __iter__(self):
+        for game_num in range(0, self.game_count):
+            yield self.read_game(game_num)
+        return
+
+    def close(self):
+        self.fh.close()
+        return
+
+
+def square_name(sq):
+    return 'abcdefgh'[sq % 8] + str(8 - sq // 8)
+
+
+class ChessDataDecoder:
+    #
+    #  Decodes a chessdata file back into each game's stream, and replays a game's stream onto a board the way the
+    #  replayer would, checking every piece move against the move text that follows it.  This catches a source square
+    #  that was resolved wrongly, which would otherwise throw off every later move of the game.
+    #
+    #  A move is checked for: the piece being where the stream says, it belonging to the side to move, the move
+    #  being one that piece can make on the board as it stands, not leaving its own king in check, and the move text
+    #  agreeing about the piece, the squares, any capture, promotion or castling.
+    #
+    def __init__(self, header):
+        # header is the start of the file, up to the first record - see header_size
+        self.converter = PgnToPet()
+        self.stream_code = self.converter.stream_code
+        self.stream_name = self.converter.stream_name
+        if header[0] != DATA_MARKER:
+            raise Exception("This isn't a chessdata file, or it was written by an older pgn_to_pet.py")
+        self.compressed = (header[1] & DATA_FLAG_COMPRESSED) != 0
+        self.header_size = 2
+        self.trees = []
+        if self.compressed:
+            num_trees = header[2]
+            pos = 3
+            for tree_num in range(0, num_trees):
+                num_nodes = header[pos]
+                children = header[pos + 1:pos + 1 + num_nodes * 2]
+                symbols = header[pos + 1 + num_nodes * 2:pos + 2 + num_nodes * 3]
+                self.trees.append((children, symbols, self.build_tree_lookup(children)))
+                pos += 2 + num_nodes * 3
+            self.header_size = pos
+
+        # the opening blocks, without their EO tokens
+        self.openings = []
+        if header[1] & DATA_FLAG_OPENINGS:
+            table_size = struct.unpack_from('<H', header, self.header_size)[0]
+            table = header[self.header_size + 2:self.header_size + 2 + table_size]
+            num_blocks = struct.unpack_from('<H', table, 0)[0] // 2 if table_size > 0 else 0
+            offsets = list(struct.unpack_from(f"<{num_blocks}H", table, 0)) + [table_size]
+            for block_num in range(0, num_blocks):
+                self.openings.append(bytes(table[offsets[block_num]:offsets[block_num + 1] - 1]))
+            self.header_size += 2 + table_size
+        self.start_squares = self.converter.populate_board().squares
+        return
+
+    def build_tree_lookup(self, children):
+        #
+        #  Where walking the tree with each possible next 8 bits ends up: a leaf and the number of bits it took, or
+        #  the internal node reached after all 8.  Most codes are short, so this saves walking the tree a bit at a
+        #  time.
+        #
+        lookup = []
+        for value in range(0, 256):
+            node = 0
+            for bit_num in range(0, 8):
+                child = children[node * 2 + ((value >> (7 - bit_num)) & 1)]
+                if child & 0x80:
+                    lookup.append((True, child & 0x7F, bit_num + 1))
+                    break
+                node = child
+            else:
+                lookup.append((False, node, 8))
+        return lookup
+
+    def records(self, data):
+        # each record's bytes, the last one is the EOF token's - any game index is after that
+        end = len(data)
+        if end >= INDEX_FOOTER.size:
+            magic, version, flags, game_count, table_offset = INDEX_FOOTER.unpack_from(data, end - INDEX_FOOTER.size)
+            if magic == INDEX_MAGIC:
+                end = table_offset
+        pos = self.header_size
+        while pos < end:
+            length = struct.unpack_from('<H', data, pos)[0]
+            pos += 2
+            yield data[pos:pos + length]
+            pos += length
+        return
+
+    def decode_record(self, record):
+        #
+        #  The game's stream, with any opening block played in place of its OP token the way the replayer does, so
+        #  the stream comes out the same as it was before the openings were shared.
+        #
+        if self.compressed is False and len(self.openings) == 0:
+            return bytes(record)
+
+        # the contexts follow the replayer's, see stream_contexts
+        padded = bytes(record) + bytes(2)
+        trees = self.trees
+        pos = 0
+
+        def next_raw_byte(context):
+            nonlocal pos
+            pos += 1
+            return padded[pos - 1]
+
+        def next_huffman_byte(context):
+            nonlocal pos
+            children, symbols, lookup = trees[context]
+            index = pos >> 3
+            bits = (((padded[index] << 8) | padded[index + 1]) >> (8 - (pos & 7))) & 0xFF
+            is_leaf, value, length = lookup[bits]
+            pos += length
+            while is_leaf is False:
+                bit = (padded[pos >> 3] >> (7 - (pos & 7))) & 1
+                pos += 1
+                child = children[value * 2 + bit]
+                is_leaf = (child & 0x80) != 0
+                value = child & 0x7F
+            if value != 0:
+                return symbols[value]
+
+            # the escape code, the byte itself follows
+            index = pos >> 3
+            byte = (((padded[index] << 8) | padded[index + 1]) >> (8 - (pos & 7))) & 0xFF
+            pos += 8
+            return byte
+
+        next_byte = next_huffman_byte if self.compressed else next_raw_byte
+        stream = bytearray()
+        eor = self.stream_code['EOR']
+        first_piece = self.stream_code['BR']
+        cmd_context = CONTEXT_CMD
+        while True:
+            code = next_byte(cmd_context)
+            stream.append(code)
+            cmd_context = CONTEXT_CMD
+            if code < first_piece:
+                stream.append(next_byte(CONTEXT_SQUARE))
+                stream.append(next_byte(CONTEXT_PIECE))
+                cmd_context = CONTEXT_AFTER_MOVE
+                continue
+
+            name = self.stream_name[code]
+            if name in ('EV', 'DT', 'WX', 'BX', 'PG', 'EOG'):
+                context = CONTEXT_MOVE_TEXT if name == 'PG' else CONTEXT_TEXT
+                while True:
+                    byte = next_byte(context)
+                    stream.append(byte)
+                    if byte == eor:
+                        break
+                    if CONTEXT_MOVE_TEXT <= context < CONTEXT_MOVE_TEXT_LAST:
+                        context += 1
+                if name == 'PG':
+                    cmd_context = CONTEXT_AFTER_PG
+            elif name == 'DN':
+                while True:
+                    square = next_byte(CONTEXT_SQUARE)
+                    stream.append(square)
+                    if square == eor:
+                        break
+                    stream.append(next_byte(CONTEXT_PIECE))
+            elif name == 'DP':
+                stream.append(next_byte(CONTEXT_SQUARE))
+                stream.append(next_byte(CONTEXT_PIECE))
+            elif name in ('MX', 'PX'):
+                stream.append(next_byte(CONTEXT_TEXT))
+            elif name == 'OP':
+                # the opening's moves take the place of the token
+                del stream[-1]
+                stream += self.openings[next_byte(CONTEXT_TEXT)]
+            elif name in ('NG', 'EOF'):
+                break
+        return bytes(stream)
+
+    def game_streams(self, data):
+        for record in self.records(data):
+            stream = self.decode_record(record)
+            if stream[0] == self.stream_code['EOF']:
+                break
+            yield stream
+        return
+
+    def stream_text(self, text):
+        # PETSCII back to ASCII, the letters all come back as capitals
+        return ''.join(chr(code + 64) if 1 <= code <= 26 else chr(code) for code in text)
+
+    def verify_game(self, stream):
+        #
+        #  Replays one game's stream onto self.board.  Returns None if every move checks out, otherwise a description
+        #  of the first one that doesn't, along with the players' names and the move number.
+        #
+        board = Board()
+        for sq, piece in enumerate(self.start_squares):
+            if piece != 0:
+                board.set_piece(sq, piece)
+        self.board = board
+        self.white_to_move = True
+        self.ep_square = None
+        self.any_ep_capture = False
+        names = {}
+        pending = []
+        move_count = 0
+        eor = self.stream_code['EOR']
+        first_piece = self.stream_code['BR']
+        index = 0
+        while index < len(stream):
+            code = stream[index]
+            index += 1
+            if code < first_piece:
+                pending.append((code, stream[index], stream[index + 1]))
+                index += 2
+                continue
+
+            name = self.stream_name[code]
+            problem = None
+            if name in ('EV', 'DT', 'WX', 'BX', 'PG', 'EOG'):
+                end = stream.index(eor, index)
+                text = self.stream_text(stream[index:end])
+                index = end + 1
+                if name == 'PG':
+                    move_count += 1
+                    problem = self.verify_move(pending, text)
+                    pending = []
+                elif name == 'EOG' and len(pending) > 0:
+                    problem = "the last piece move has no move text"
+                else:
+                    names[name] = text.strip()
+            elif name == 'CB':
+                for sq in range(0, 64):
+                    board.clear_square(sq)
+            elif name == 'DN':
+                while stream[index] != eor:
+                    self.draw_piece(stream[index], stream[index + 1])
+                    index += 2
+                index += 1
+                # the stream doesn't say whether a FEN start allows an en passant capture, so the first move may
+                # capture en passant onto any empty square behind an enemy pawn
+                self.any_ep_capture = True
+            elif name == 'DP':
+                if len(pending) > 0:
+                    # a promotion or an en passant capture, part of the move being made
+                    pending.append((None, stream[index], stream[index + 1]))
+                else:
+                    self.draw_piece(stream[index], stream[index + 1])
+                index += 2
+            elif name in ('MX', 'PX'):
+                # PX is only there when black moves first
+                if name == 'PX':
+                    self.white_to_move = False
+                index += 1
+
+            if problem is not None:
+                players = f"{names.get('WX', '?')} vs {names.get('BX', '?')}"
+                return f"{players}, move {move_count} {text!r}: {problem}"
+        return None
+
+    def draw_piece(self, sq, piece):
+        if piece == self.stream_code['BS']:
+            self.board.clear_square(sq)
+        else:
+            self.board.set_piece(sq, piece)
+        return
+
+    def verify_move(self, pending, text):
+        #
+        #  Checks the piece moves and draws since the last move text against the board and the move text, then
+        #  makes the move.  Returns a description of the first problem found, or None.
+        #
+        board = self.board
+        if len(pending) == 0 or pending[0][0] is None:
+            return "there's no piece move before the move text"
+        src, dst, piece = pending[0]
+        if board.squares[src] != piece:
+            return f"the stream moves a {PIECE_LETTERS[piece]} from {square_name(src)}, which has " \
+                   f"{PIECE_LETTERS.get(board.squares[src], 'nothing')} on it"
+        if (piece >= WHITE_ROOK) != self.white_to_move:
+            return f"it's {'white' if self.white_to_move else 'black'}'s move, but a {PIECE_LETTERS[piece]} moved"
+
+        # strip any check marks and annotations the same way the converter does
+        san = text
+        while len(san) > 0 and san[-1] not in ('1', '2', '3', '4', '5', '6', '7', '8', 'Q', 'R', 'N', 'B', 'O'):
+            san = san[:-1]
+        if len(san) < 2:
+            return "the move text isn't a move"
+
+        kind = piece if piece < WHITE_ROOK else piece - 6
+        if kind == BLACK_KING and abs(dst - src) == 2:
+            return self.verify_castling(pending, san)
+        if san.startswith('O-O'):
+            return f"the move text is castling, but the stream moves {square_name(src)} to {square_name(dst)}"
+
+        # what's left is [piece][file or rank of the source][x]destination[=promotion]
+        promotion = None
+        if '=' in san:
+            promotion = san[-1]
+            san = san[:-2]
+        if san[-2:] != square_name(dst).upper():
+            return f"the move text goes to {san[-2:].lower()}, but the stream moves to {square_name(dst)}"
+        source = san[:-2]
+        captures_text = 'X' in source
+        source = source.replace('X', '')
+        if kind == BLACK_PAWN:
+            if source not in ('', square_name(src)[0].upper()):
+                return f"the move text doesn't fit a pawn on {square_name(src)}"
+        else:
+            if len(source) == 0 or source[0] != PIECE_LETTERS[kind].upper():
+                return f"the move text doesn't fit a {PIECE_LETTERS[piece]} moving"
+            for ch in source[1:]:
+                if ch not in square_name(src).upper():
+                    return f"the move text doesn't fit the piece on {square_name(src)}"
+
+        target = board.squares[dst]
+        if target != 0 and (target >= WHITE_ROOK) == (piece >= WHITE_ROOK):
+            return f"the stream captures its own piece on {square_name(dst)}"
+        extras = pending[1:]
+        captured = target != 0
+        ep_victim = None
+        next_ep = None
+        if kind == BLACK_PAWN:
+            forward = -8 if piece == WHITE_PAWN else 8
+            start_row = 6 if piece == WHITE_PAWN else 1
+            if dst == src + forward and target == 0:
+                pass
+            elif dst == src + 2 * forward and src // 8 == start_row and target == 0 \
+                    and board.squares[src + forward] == 0:
+                next_ep = src + forward
+            elif abs(dst % 8 - src % 8) == 1 and dst // 8 == src // 8 + forward // 8:
+                if target == 0:
+                    ep_victim = dst - forward
+                    enemy_pawn = BLACK_PAWN if piece == WHITE_PAWN else WHITE_PAWN
+                    if dst != self.ep_square \
+                            and (self.any_ep_capture is False or board.squares[ep_victim] != enemy_pawn):
+                        return f"a pawn can't capture on the empty square {square_name(dst)}"
+
+                    captured = True
+            else:
+                return f"a pawn can't move from {square_name(src)} to {square_name(dst)}"
+        elif board.attackers_of(dst, piece) & (1 << src) == 0:
+            return f"a {PIECE_LETTERS[piece]} can't move from {square_name(src)} to {square_name(dst)}"
+        if captured != captures_text:
+            return "the stream's move captures, but the move text has no 'x'" if captured \
+                else "the move text captures, but the stream's move doesn't"
+
+        board.move_piece(src, dst)
+
+        # the draws that go with a pawn move: the promoted piece, or the pawn taken en passant
+        promotes = kind == BLACK_PAWN and dst // 8 in (0, 7)
+        expected = []
+        if promotes:
+            if promotion is None:
+                return "the pawn reaches the last rank, but the move text has no promotion"
+            expected.append(dst)
+        elif promotion is not None:
+            return "the move text promotes, but the pawn doesn't reach the last rank"
+        if ep_victim is not None:
+            expected.append(ep_victim)
+        if [draw[1] for draw in extras] != expected or any(draw[0] is not None for draw in extras):
+            return "the stream draws pieces that don't go with the move"
+        for unused, sq, drawn in extras:
+            if sq == dst:
+                if drawn == self.stream_code['BS'] or (drawn >= WHITE_ROOK) != (piece >= WHITE_ROOK) \
+                        or PIECE_LETTERS[drawn].upper() != promotion:
+                    return f"the pawn is promoted to {PIECE_LETTERS.get(drawn, 'nothing')} on the board"
+            elif drawn != self.stream_code['BS']:
+                return f"the pawn taken en passant is replaced with {PIECE_LETTERS[drawn]}"
+            self.draw_piece(sq, drawn)
+
+        return self.finish_move(piece, next_ep)
+
+    def verify_castling(self, pending, san):
+        board = self.board
+        src, dst, king = pending[0]
+        row = src // 8
+        if src % 8 != 4 or dst // 8 != row:
+            return f"a king can't move from {square_name(src)} to {square_name(dst)}"
+        kingside = dst > src
+        if san != ('O-O' if kingside else 'O-O-O'):
+            return f"the king castles {'king' if kingside else 'queen'}side, but the move text doesn't"
+        rook = king - 4
+        rook_src = row * 8 + (7 if kingside else 0)
+        rook_dst = row * 8 + (5 if kingside else 3)
+        if pending[1:] != [(rook_src, rook_dst, rook)] or board.squares[rook_src] != rook:
+            return "the rook doesn't move with the king"
+
+        between = range(src + 1, rook_src) if kingside else range(rook_src + 1, src)
+        if any(board.squares[sq] != 0 for sq in between):
+            return "there are pieces between the king and rook"
+        by_white = king < WHITE_ROOK
+        if any(board.is_attacked(sq, by_white) for sq in (src, (src + dst) // 2)):
+            return "the king castles out of or through check"
+
+        board.move_piece(src, dst)
+        board.move_piece(rook_src, rook_dst)
+        return self.finish_move(king, None)
+
+    def finish_move(self, piece, ep_square):
+        # the side that moved can't be left in check
+        white = piece >= WHITE_ROOK
+        king = self.board.pieces[WHITE_KING if white else BLACK_KING]
+        if king != 0 and self.board.is_attacked(lowest_square(king), not white):
+            return "the move leaves its own king in check"
+        self.white_to_move = not white
+        self.ep_square = ep_square
+        self.any_ep_capture = False
+        return None
+
+
+class ConversionStats:
+    #
+    #  Cumulative wall clock and CPU time spent in each stage of a conversion, along with counts of what was in the
+    #  games.  Worker processes for --jobs keep stats of their own, which are merged back into the main process's.
+    #
+    #  Timing is done in laps: start() marks the beginning of a game and each lap() charges the time since the last
+    #  mark to a stage.
+    #
+    stages = ('read', 'dedupe', 'metadata', 'fen', 'tokens', 'board', 'generate', 'datafile')
+
+    # games taken from the cache are never parsed, so only the games converted go into the counts after those two
+    count_names = ('games converted', 'games from the cache', 'duplicates dropped', 'moves', 'captures', 'promotions',
+                   'FEN starts', 'comments', 'variations', 'NAGs', 'tokens skipped in {} and ()')
+
+    def __init__(self):
+        self.wall = dict.fromkeys(self.stages, 0.0)
+        self.cpu = dict.fromkeys(self.stages, 0.0)
+        self.counts = dict.fromkeys(self.count_names, 0)
+        self.byte_counts = collections.Counter()
+        self.lap_wall = 0.0
+        self.lap_cpu = 0.0
+        return
+
+    def start(self):
+        self.lap_wall = time.perf_counter()
+        self.lap_cpu = time.process_time()
+        return
+
+    def lap(self, stage):
+        now_wall = time.perf_counter()
+        now_cpu = time.process_time()
+        self.wall[stage] += now_wall - self.lap_wall
+        self.cpu[stage] += now_cpu - self.lap_cpu
+        self.lap_wall = now_wall
+        self.lap_cpu = now_cpu
+        return
+
+    def timed_iter(self, stage, items):
+        # charges the time taken to produce each item to the stage, but not the time the caller spends on it
+        items = iter(items)
+        while True:
+            self.start()
+            try:
+                item = next(items)
+            except StopIteration:
+                self.lap(stage)
+                return
+            self.lap(stage)
+            yield item
+
+    def merge(self, other):
+        for stage in self.stages:
+            self.wall[stage] += other.wall[stage]
+            self.cpu[stage] += other.cpu[stage]
+        for name in self.count_names:
+            self.counts[name] += other.counts[name]
+        self.byte_counts.update(other.byte_counts)
+        return
+
+    def count_game(self, meta, moves):
+        # the comments, variations and NAGs are counted as the tokenizer takes them out, see MOVETEXT_MARKERS
+        counts = self.counts
+        counts['games converted'] += 1
+        if 'FEN' in meta:
+            counts['FEN starts'] += 1
+        for move in moves:
+            if move.player is None:
+                continue
+            counts['moves'] += 1
+            if 'x' in move.move_text:
+                counts['captures'] += 1
+            if '=' in move.move_text:
+                counts['promotions'] += 1
+        return
+
+    def print_report(self):
+        byte_counts = self.byte_counts
+        total_wall = sum(self.wall.values())
+        print(f"{'stage':<10} {'wall s':>9} {'cpu s':>9} {'share':>7}")
+        for stage in self.stages:
+            share = self.wall[stage] / total_wall * 100 if total_wall > 0 else 0.0
+            print(f"{stage:<10} {self.wall[stage]:>9.3f} {self.cpu[stage]:>9.3f} {share:>6.1f}%")
+        print(f"{'total':<10} {total_wall:>9.3f} {sum(self.cpu.values()):>9.3f}")
+        print()
+        for name in self.count_names:
+            print(f"{name + ':':<29} {self.counts[name]:>10}")
+        if self.counts['games from the cache'] > 0:
+            print('(the counts from moves on are for the games converted only, not the ones from the cache)')
+        print()
+
+        total_bytes = sum(byte_counts.values())
+        print(f"{'output bytes':<13} {'bytes':>10} {'share':>7}")
+        for name, count in sorted(byte_counts.items(), key=lambda item: item[1], reverse=True):
+            share = count / total_bytes * 100 if total_bytes > 0 else 0.0
+            print(f"{name:<13} {count:>10} {share:>6.1f}%")
+        print(f"{'total':<13} {total_bytes:>10}")
+        return
 
 
 class PgnToPet:
-    def __init__(self, filenames):
-        games = []
-        self.output_stream = []
-        self.output_bytes = []
-        self.board_piece_to_byte_stream = {' ': 'BS', 'P': 'WP', 'R': 'WR', 'N': 'WN', 'B': 'WB', 'Q': 'WQ', 'K': 'WK',
-                                           'p': 'BP', 'r': 'BR', 'n': 'BN', 'b': 'BB', 'q': 'BQ', 'k': 'BK'}
+    def __init__(self, filenames=None, jobs=1, cache=None, stats=None, game_index=None, where=None, dedupe=False):
+        self.output_stream = bytearray()
+        self.filenames = filenames
+        self.jobs = jobs
+        self.cache = cache
+        self.stats = stats
+        self.game_index = game_index
+        self.where = where
+        self.dedupe = dedupe
+        self.duplicates = []
         self.stream_code = {'BR': 101, 'BN': 102, 'BB': 103, 'BQ': 104, 'BK': 105, 'BP': 106, 'WR': 107, 'WN': 108,
                             'WB': 109, 'WQ': 110, 'WK': 111, 'WP': 112, 'BS': 113, 'ZZ': 114, 'DP': 115, 'DN': 116,
                             'CB': 117, 'PG': 118, 'EV': 119, 'DT': 120, 'WX': 121, 'BX': 122, 'MX': 123, 'PX': 124,
-                            'EOG': 125, 'NG': 126, 'EOF': 127, 'EOR': 254}
+                            'EOG': 125, 'NG': 126, 'EOF': 127, 'OP': 128, 'EO': 129, 'EOR': 254}
+        self.stream_name = {code: name for name, code in self.stream_code.items()}
         self.default_fen = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR"
+        self.petscii_table = self.build_petscii_table()
 
+        # with no files we're just a set of conversion tables and routines - this is how the worker processes for
+        # --jobs use this class.  Nothing is converted until write_pet_datafile asks for the games.
+        return
+
+    def encoded_segments(self):
+        #
+        #  The conversion pipeline.  Games are read from the input files one at a time, and each game is tokenized,
+        #  resolved and encoded on its way through, so only the games being worked on are ever held in memory.  The
+        #  segments come out in the same order as the games in the input files, whether or not a pool is used.
+        #
+        game_blocks = self.read_pgn_files(self.filenames)
+        if self.dedupe is True:
+            game_blocks = self.drop_duplicate_games(game_blocks)
+        if self.jobs > 1:
+            return self.encode_games_in_pool(game_blocks, self.jobs, self.cache)
+        return self.encode_games_serially(game_blocks, self.cache)
+
+    def read_pgn_files(self, filenames):
         for filename in filenames:
-            with open(filename, 'r') as fh:
-                self.lines = fh.readlines()
+            if self.where is not None:
+                game_blocks = self.read_selected_pgn_games(filename)
+            else:
+                game_blocks = self.read_pgn_file(filename)
+            if self.stats is not None:
+                game_blocks = self.stats.timed_iter('read', game_blocks)
+            for game_block in game_blocks:
+                yield game_block
+        return
 
-            self.file_index = 0
+    def drop_duplicate_games(self, game_blocks):
+        #
+        #  Passes on only the first of the games that have the same moves from the same start.  The rest are noted in
+        #  self.duplicates as (input game number, description) and never get encoded.  This runs before the games go
+        #  out to any pool, so the same copy of a game is kept no matter how many jobs are used.
+        #
+        seen = GameHashSet()
+        stats = self.stats
+        for game_num, game_block in enumerate(game_blocks, start=1):
+            if stats is not None:
+                stats.start()
+            game_hash = self.game_moves_hash(game_block)
+            is_new = game_hash is None or seen.add(game_hash)
+            if stats is not None:
+                stats.lap('dedupe')
+            if is_new:
+                yield game_block
+                continue
 
-            while self.file_index < len(self.lines):
-                # get any metadata tags
-                meta = self.parse_pgn_file_for_metadata()
+            meta = self.parse_pgn_file_for_metadata(game_block[0])
+            self.duplicates.append((game_num, f"{meta.get('White', '?')} vs {meta.get('Black', '?')}, "
+                                              f"{meta.get('Event', '?')}, {meta.get('Date', '?')}"))
+            if stats is not None:
+                stats.counts['duplicates dropped'] += 1
+        return
 
-                # pull any defined FEN element and populate the initial board
-                fen = meta.get('FEN', None)
-                board = self.populate_board(fen)
-                fen_moves = self.board_to_draw_commands(board)
+    def game_moves_hash(self, game_block):
+        #
+        #  A 64-bit hash of the game's start position and its moves in SAN, with the move numbers, result and
+        #  annotations taken out, so that copies of a game with different tags, comments or variations come out the
+        #  same.  Games with no moves don't get a hash, there's nothing to tell them apart by.
+        #
+        header_lines, move_lines = game_block
+        meta = self.parse_pgn_file_for_metadata(header_lines)
+        san_moves = []
+        for token in self.parse_pgn_file_for_moves_tokens(move_lines):
+            if self.token_starts_with_movenum(token) or self.move_is_end_of_game(token):
+                continue
+            san_moves.append(token.rstrip('!?+#').replace('=', '').replace('0', 'O'))
+        if len(san_moves) == 0:
+            return None
 
-                # get the first pass through the moves text, return a set of tokens
-                tokens = self.parse_pgn_file_for_moves_tokens()
+        digest = hashlib.blake2b(digest_size=8)
+        digest.update(meta.get('FEN', self.default_fen).encode('utf-8', errors='replace'))
+        digest.update(b'\0')
+        digest.update(' '.join(san_moves).encode('utf-8', errors='replace'))
+        return int.from_bytes(digest.digest(), 'little')
 
-                # convert the tokens to a set of moves structs
-                moves = self.create_pgn_moves_struct(tokens)
+    def open_pgn_file(self, filename, binary=False):
+        #
+        #  Opens a PGN file, or standard input for '-', for reading as text or binary.  A compressed file is
+        #  decompressed as it's read (see COMPRESSED_PGN_FORMATS), so it never has to be unpacked to disk first.  The
+        #  offsets of a compressed file are the offsets in the decompressed text.
+        #
+        if filename == '-':
+            fh = open(sys.stdin.fileno(), 'rb', closefd=False)
+            magic = fh.peek(6)[:6]
+            for prefix, module in COMPRESSED_PGN_FORMATS:
+                if magic.startswith(prefix):
+                    fh = module.open(fh)
+                    break
+        else:
+            module = self.pgn_file_compression(filename)
+            if module is not None:
+                fh = module.open(filename, 'rb')
+            else:
+                fh = open(filename, 'rb')
+
+        if binary is True:
+            return fh
+        return io.TextIOWrapper(fh)
+
+    def pgn_file_compression(self, filename):
+        # the module that decompresses the file, None if it isn't compressed
+        with open(filename, 'rb') as fh:
+            magic = fh.read(6)
+        for prefix, module in COMPRESSED_PGN_FORMATS:
+            if magic.startswith(prefix):
+                return module
+        return None
+
+    def read_pgn_file(self, filename):
+        with self.open_pgn_file(filename) as fh:
+            # games are pulled from the file one at a time, so the whole file is never held in memory
+            for game_block in self.read_pgn_games(fh):
+                yield game_block
+        return
 
-                # add the board movements
-                moves = self.add_board_movements(moves, board)
+    def read_selected_pgn_games(self, filename):
+        # only the games picked out by the game index are read, each one straight from where it sits in the file
+        with self.open_pgn_file(filename, binary=True) as fh:
+            for offset, length in self.game_index.select(filename, self.where):
+                fh.seek(offset)
+                text = fh.read(length).decode('utf-8', errors='replace')
+                for game_block in self.read_pgn_games(io.StringIO(text, newline=None)):
+                    yield game_block
+        return
 
-                # save this game info
-                games.append({'moves': moves, 'meta': meta, 'fenmoves': fen_moves})
+    def pgn_game_spans(self, filename):
+        #
+        #  Where each game sits in a PGN file along with its tag lines.  An uncompressed file is scanned for the start
+        #  of each game by PgnOffsetIndex, using its saved offsets if there are any, and only the tags are decoded.  A
+        #  compressed file has to be read through line by line.
+        #
+        if filename != '-' and self.pgn_file_compression(filename) is None:
+            with PgnOffsetIndex(filename) as offsets:
+                for game_num, (offset, length) in enumerate(offsets.spans()):
+                    yield offset, length, offsets.tag_lines(game_num)
+        else:
+            with self.open_pgn_file(filename, binary=True) as fh:
+                for span in self.read_pgn_game_spans(fh):
+                    yield span
+        return
 
-        for game in games:
-            # ordering matters here in terms of what gets drawn when
-            meta = game['meta']
-            fen = game['fenmoves']
-            moves = game['moves']
-            self.generate_metadata_outputs(meta)
-            self.generate_fen_draw_outputs(fen)
-            self.generate_first_move_data(moves)
-            self.generate_pause()
-            self.generate_moves_data(moves)
-            self.generate_pause(num=4)
-            self.generate_eog()
-        self.generate_eof()
+    def read_pgn_game_spans(self, fh):
+        #
+        #  Generator that splits a PGN file opened in binary the same way read_pgn_games does, and yields where each
+        #  game sits in the file along with its tag lines.  Each game's span runs on from the end of the game before
+        #  it, so the spans cover the whole file.
+        #
+        position = 0
+
+        def decoded_lines():
+            nonlocal position
+            for line in fh:
+                position += len(line)
+                yield line.decode('utf-8', errors='replace')
+            return
+
+        start = 0
+        for header_lines, move_lines in self.read_pgn_games(decoded_lines()):
+            yield start, position - start, header_lines
+            start = position
         return
 
-    def parse_pgn_file_for_metadata(self):
-        metadata = {}
+    def encode_game(self, game_block):
+        #
+        #  Runs one game all the way through, from its PGN text to its encoded byte stream.  Returns that game's
+        #  segment of the output stream.
+        #
+        header_lines, move_lines = game_block
+        self.output_stream = bytearray()
+        stats = self.stats
+        if stats is not None:
+            stats.start()
+
+        # get any metadata tags
+        meta = self.parse_pgn_file_for_metadata(header_lines)
+        if stats is not None:
+            stats.lap('metadata')
+
+        # pull any defined FEN element and populate the initial board
+        fen = meta.get('FEN', None)
+        board = self.populate_board(fen)
+        fen_moves = self.board_to_draw_commands(board)
+        if stats is not None:
+            stats.lap('fen')
+
+        # the moves text is tokenized as the tokens are turned into a set of moves structs
+        tokens = self.parse_pgn_file_for_moves_tokens(move_lines, None if stats is None else stats.counts)
+        moves = self.create_pgn_moves_struct(tokens)
+        if stats is not None:
+            stats.lap('tokens')
+
+        # add the board movements
+        moves = self.add_board_movements(moves, board)
+        if stats is not None:
+            stats.lap('board')
+
+        # ordering matters here in terms of what gets drawn when
+        self.generate_metadata_outputs(meta)
+        self.generate_fen_draw_outputs(fen_moves)
+        self.generate_first_move_data(moves)
+        self.generate_pause()
+        self.generate_moves_data(moves)
+        self.generate_pause(num=4)
+        self.generate_eog()
+        if stats is not None:
+            stats.lap('generate')
+            # counting isn't charged to any stage
+            stats.count_game(meta, moves)
+        return self.output_stream
+
+    def encode_games_serially(self, game_blocks, cache=None):
+        for game_block in game_blocks:
+            if cache is None:
+                yield self.encode_game(game_block)
+                continue
 
-        # consume all blank lines we encounter at the top of the current section
-        while len(self.lines[self.file_index].strip()) == 0:
-            self.file_index += 1
+            # only games that aren't already in the cache need to be encoded
+            key = cache.key_for(game_block)
+            segment = cache.get(key)
+            if segment is None:
+                segment = self.encode_game(game_block)
+                cache.put(key, segment)
+            elif self.stats is not None:
+                self.stats.counts['games from the cache'] += 1
+            yield segment
+        return
 
-        while self.file_index < len(self.lines):
-            line = self.lines[self.file_index]
-            self.file_index += 1
-            line = line.strip()
+    def encode_games_in_pool(self, game_blocks, jobs, cache=None, chunk_size=32):
+        #
+        #  Farms the games out to a pool of worker processes in chunks and hands the encoded segments back in their
+        #  original input order.  Only a few chunks per worker are in flight at once, so the input is still read a
+        #  game at a time rather than being queued up in memory all at once.
+        #
+        #  Games found in the cache never go to the pool.  A cache hit closes off the chunk being built, so that
+        #  each chunk only holds games that were next to each other in the input.
+        #
+        max_pending = jobs * 4
+        pending = collections.deque()
+        chunk = []
+        chunk_keys = []
+        with multiprocessing.Pool(jobs, initializer=init_pool_worker, initargs=(self.stats is not None,)) as pool:
+            for game_block in game_blocks:
+                key = None
+                segment = None
+                if cache is not None:
+                    key = cache.key_for(game_block)
+                    segment = cache.get(key)
+
+                if segment is None:
+                    chunk.append(game_block)
+                    chunk_keys.append(key)
+                if len(chunk) > 0 and (segment is not None or len(chunk) == chunk_size):
+                    pending.append((pool.apply_async(encode_games_in_worker, (chunk,)), chunk_keys))
+                    chunk = []
+                    chunk_keys = []
+                if segment is not None:
+                    pending.append((None, [segment]))
+                    if self.stats is not None:
+                        self.stats.counts['games from the cache'] += 1
+
+                while len(pending) >= max_pending:
+                    for segment in self.collect_pool_segments(pending.popleft(), cache):
+                        yield segment
+
+            if len(chunk) > 0:
+                pending.append((pool.apply_async(encode_games_in_worker, (chunk,)), chunk_keys))
+            while len(pending) > 0:
+                for segment in self.collect_pool_segments(pending.popleft(), cache):
+                    yield segment
+        return
 
-            # end of the metadata section - a blank line
-            if len(line) == 0:
-                break
+    def collect_pool_segments(self, pending_entry, cache):
+        # a pending entry is either a chunk handed to the pool along with the chunk's cache keys, or a cache hit
+        async_result, keys_or_segments = pending_entry
+        if async_result is None:
+            return keys_or_segments
+
+        segments, stats = async_result.get()
+        if stats is not None:
+            self.stats.merge(stats)
+        if cache is not None:
+            for key, segment in zip(keys_or_segments, segments):
+                cache.put(key, segment)
+        return segments
+
+    def chunk_game_blocks(self, game_blocks, chunk_size):
+        chunk = []
+        for game_block in game_blocks:
+            chunk.append(game_block)
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if len(chunk) > 0:
+            yield chunk
+        return
+
+    def read_pgn_games(self, fh):
+        #
+        #  Generator that walks an open PGN file line by line and yields one game at a time as a pair of lists: the
+        #  metadata tag lines and the moves text lines.  Only the game currently being read is held in memory.
+        #
+        #  The tags section ends at the first blank line.  The moves section ends at the next blank line, unless that
+        #  blank line is inside a comment or variation.
+        #
+        header_lines = []
+        move_lines = []
+        in_moves = False
+        in_comment = False
+        depth = 0
+
+        for line in fh:
+            if len(line.strip()) == 0:
+                if in_moves is False:
+                    # consume blank lines at the top of a game, a blank line after the tags starts the moves section
+                    if len(header_lines) > 0:
+                        in_moves = True
+                    continue
+
+                if depth == 0 and in_comment is False:
+                    # consume blank lines at the top of the moves section, otherwise this is the end of the game
+                    if len(move_lines) > 0:
+                        yield (header_lines, move_lines)
+                        header_lines = []
+                        move_lines = []
+                        in_moves = False
+                    continue
+
+            if in_moves is False:
+                header_lines.append(line)
+                continue
+
+            move_lines.append(line)
+            if line.startswith('%'):
+                continue
+            for bracket in BRACKETS.findall(line):
+                if in_comment:
+                    in_comment = bracket != '}'
+                elif bracket == '{':
+                    in_comment = True
+                elif bracket == ';':
+                    # a comment to the end of the line
+                    break
+                elif bracket in ('[', '('):
+                    depth += 1
+                elif depth > 0:
+                    depth -= 1
+
+        # the last game in a file doesn't need a trailing blank line
+        if len(header_lines) > 0 or len(move_lines) > 0:
+            yield (header_lines, move_lines)
+        return
+
+    def parse_pgn_file_for_metadata(self, header_lines):
+        metadata = {}
+
+        for line in header_lines:
+            line = line.strip()
 
             # only going to parse files with one element per line in this section
             if (line.startswith('[') and line.endswith(']')) is False:
@@ -92,71 +1981,49 @@ class PgnToPet:
                     break
         return metadata
 
-    def parse_pgn_file_for_moves_tokens(self):
-        ignore_stack = []
-        token = ''
-        partial_token = ''
-        tokens = []
-
-        # consume all blank lines we encounter at the top
-        while len(self.lines[self.file_index].strip()) == 0:
-            self.file_index += 1
-
-        while self.file_index < len(self.lines):
-            line = self.lines[self.file_index]
-            self.file_index += 1
-
-            # end of this moves section - blank line
-            if len(line.strip()) == 0 and len(ignore_stack) == 0:
-                break
-
-            for ch in line:
-                if ch in ('[', '{', '('):
-                    ignore_stack.append(ch)
-                if ch in (']', '}', ')'):
-                    ignore_stack.pop()
-
-                if len(ignore_stack) > 0:
-                    continue
-                elif ch in (']', '}', ')'):
-                    continue
-
-                if ch == ' ' or ch == '\n':
-                    token = partial_token
-                    partial_token = ''
-                else:
-                    partial_token += ch
-                    continue
-
-                # at some state transitions, we end up with an empty token here, just continue to the next
-                if token == '':
-                    continue
-
-                # tokens that start with '$' are part of some meta commenting
-                if token.startswith('$'):
-                    continue
-
-                # find the end result if it is here
-                if self.move_is_end_of_game(token):
-                    if '½' in token:
-                        tokens.append('1/2-1/2')
-                    else:
-                        tokens.append(token)
-                    continue
-
-                # tokens can have a move number on the front of them, if so separate them
-                if token[0].isdigit() and '.' in token and token[-1] != '.':
-                    # find last '.'
-                    for i in reversed(range(0, len(token))):
-                        if token[i] == '.':
-                            movenum = token[0:i + 1]
-                            move = token[i + 1:]
-                            break
-                    tokens.append(movenum)
-                    tokens.append(move)
-                else:
-                    tokens.append(token)
-        return tokens
+    def parse_pgn_file_for_moves_tokens(self, move_lines, counts=None):
+        #
+        #  Generator for the tokens of a game's moves: move numbers, moves and the result.  Comments, NAGs and
+        #  variations, however deeply nested, are skipped - see MOVETEXT_COMMENTS.  With counts (a ConversionStats'
+        #  counts), the comments, variations and NAGs that aren't inside a variation are counted as they're skipped,
+        #  along with the tokens that were skipped with them.
+        #
+        movetext = ''.join(line for line in move_lines if line.startswith('%') is False)
+        if counts is not None:
+            num_words = len(MOVETEXT_ANY_WORD.findall(movetext))
+            movetext = MOVETEXT_COMMENTS.sub(lambda match: MOVETEXT_MARKERS[match.group()[0]], movetext)
+            blank = f" {MARKER_VARIATION} "
+        else:
+            movetext = MOVETEXT_COMMENTS.sub(' ', movetext)
+            blank = ' '
+        removed = 1
+        while removed > 0:
+            movetext, removed = MOVETEXT_VARIATION.subn(blank, movetext)
+
+        # a variation that's never closed runs to the end of the game
+        unclosed = movetext.find('(')
+        if unclosed >= 0:
+            movetext = movetext[:unclosed] + blank
+        movetext = movetext.replace(')', ' ')
+
+        if counts is not None:
+            num_nags = movetext.count(MARKER_NAG)
+            counts['comments'] += movetext.count(MARKER_COMMENT)
+            counts['variations'] += movetext.count(MARKER_VARIATION)
+            counts['NAGs'] += num_nags
+            # the markers split away as whitespace, and a NAG is a token that's skipped but not in {} or ()
+            counts['tokens skipped in {} and ()'] += num_words - len(movetext.split()) - num_nags
+
+        for match in MOVETEXT_WORD.finditer(movetext):
+            movenum, token = match.groups()
+            if movenum is not None:
+                yield movenum
+            elif MOVETEXT_RESULT.fullmatch(token) is not None:
+                # the end result
+                yield '1/2-1/2' if '½' in token else token
+                continue
+            yield token
+        return
 
     def token_starts_with_movenum(self, token):
         seen_num = False
@@ -172,9 +2039,7 @@ class PgnToPet:
         if fen is None:
             fen = self.default_fen
         self.fen = fen
-        board = []
-        for row in range(0, 8):
-            board.append(['', '', '', '', '', '', '', ''])
+        board = Board()
         row = 0
         col = 0
         for ch in fen:
@@ -182,8 +2047,8 @@ class PgnToPet:
                 col = 0
                 row += 1
                 continue
-            if ch in ('r', 'R', 'n', 'N', 'b', 'B', 'q', 'Q', 'k', 'K', 'p', 'P'):
-                board[row][col] = ch
+            if ch in PIECE_CODES:
+                board.set_piece(row * 8 + col, PIECE_CODES[ch])
             elif ch.isdigit():
                 col += int(ch) - 1
             else:
@@ -196,11 +2061,10 @@ class PgnToPet:
         draws = []
         if self.fen == self.default_fen:
             return draws
-        for row in range(0, 8):
-            for col in range(0, 8):
-                ch = board[row][col]
-                if ch != '':
-                    draws.append((row, col, ch))
+        for sq in range(0, 64):
+            piece = board.squares[sq]
+            if piece != 0:
+                draws.append(PieceDraw(sq, piece))
         return draws
 
     def dump_board(self, board):
@@ -209,10 +2073,11 @@ class PgnToPet:
             rank = 8 - row
             print(rank, end='')
             for col in range(0, 8):
-                if board[row][col] == '':
+                piece = board.squares[row * 8 + col]
+                if piece == 0:
                     print(" _", end='')
                 else:
-                    print(f" {board[row][col]}", end='')
+                    print(f" {PIECE_LETTERS[piece]}", end='')
             print('')
         print('  A B C D E F G H\n')
         return
@@ -252,15 +2117,11 @@ class PgnToPet:
 
             # detect end of game token
             if self.move_is_end_of_game(token):
-                moves.append({'player': None,
-                              'move_text': token,
-                              'move_num': None})
+                moves.append(PgnMove(None, token, None))
                 # this really SHOULD be the last token for the game, but we'll loop back up anyway
                 continue
 
-            moves.append({'player': current_player,
-                          'move_text': token,
-                          'move_num': movenum})
+            moves.append(PgnMove(current_player, token, movenum))
 
             current_player = 'WHITE' if current_player == 'BLACK' else 'BLACK'
         return moves
@@ -268,15 +2129,15 @@ class PgnToPet:
     def dump_game_pgn(self, moves):
         # useful when debugging
         for move in moves:
-            board_move = str(move.get('board_move', ''))
-            if move['player'] is None:
-                print(f"{move['move_text']}")
+            board_move = str(move.board_moves or '')
+            if move.player is None:
+                print(f"{move.move_text}")
                 need_cr = False
-            if move['player'] == 'WHITE':
-                print(f"{move['move_num']}. {move['move_text']} {board_move}", end='')
+            if move.player == 'WHITE':
+                print(f"{move.move_num}. {move.move_text} {board_move}", end='')
                 need_cr = True
             else:
-                print(f"  {move['move_text']} {board_move}")
+                print(f"  {move.move_text} {board_move}")
                 need_cr = False
 
         if need_cr is True:
@@ -294,201 +2155,6 @@ class PgnToPet:
         trimmed_move = move_text[:-2]
         return (dst_piece, trimmed_move)
 
-    def find_piece_in_row(self, dst_row, piece, board, starting_col=None):
-        #
-        #  If starting_col is given, that should be used as a place where the search should start.  It also implies that
-        #  this is a piece movement path and all cells between the starting location and the piece location should be
-        #  empty.
-        #
-        found_row = None
-        found_col = None
-        for_piece_move = True
-
-        rownum = dst_row
-
-        if starting_col is None:
-            for_piece_move = False
-            starting_col = -1
-
-        # check to the right
-        colnum = starting_col + 1
-        while colnum < 8:
-            try:
-                if board[rownum][colnum] == piece:
-                    found_row = rownum
-                    found_col = colnum
-                    break
-                elif board[rownum][colnum] != '' and for_piece_move is True:
-                    break
-            except Exception:
-                pass
-            colnum += 1
-
-        if found_row is not None:
-            return (found_row, found_col)
-
-        # check to the left
-        colnum = starting_col - 1
-        while colnum >= 0:
-            try:
-                if board[rownum][colnum] == piece:
-                    found_row = rownum
-                    found_col = colnum
-                    break
-                elif board[rownum][colnum] != '' and for_piece_move is True:
-                    break
-            except Exception:
-                pass
-            colnum -= 1
-        return (found_row, found_col)
-
-    def find_piece_in_col(self, dst_col, piece, board, starting_row=None):
-        found_row = None
-        found_col = None
-        for_piece_move = True
-
-        colnum = dst_col
-
-        if starting_row is None:
-            for_piece_move = False
-            starting_row = -1
-
-        # check down
-        rownum = starting_row + 1
-        while rownum < 8:
-            try:
-                if board[rownum][colnum] == piece:
-                    found_row = rownum
-                    found_col = colnum
-                    break
-                elif board[rownum][colnum] != '' and for_piece_move is True:
-                    break
-            except Exception:
-                pass
-            rownum += 1
-
-        if found_row is not None:
-            return (found_row, found_col)
-
-        # check up
-        rownum = starting_row - 1
-        while rownum >= 0:
-            try:
-                if board[rownum][colnum] == piece:
-                    found_row = rownum
-                    found_col = colnum
-                    break
-                elif board[rownum][colnum] != '' and for_piece_move is True:
-                    break
-            except Exception:
-                pass
-            rownum -= 1
-        return (found_row, found_col)
-
-    def find_knight(self, dst_row, dst_col, piece, board):
-        found_row = None
-        found_col = None
-
-        offsets = [(-2, -1), (-2, 1),
-                   (2, -1), (2, 1),
-                   (-1, 2), (1, 2),
-                   (-1, -2), (1, -2)]
-
-        # work through the various positions, checking for the knight
-        for offset in offsets:
-            row = dst_row + offset[0]
-            col = dst_col + offset[1]
-            try:
-                if board[row][col] == piece:
-                    found_row = row
-                    found_col = col
-            except Exception:
-                # if we check off the board, just move on
-                pass
-        return (found_row, found_col)
-
-    def find_piece_on_diagonals(self, dst_row, dst_col, piece, board):
-        #
-        #  This is assumed to be called in the context of finding a piece diagonally from a location on the board.
-        #  All squares between the location and the piece need to be empty.
-        #
-        found_row = None
-        found_col = None
-
-        # diagonally up-right
-        rownum = dst_row - 1
-        colnum = dst_col + 1
-        while rownum >= 0 and colnum < 8:
-            try:
-                if board[rownum][colnum] == piece:
-                    found_row = rownum
-                    found_col = colnum
-                    break
-                elif board[rownum][colnum] != '':
-                    break
-            except Exception:
-                pass
-            rownum -= 1
-            colnum += 1
-
-        if found_row is not None:
-            return (found_row, found_col)
-
-        # diagonally up-left
-        rownum = dst_row - 1
-        colnum = dst_col - 1
-        while rownum >= 0 and colnum >= 0:
-            try:
-                if board[rownum][colnum] == piece:
-                    found_row = rownum
-                    found_col = colnum
-                    break
-                elif board[rownum][colnum] != '':
-                    break
-            except Exception:
-                pass
-            rownum -= 1
-            colnum -= 1
-
-        if found_row is not None:
-            return (found_row, found_col)
-
-        # diagonally down-right
-        rownum = dst_row + 1
-        colnum = dst_col + 1
-        while rownum < 8 and colnum < 8:
-            try:
-                if board[rownum][colnum] == piece:
-                    found_row = rownum
-                    found_col = colnum
-                    break
-                elif board[rownum][colnum] != '':
-                    break
-            except Exception:
-                pass
-            rownum += 1
-            colnum += 1
-
-        if found_row is not None:
-            return (found_row, found_col)
-
-        # diagonally down-left
-        rownum = dst_row + 1
-        colnum = dst_col - 1
-        while rownum < 8 and colnum >= 0:
-            try:
-                if board[rownum][colnum] == piece:
-                    found_row = rownum
-                    found_col = colnum
-                    break
-                elif board[rownum][colnum] != '':
-                    break
-            except Exception:
-                pass
-            rownum += 1
-            colnum -= 1
-        return (found_row, found_col)
-
     def get_info_from_move_text(self, move_text):
         #
         # Moves look like this:
@@ -543,19 +2209,20 @@ class PgnToPet:
 
     def pawn_move(self, move_text, player, board):
         moves = []
-        piece = 'P' if player == 'WHITE' else 'p'
+        piece = WHITE_PAWN if player == 'WHITE' else BLACK_PAWN
         dst_piece = piece
 
         # check for pawn promotion
         if '=' in move_text:
-            dst_piece, move_text = self.get_pawn_promotion_info(move_text)
-
-        if player == 'BLACK':
-            dst_piece = dst_piece.lower()
+            dst_letter, move_text = self.get_pawn_promotion_info(move_text)
+            if player == 'BLACK':
+                dst_letter = dst_letter.lower()
+            dst_piece = PIECE_CODES[dst_letter]
 
         # destination is always given in the move text
         dst_row = self.convert_algebraic_rank_to_row(move_text[-1])
         dst_col = self.convert_algebraic_file_to_col(move_text[-2])
+        dst = dst_row * 8 + dst_col
 
         # find the pawn that is moving
         src_col = self.convert_algebraic_file_to_col(move_text[0])
@@ -563,231 +2230,144 @@ class PgnToPet:
         # a pawn can't move more than two squares at any time, so the source row is within two rows of the
         # destination within the source column.  Also, it has to be the first pawn we find moving from the
         # destination square back
-        src_row = None
+        src = None
         if player == 'WHITE':
             for row in range(dst_row + 1, dst_row + 3):
-                if board[row][src_col] == piece:
-                    src_row = row
+                if board.squares[row * 8 + src_col] == piece:
+                    src = row * 8 + src_col
                     break
         else:
             for row in range(dst_row - 1, dst_row - 3, -1):
-                if board[row][src_col] == piece:
-                    src_row = row
+                if board.squares[row * 8 + src_col] == piece:
+                    src = row * 8 + src_col
                     break
+        if src is None:
+            raise Exception(f"Parser error. No pawn can make the move {move_text}")
 
         # check for en passant capture
         # (should be enough to check that the pawn is capturing in an unoccupied square)
-        rem_row = None
-        if 'x' in move_text and board[dst_row][dst_col] == '':
-            if player == 'WHITE':
-                board[dst_row + 1][dst_col] = ''
-                rem_row = dst_row + 1
-                rem_col = dst_col
-            else:
-                board[dst_row - 1][dst_col] = ''
-                rem_row = dst_row - 1
-                rem_col = dst_col
+        rem = None
+        if 'x' in move_text and board.squares[dst] == 0:
+            rem = dst + 8 if player == 'WHITE' else dst - 8
+            board.clear_square(rem)
 
-        board[src_row][src_col] = ''
-        board[dst_row][dst_col] = dst_piece
-        moves.append((src_row, src_col, dst_row, dst_col, piece))
+        board.move_piece(src, dst)
+        moves.append(PieceMove(src, dst, piece))
 
         # promotion means drawing the promoted piece immediately after drawing the move
         if piece != dst_piece:
-            moves.append((dst_row, dst_col, dst_piece))
+            board.set_piece(dst, dst_piece)
+            moves.append(PieceDraw(dst, dst_piece))
 
         # handle en passant capture by removing the opposing pawn
-        if rem_row is not None:
-            moves.append((rem_row, rem_col, ' '))
+        if rem is not None:
+            moves.append(PieceDraw(rem, BLANK_SQUARE))
         return moves
 
     def king_move(self, move_text, player, board):
         moves = []
-        piece = 'K' if player == 'WHITE' else 'k'
+        piece = WHITE_KING if player == 'WHITE' else BLACK_KING
 
         # there is only one king, so it isn't necessary to search for the nearest one
-        for row in range(0, 8):
-            for col in range(0, 8):
-                if board[row][col] == piece:
-                    src_row = row
-                    src_col = col
+        src = lowest_square(board.pieces[piece])
 
         dst_col = self.convert_algebraic_file_to_col(move_text[-2])
         dst_row = self.convert_algebraic_rank_to_row(move_text[-1])
+        dst = dst_row * 8 + dst_col
 
-        board[src_row][src_col] = ''
-        board[dst_row][dst_col] = piece
-        moves.append((src_row, src_col, dst_row, dst_col, piece))
+        board.move_piece(src, dst)
+        moves.append(PieceMove(src, dst, piece))
         return moves
 
     def queen_move(self, move_text, player, board):
-        moves = []
-        piece = 'Q' if player == 'WHITE' else 'q'
-
-        src_row, src_col, dst_row, dst_col = self.get_info_from_move_text(move_text)
-
-        if src_row is not None and src_col is not None:
-            pass
-
-        elif src_row is not None:
-            src_row, src_col = self.find_piece_in_row(src_row, piece, board)
-
-        elif src_col is not None:
-            src_row, src_col = self.find_piece_in_col(src_col, piece, board)
-
-        else:
-            try:
-                # no hints from the move text, start looking
-                src_row, src_col = self.find_piece_in_col(dst_col, piece, board, starting_row=dst_row)
-                if src_row is not None:
-                    src_col = dst_col
-                    raise Exception('DONE')
-
-                src_row, src_col = self.find_piece_in_row(dst_row, piece, board, starting_col=dst_col)
-                if src_col is not None:
-                    src_row = dst_row
-                    raise Exception('DONE')
-
-                src_row, src_col = self.find_piece_on_diagonals(dst_row, dst_col, piece, board)
-
-            except Exception as errmsg:
-                if 'DONE' not in str(errmsg):
-                    raise
-
-        board[src_row][src_col] = ''
-        board[dst_row][dst_col] = piece
-        moves.append((src_row, src_col, dst_row, dst_col, piece))
-        return moves
+        piece = WHITE_QUEEN if player == 'WHITE' else BLACK_QUEEN
+        return self.piece_move(move_text, piece, board)
 
     def rook_move(self, move_text, player, board):
-        moves = []
-        piece = 'R' if player == 'WHITE' else 'r'
+        piece = WHITE_ROOK if player == 'WHITE' else BLACK_ROOK
+        return self.piece_move(move_text, piece, board)
 
-        src_row, src_col, dst_row, dst_col = self.get_info_from_move_text(move_text)
-
-        if src_row is not None and src_col is not None:
-            pass
-
-        elif src_row is not None:
-            src_row, src_col = self.find_piece_in_row(src_row, piece, board)
-
-        elif src_col is not None:
-            src_row, src_col = self.find_piece_in_col(src_col, piece, board)
+    def knight_move(self, move_text, player, board):
+        piece = WHITE_KNIGHT if player == 'WHITE' else BLACK_KNIGHT
+        return self.piece_move(move_text, piece, board)
 
-        else:
-            try:
-                # no hints from the move text, start looking
-                src_row, src_col = self.find_piece_in_col(dst_col, piece, board, starting_row=dst_row)
-                if src_row is not None:
-                    src_col = dst_col
-                    raise Exception('DONE')
-
-                src_row, src_col = self.find_piece_in_row(dst_row, piece, board, starting_col=dst_col)
-                if src_col is not None:
-                    src_row = dst_row
-                    raise Exception('DONE')
-
-            except Exception as errmsg:
-                if 'DONE' not in str(errmsg):
-                    raise
-
-        board[src_row][src_col] = ''
-        board[dst_row][dst_col] = piece
-        moves.append((src_row, src_col, dst_row, dst_col, piece))
-        return moves
+    def bishop_move(self, move_text, player, board):
+        piece = WHITE_BISHOP if player == 'WHITE' else BLACK_BISHOP
+        return self.piece_move(move_text, piece, board)
 
-    def knight_move(self, move_text, player, board):
+    def piece_move(self, move_text, piece, board):
         moves = []
-        piece = 'N' if player == 'WHITE' else 'n'
 
         src_row, src_col, dst_row, dst_col = self.get_info_from_move_text(move_text)
+        dst = dst_row * 8 + dst_col
 
-        if src_row is not None and src_col is not None:
-            pass
-
-        elif src_row is not None:
-            src_row, src_col = self.find_piece_in_row(src_row, piece, board)
-
-        elif src_col is not None:
-            src_row, src_col = self.find_piece_in_col(src_col, piece, board)
-
+        # unless the move text gives the full source square, look for the piece that can make the move
+        if src_row is None or src_col is None:
+            src = board.find_source_square(piece, dst, src_row, src_col)
         else:
-            src_row, src_col = self.find_knight(dst_row, dst_col, piece, board)
+            src = src_row * 8 + src_col
 
-        board[src_row][src_col] = ''
-        board[dst_row][dst_col] = piece
-        moves.append((src_row, src_col, dst_row, dst_col, piece))
-        return moves
-
-    def bishop_move(self, move_text, player, board):
-        moves = []
-        piece = 'B' if player == 'WHITE' else 'b'
-
-        src_row, src_col, dst_row, dst_col = self.get_info_from_move_text(move_text)
-        src_row, src_col = self.find_piece_on_diagonals(dst_row, dst_col, piece, board)
-
-        board[src_row][src_col] = ''
-        board[dst_row][dst_col] = piece
-        moves.append((src_row, src_col, dst_row, dst_col, piece))
+        board.move_piece(src, dst)
+        moves.append(PieceMove(src, dst, piece))
         return moves
 
     def castle_move(self, move_text, player, board):
         moves = []
         if player == 'WHITE':
-            rook = 'R'
-            king = 'K'
+            rook = WHITE_ROOK
+            king = WHITE_KING
             row = 7
         else:
-            rook = 'r'
-            king = 'k'
+            rook = BLACK_ROOK
+            king = BLACK_KING
             row = 0
-        king_src_col = 4
+        king_src = row * 8 + 4
 
         if move_text == 'O-O-O':
-            rook_src_col = 0
-            rook_dst_col = 3
-            king_dst_col = 2
+            rook_src = row * 8
+            rook_dst = row * 8 + 3
+            king_dst = row * 8 + 2
         else:
-            rook_src_col = 7
-            rook_dst_col = 5
-            king_dst_col = 6
+            rook_src = row * 8 + 7
+            rook_dst = row * 8 + 5
+            king_dst = row * 8 + 6
 
-        board[row][rook_src_col] = ''
-        board[row][king_src_col] = ''
-        board[row][rook_dst_col] = rook
-        board[row][king_dst_col] = king
+        board.clear_square(rook_src)
+        board.clear_square(king_src)
+        board.set_piece(rook_dst, rook)
+        board.set_piece(king_dst, king)
 
-        moves.append((row, king_src_col, row, king_dst_col, king))
-        moves.append((row, rook_src_col, row, rook_dst_col, rook))
+        moves.append(PieceMove(king_src, king_dst, king))
+        moves.append(PieceMove(rook_src, rook_dst, rook))
         return moves
 
     def add_board_movements(self, moves, board):
         for move in moves:
-            if self.move_is_end_of_game(move['move_text']):
+            if self.move_is_end_of_game(move.move_text):
                 continue
 
-            mtext = self.strip_annotations_from_text_move(move['move_text'])
+            mtext = self.strip_annotations_from_text_move(move.move_text)
             if mtext[0] == mtext[0].lower():
                 # looks like a pawn move
-                move['board_move'] = self.pawn_move(mtext, move['player'], board)
+                move.board_moves = self.pawn_move(mtext, move.player, board)
 
             elif mtext[0] == 'K':
-                move['board_move'] = self.king_move(mtext, move['player'], board)
+                move.board_moves = self.king_move(mtext, move.player, board)
 
             elif mtext[0] == 'Q':
-                move['board_move'] = self.queen_move(mtext, move['player'], board)
+                move.board_moves = self.queen_move(mtext, move.player, board)
 
             elif mtext[0] == 'B':
-                move['board_move'] = self.bishop_move(mtext, move['player'], board)
+                move.board_moves = self.bishop_move(mtext, move.player, board)
 
             elif mtext[0] == 'R':
-                move['board_move'] = self.rook_move(mtext, move['player'], board)
+                move.board_moves = self.rook_move(mtext, move.player, board)
 
             elif mtext[0] == 'N':
-                move['board_move'] = self.knight_move(mtext, move['player'], board)
+                move.board_moves = self.knight_move(mtext, move.player, board)
 
             elif mtext.startswith('O-O'):
-                move['board_move'] = self.castle_move(mtext, move['player'], board)
+                move.board_moves = self.castle_move(mtext, move.player, board)
 
             else:
                 raise Exception(f"Parser error. I don't know what to do with {mtext}")
@@ -800,6 +2380,23 @@ class PgnToPet:
         else:
             return ord(inchar)
 
+    def build_petscii_table(self):
+        # the PETSCII code for every latin-1 character, so whole strings can be converted with bytes.translate
+        table = bytearray(256)
+        for i in range(0, 256):
+            try:
+                code = self.char_to_petscii(chr(i))
+            except TypeError:
+                # letters like 'ß' that don't upper-case to a single character
+                code = ord('?')
+            if code < 0 or code > 255 or code == self.stream_code['EOR']:
+                code = ord('?')
+            table[i] = code
+        return bytes(table)
+
+    def petscii_string(self, text):
+        return text.encode('latin-1', errors='replace').translate(self.petscii_table)
+
     def center_string_within_width(self, instr, width):
         instr = instr.strip()
         strlen = len(instr)
@@ -820,14 +2417,9 @@ class PgnToPet:
         if msg is not None:
             msg = self.center_string_within_width(msg, 16)
 
-            # byte stream code
+            # byte stream code, then the characters in PETSCII format
             self.output_stream.append(self.stream_code[code])
-            self.output_bytes.append(code)
-
-            # characters in PETSCII format
-            for ch in msg:
-                self.output_stream.append(self.char_to_petscii(ch))
-                self.output_bytes.append(self.char_to_petscii(ch))
+            self.output_stream += self.petscii_string(msg)
 
             # end of record
             self.generate_eor()
@@ -839,24 +2431,14 @@ class PgnToPet:
 
         # "Clear board" token
         self.output_stream.append(self.stream_code['CB'])
-        self.output_bytes.append('CB')
 
         # "Draw N pieces" record
         self.output_stream.append(self.stream_code['DN'])
-        self.output_bytes.append('DN')
 
         # pieces are represented as square, piece pairs
-        for piecemove in fen_moves:
-            row = piecemove[0]
-            col = piecemove[1]
-            piece = piecemove[2]
-            board_square = row * 8 + col
-
-            self.output_stream.append(board_square)
-            self.output_stream.append(self.stream_code[self.board_piece_to_byte_stream[piece]])
-
-            self.output_bytes.append(board_square)
-            self.output_bytes.append(self.board_piece_to_byte_stream[piece])
+        for piecedraw in fen_moves:
+            self.output_stream.append(piecedraw.square)
+            self.output_stream.append(piecedraw.piece)
 
         # end of record
         self.generate_eor()
@@ -867,8 +2449,8 @@ class PgnToPet:
         if len(moves) == 0:
             return
         move = moves[0]
-        move_num = move['move_num']
-        player = move['player']
+        move_num = move.move_num
+        player = move.player
 
         if move_num is None:
             move_num = 1
@@ -876,84 +2458,41 @@ class PgnToPet:
             player = 'WHITE'
         if move_num != 1:
             self.output_stream.append(self.stream_code['MX'])
-            self.output_bytes.append('MX')
-            self.output_stream.append(move['move_num'])
-            self.output_bytes.append(move['move_num'])
+            self.output_stream.append(move.move_num)
         if player != 'WHITE':
             self.output_stream.append(self.stream_code['PX'])
-            self.output_bytes.append('PX')
             self.output_stream.append(2)
-            self.output_bytes.append(2)
         return
 
     def generate_moves_data(self, moves):
         if len(moves) == 0:
             return
+        out = self.output_stream
+        code_dp = self.stream_code['DP']
+        code_pg = self.stream_code['PG']
         for move in moves:
-            if 'board_move' in move.keys():
+            if move.board_moves is not None:
                 # the board coordinates and piece code
-                for piecemove in move['board_move']:
-                    if len(piecemove) == 5:
-                        row = piecemove[0]
-                        col = piecemove[1]
-                        src_square = row * 8 + col
-
-                        row = piecemove[2]
-                        col = piecemove[3]
-                        dst_square = row * 8 + col
-
-                        piece = piecemove[4]
-
-                        # find negative numbers
-                        if src_square < 0:
-                            raise Exception(f"found negative src square - move={move}")
-                        if dst_square < 0:
-                            raise Exception(f"found negative src square - move={move}")
-
-                        self.output_stream.append(src_square)
-                        self.output_stream.append(dst_square)
-                        self.output_stream.append(self.stream_code[self.board_piece_to_byte_stream[piece]])
-
-                        self.output_bytes.append(src_square)
-                        self.output_bytes.append(dst_square)
-                        self.output_bytes.append(self.board_piece_to_byte_stream[piece])
-
-                    elif len(piecemove) == 3:
-                        row = piecemove[0]
-                        col = piecemove[1]
-                        src_square = row * 8 + col
-                        piece = piecemove[2]
-
-                        if src_square < 0:
-                            raise Exception(f"found negative src square - move={move}")
-
-                        self.output_stream.append(self.stream_code['DP'])
-                        self.output_stream.append(src_square)
-                        self.output_stream.append(self.stream_code[self.board_piece_to_byte_stream[piece]])
-
-                        self.output_bytes.append('DP')
-                        self.output_bytes.append(src_square)
-                        self.output_bytes.append(self.board_piece_to_byte_stream[piece])
+                for piecemove in move.board_moves:
+                    if isinstance(piecemove, PieceMove):
+                        out.append(piecemove.src)
+                        out.append(piecemove.dst)
+                        out.append(piecemove.piece)
+                    else:
+                        out.append(code_dp)
+                        out.append(piecemove.square)
+                        out.append(piecemove.piece)
 
             # a move record with no player is the end of game result
-            if move['player'] is None:
-                self.output_stream.append(self.stream_code['EOG'])
-                self.output_bytes.append('EOG')
-
-                for ch in self.center_string_within_width(move['move_text'], 16):
-                    self.output_stream.append(self.char_to_petscii(ch))
-                    self.output_bytes.append(self.char_to_petscii(ch))
+            if move.player is None:
+                out.append(self.stream_code['EOG'])
+                out += self.petscii_string(self.center_string_within_width(move.move_text, 16))
                 self.generate_eor()
 
             else:
-                # the PGN text record
-                self.output_stream.append(self.stream_code['PG'])
-                self.output_bytes.append('PG')
-
-                # max any given move at 6 chars
-                for ch in move['move_text'][:6]:
-                    self.output_stream.append(self.char_to_petscii(ch))
-                    self.output_bytes.append(self.char_to_petscii(ch))
+                # the PGN text record, max any given move at 6 chars
+                out.append(code_pg)
+                out += self.petscii_string(move.move_text[:6])
                 self.generate_eor()
 
             # output a wait at the end of each move
@@ -963,37 +2502,162 @@ class PgnToPet:
     def generate_pause(self, num=1):
         for i in range(0, num):
             self.output_stream.append(self.stream_code['ZZ'])
-            self.output_bytes.append('ZZ')
         return
 
     def generate_eog(self):
         self.output_stream.append(self.stream_code['NG'])
-        self.output_bytes.append('NG')
         return
 
     def generate_eor(self):
         self.output_stream.append(self.stream_code['EOR'])
-        self.output_bytes.append('EOR')
         return
 
     def generate_eof(self):
         self.output_stream.append(self.stream_code['EOF'])
-        self.output_bytes.append('EOF')
         return
 
-    def dump_asm_byte_statements(self):
+    def stream_to_byte_trace(self, stream):
+        #
+        #  Rebuilds the symbolic form of a byte stream, with token and piece names in place of their codes.  The
+        #  encoders only ever write raw bytes, so this is done on demand when the stream is dumped.
+        #
+        trace = []
+        eor = self.stream_code['EOR']
+        index = 0
+        while index < len(stream):
+            code = stream[index]
+            index += 1
+
+            # anything below the piece codes starts a piece move: source square, destination square, piece
+            if code < self.stream_code['BR']:
+                trace.extend((code, stream[index], self.stream_name[stream[index + 1]]))
+                index += 2
+                continue
+
+            name = self.stream_name[code]
+            trace.append(name)
+            if name in ('EV', 'DT', 'WX', 'BX', 'PG', 'EOG'):
+                # PETSCII text up to the end of record
+                while stream[index] != eor:
+                    trace.append(stream[index])
+                    index += 1
+                trace.append('EOR')
+                index += 1
+            elif name == 'DN':
+                # square, piece pairs up to the end of record
+                while stream[index] != eor:
+                    trace.extend((stream[index], self.stream_name[stream[index + 1]]))
+                    index += 2
+                trace.append('EOR')
+                index += 1
+            elif name == 'DP':
+                trace.extend((stream[index], self.stream_name[stream[index + 1]]))
+                index += 2
+            elif name in ('MX', 'PX', 'OP'):
+                trace.append(stream[index])
+                index += 1
+        return trace
+
+    def stream_byte_counts(self, stream):
+        #
+        #  Adds up how many bytes of a stream go to each sort of token, counting everything up to and including the
+        #  EOR of a record towards the token that starts it.  Piece moves have no token of their own and are counted
+        #  as 'move'.
+        #
+        counts = collections.Counter()
+        eor = self.stream_code['EOR']
+        index = 0
+        while index < len(stream):
+            code = stream[index]
+            start = index
+            index += 1
+
+            if code < self.stream_code['BR']:
+                counts['move'] += 3
+                index += 2
+                continue
+
+            name = self.stream_name[code]
+            if name in ('EV', 'DT', 'WX', 'BX', 'PG', 'EOG', 'DN'):
+                index = stream.index(eor, index) + 1
+            elif name == 'DP':
+                index += 2
+            elif name in ('MX', 'PX', 'OP'):
+                index += 1
+            counts[name] += index - start
+        return counts
+
+    def stream_contexts(self, stream):
+        #
+        #  Works out which Huffman context each byte of a stream is read in.  This has to follow the replayer exactly,
+        #  since that's how it knows which tree to decode each byte with.
+        #
+        contexts = bytearray(len(stream))
+        eor = self.stream_code['EOR']
+        cmd_context = CONTEXT_CMD
+        index = 0
+        while index < len(stream):
+            code = stream[index]
+            contexts[index] = cmd_context
+            index += 1
+            cmd_context = CONTEXT_CMD
+
+            # a piece move: source square (the token itself), destination square, piece
+            if code < self.stream_code['BR']:
+                contexts[index] = CONTEXT_SQUARE
+                contexts[index + 1] = CONTEXT_PIECE
+                index += 2
+                cmd_context = CONTEXT_AFTER_MOVE
+                continue
+
+            name = self.stream_name[code]
+            if name in ('EV', 'DT', 'WX', 'BX', 'PG', 'EOG'):
+                # move text gets a context for each of its first few characters, other text shares one
+                context = CONTEXT_MOVE_TEXT if name == 'PG' else CONTEXT_TEXT
+                while stream[index] != eor:
+                    contexts[index] = context
+                    index += 1
+                    if CONTEXT_MOVE_TEXT <= context < CONTEXT_MOVE_TEXT_LAST:
+                        context += 1
+                contexts[index] = context
+                index += 1
+                if name == 'PG':
+                    cmd_context = CONTEXT_AFTER_PG
+            elif name == 'DN':
+                # square, piece pairs, the EOR turns up where the next square would be
+                while stream[index] != eor:
+                    contexts[index] = CONTEXT_SQUARE
+                    contexts[index + 1] = CONTEXT_PIECE
+                    index += 2
+                contexts[index] = CONTEXT_SQUARE
+                index += 1
+            elif name == 'DP':
+                contexts[index] = CONTEXT_SQUARE
+                contexts[index + 1] = CONTEXT_PIECE
+                index += 2
+            elif name in ('MX', 'PX', 'OP'):
+                # the byte after an opening's block number is read once the block has played, in CONTEXT_CMD
+                contexts[index] = CONTEXT_TEXT
+                index += 1
+        return contexts
+
+    def dump_asm_byte_statements(self, segments=None):
         # this routine was originally used to dump the data stream out as a block of memory that could be
         # copy-n-pasted into the main program to use in place of data read from a file on disk. I've kept it
-        # here because it's still useful as a way to see the actual byte stream generated.
+        # here because it's still useful as a way to see the actual byte stream generated.  The games are
+        # converted and dumped one at a time, the same as they're written to the chessdata file.
+        if segments is None:
+            segments = self.encoded_segments()
         count = 0
         outline = []
-        for out in self.output_bytes:
-            if count % 20 == 0 and len(outline) > 0:
-                line = ', '.join(outline)
-                outline = []
-                print(f"     .byte {line}")
-            outline.append(f"{out:>3}")
-            count += 1
+        for segment in self.segments_with_eof(segments):
+            for out in self.stream_to_byte_trace(segment):
+                if count % 20 == 0 and len(outline) > 0:
+                    line = ', '.join(outline)
+                    outline = []
+                    print(f"     .byte {line}")
+                outline.append(f"{out:>3}")
+                count += 1
         line = ', '.join(outline)
         print(f"     .byte {line}")
         return count
@@ -1008,23 +2672,265 @@ class PgnToPet:
         print("EOR")
         return
 
-    def write_pet_datafile(self, filename):
-        count = 0
-        for ch in self.output_stream:
-            count += 1
-            # check for a couple of errors found in earlier versions of this program
-            if ch is None:
-                print(f"found None at count={count}")
-            if ch < 0:
-                print(f"found {ch} at count={count}")
-        with open(filename, 'wb') as fhw:
-            try:
-                for ch in self.output_stream:
-                    fhw.write(struct.pack('B', ch))
-            except Exception:
-                print(f"Couldn't write {ch} to file")
-                raise
-        return count
+    def write_pet_datafile(self, filename, index=False, compress=False, segments=None, openings=None):
+        #
+        #  Lays out the chessdata file, see DATA_MARKER, writing each game's record as soon as the game is encoded.
+        #  The games come from encoded_segments unless they're given.  openings is the most bytes of opening blocks
+        #  to share between the games, or None for none.  Returns the size of the file.
+        #
+        #  The Huffman code of a compressed file and the opening blocks both depend on the whole file, so for those
+        #  the games are spilled to a temporary file on the way through and written on another pass - either way,
+        #  only one game is held in memory.  The file is written under a temporary name, so a conversion that fails
+        #  part way leaves any old file be.
+        #
+        if segments is None:
+            segments = self.encoded_segments()
+        stats = self.stats
+        flags = DATA_FLAG_COMPRESSED if compress is True else 0
+        if openings is not None:
+            flags |= DATA_FLAG_OPENINGS
+        spill_dir = os.path.dirname(os.path.abspath(filename))
+        temp_filename = filename + '.tmp'
+        with open(temp_filename, 'wb') as fhw, tempfile.TemporaryFile(dir=spill_dir) as opening_spill:
+            fhw.write(bytes([DATA_MARKER, flags]))
+            opening_table = None
+            if openings is not None:
+                opening_table, segments = self.share_openings(segments, openings, opening_spill, compress)
+
+            if compress is True:
+                with tempfile.TemporaryFile(dir=spill_dir) as spill:
+                    coder = HuffmanCoder(NUM_CONTEXTS)
+                    for segment in self.segments_with_eof(segments):
+                        if stats is not None:
+                            stats.start()
+                        coder.count(self.stream_contexts(segment), segment)
+                        spill.write(struct.pack('<I', len(segment)))
+                        spill.write(segment)
+                        if stats is not None:
+                            stats.lap('datafile')
+
+                    coder.build(HUFFMAN_TABLE_LIMIT)
+                    fhw.write(bytes([NUM_CONTEXTS]) + coder.table_bytes())
+                    if opening_table is not None:
+                        fhw.write(struct.pack('<H', len(opening_table)) + opening_table)
+                    spill.seek(0)
+                    if stats is not None:
+                        stats.start()
+                    records = (coder.encode(self.stream_contexts(segment), segment)
+                               for segment in self.read_spilled_segments(spill))
+                    game_locations = self.write_records(fhw, records)
+                    if stats is not None:
+                        stats.lap('datafile')
+            else:
+                if opening_table is not None:
+                    fhw.write(struct.pack('<H', len(opening_table)) + opening_table)
+                game_locations = self.write_records(fhw, self.segments_with_eof(segments))
+
+            if index is True:
+                fhw.write(self.build_game_index(fhw.tell(), game_locations, flags))
+            num_bytes = fhw.tell()
+        os.replace(temp_filename, filename)
+        return num_bytes
+
+    def share_openings(self, segments, byte_limit, spill, compress=False):
+        #
+        #  Counts the openings of all of the games into an OpeningTrie as they're spilled, then chooses the opening
+        #  blocks.  Returns the table of blocks (see DATA_FLAG_OPENINGS) and a generator for the games read back
+        #  from the spill, with each game's opening moves swapped for a block where there's one.
+        #
+        stats = self.stats
+        trie = OpeningTrie()
+        for segment in segments:
+            if stats is not None:
+                stats.start()
+            opening = self.opening_plies(segment)
+            if opening is not None:
+                trie.add(opening[1])
+            spill.write(struct.pack('<I', len(segment)))
+            spill.write(segment)
+            if stats is not None:
+                stats.lap('datafile')
+
+        # a compressed file's games come out at about half their size
+        game_byte_size = 0.5 if compress is True else 1.0
+        blocks = [trie.block_bytes(node) + bytes([self.stream_code['EO']])
+                  for node in trie.choose_blocks(byte_limit, game_byte_size)]
+
+        # the offsets come first, so the blocks start 2 bytes further on for every block
+        table = bytearray()
+        offset = 2 * len(blocks)
+        for block in blocks:
+            table += struct.pack('<H', offset)
+            offset += len(block)
+        for block in blocks:
+            table += block
+        spill.seek(0)
+        return bytes(table), self.opened_segments(trie, spill)
+
+    def opened_segments(self, trie, spill):
+        code_op = self.stream_code['OP']
+        for segment in self.read_spilled_segments(spill):
+            opening = self.opening_plies(segment)
+            if opening is not None:
+                block_num, num_plies = trie.deepest_block(opening[1])
+                if block_num is not None:
+                    start = opening[0]
+                    end = start + sum(len(ply) for ply in opening[1][:num_plies])
+                    segment = segment[:start] + bytes([code_op, block_num]) + segment[end:]
+            yield segment
+        return
+
+    def opening_plies(self, segment):
+        #
+        #  Where a game's moves start in its segment, and each of its first OPENING_MAX_PLIES moves' bytes - the
+        #  piece moves, the PG record and the pause after it.  None for a game that doesn't start from the standard
+        #  position, which has a CB, MX or PX in place of the pause after the tags.
+        #
+        code = self.stream_code
+        eor = code['EOR']
+        index = 0
+        while segment[index] in (code['EV'], code['DT'], code['WX'], code['BX']):
+            index = segment.index(eor, index) + 1
+        if segment[index] != code['ZZ']:
+            return None
+        index += 1
+
+        start = index
+        plies = []
+        while len(plies) < OPENING_MAX_PLIES:
+            ply_start = index
+            while segment[index] < code['BR'] or segment[index] == code['DP']:
+                index += 3
+            if segment[index] != code['PG']:
+                break
+            index = segment.index(eor, index) + 1
+            if segment[index] != code['ZZ']:
+                break
+            index += 1
+            plies.append(bytes(segment[ply_start:index]))
+        return start, plies
+
+    def segments_with_eof(self, segments):
+        # every game's segment and then the EOF token's, added up by token for --stats on the way through
+        self.output_stream = bytearray()
+        self.generate_eof()
+        eof_segment = self.output_stream
+        for segment in itertools.chain(segments, (eof_segment,)):
+            if self.stats is not None:
+                self.stats.byte_counts.update(self.stream_byte_counts(segment))
+            yield segment
+        return
+
+    def read_spilled_segments(self, spill):
+        while True:
+            length = spill.read(4)
+            if len(length) == 0:
+                return
+            yield spill.read(struct.unpack('<I', length)[0])
+
+    def write_records(self, fhw, records):
+        #
+        #  Writes each record with its length in front.  Returns where each game's record starts in the file (past
+        #  the record length) and how long it is - the last record is the EOF token, which isn't a game.
+        #
+        stats = self.stats
+        offsets = array.array('L')
+        lengths = array.array('L')
+        for record in records:
+            if stats is not None:
+                stats.start()
+            if len(record) > 0xFFFF:
+                raise Exception(f"A game took {len(record)} bytes to encode, records are limited to 65535")
+            fhw.write(struct.pack('<H', len(record)))
+            offsets.append(fhw.tell())
+            lengths.append(len(record))
+            fhw.write(record)
+            if stats is not None:
+                stats.lap('datafile')
+        offsets.pop()
+        lengths.pop()
+        return zip(offsets, lengths)
+
+    def verify_datafile(self, filename, jobs=1, chunk_size=256):
+        #
+        #  Replays every game in a chessdata file with a ChessDataDecoder.  Returns the number of games and a list of
+        #  (game number, problem) for each game that didn't check out, games are numbered from 1.  With more than one
+        #  job the games are handed out to a pool in chunks, like encode_games_in_pool.
+        #
+        with open(filename, 'rb') as fh:
+            data = fh.read()
+        decoder = ChessDataDecoder(data)
+        numbered_records = enumerate(decoder.records(data), start=1)
+        problems = []
+        num_games = 0
+        if jobs > 1:
+            header = data[:decoder.header_size]
+            with multiprocessing.Pool(jobs, initializer=init_verify_worker, initargs=(header,)) as pool:
+                chunks = self.chunk_game_blocks(numbered_records, chunk_size)
+                for chunk_games, chunk_problems in pool.imap(verify_games_in_worker, chunks):
+                    num_games += chunk_games
+                    problems += chunk_problems
+        else:
+            num_games, problems = verify_records(decoder, numbered_records)
+        return num_games, problems
+
+    def build_game_index(self, table_offset, game_locations, flags=0):
+        # the table of game offsets and lengths, then the footer - see INDEX_FOOTER
+        index = bytearray()
+        num_games = 0
+        for offset, length in game_locations:
+            index += INDEX_ENTRY.pack(offset, length)
+            num_games += 1
+        index += INDEX_FOOTER.pack(INDEX_MAGIC, INDEX_VERSION, flags, num_games, table_offset)
+        return index
+
+
+# each worker process in the --jobs pool keeps one converter around for all of the games it is handed
+pool_worker_converter = None
+
+
+def init_pool_worker(collect_stats=False):
+    global pool_worker_converter
+    pool_worker_converter = PgnToPet(stats=ConversionStats() if collect_stats else None)
+    return
+
+
+def encode_games_in_worker(game_blocks):
+    segments = [pool_worker_converter.encode_game(game_block) for game_block in game_blocks]
+
+    # any stats go back along with the chunk's segments, and the worker starts afresh for its next chunk
+    stats = pool_worker_converter.stats
+    if stats is not None:
+        pool_worker_converter.stats = ConversionStats()
+    return segments, stats
+
+
+# and for --verify, a decoder set up with the file's Huffman trees
+verify_worker_decoder = None
+
+
+def init_verify_worker(header):
+    global verify_worker_decoder
+    verify_worker_decoder = ChessDataDecoder(header)
+    return
+
+
+def verify_games_in_worker(numbered_records):
+    return verify_records(verify_worker_decoder, numbered_records)
+
+
+def verify_records(decoder, numbered_records):
+    num_games = 0
+    problems = []
+    for game_num, record in numbered_records:
+        stream = decoder.decode_record(record)
+        if stream[0] == decoder.stream_code['EOF']:
+            continue
+        num_games += 1
+        problem = decoder.verify_game(stream)
+        if problem is not None:
+            problems.append((game_num, problem))
+    return num_games, problems
 
 
 if __name__ == '__main__':
@@ -1038,12 +2944,134 @@ chessdata file.  Making backup copies of chessdata files you want to keep
 is advised.
 """
     argp = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=helptext)
-    argp.add_argument('filenames', nargs='+', help='Names of a valid .pgn files')
+    argp.add_argument('filenames', nargs='*',
+                      help='Names of valid .pgn files, which can be compressed with gzip, bzip2 or xz, or - to read '
+                           'standard input')
+    argp.add_argument('-j', '--jobs', type=int, default=1,
+                      help='Number of worker processes used to convert games (default: 1). The output is identical '
+                           'no matter how many are used.')
+    argp.add_argument('--cache', metavar='FILE',
+                      help='Keep encoded games in this cache file, so later runs only convert new or changed games')
+    argp.add_argument('--cache-size', metavar='MB', type=int, default=256,
+                      help='Size limit of the cache in megabytes (default: 256). Least recently used games are '
+                           'evicted first.')
+    argp.add_argument('--where', metavar='EXPR',
+                      help='Only convert the games that match this SQL expression on the columns event, white, '
+                           'black, date, result and eco, e.g. "white LIKE \'%%Fischer%%\' AND date >= \'1972\'". '
+                           'The games are found through the --games-db index.')
+    argp.add_argument('--games-db', metavar='FILE',
+                      help='Index the tags of the games in the .pgn files in this SQLite file, so --where can pick '
+                           'games out without reading the rest (default: pgngames.db when --where is given). Only new '
+                           'or changed files are indexed again.')
+    argp.add_argument('--save-offsets', action='store_true',
+                      help='Save where each game starts in each uncompressed .pgn file next to it, in a file named '
+                           'after it with .offsets on the end, so the file can be indexed again without scanning it')
+    argp.add_argument('--dedupe', action='store_true',
+                      help='Drop games that have the same moves from the same start as a game before them, even if '
+                           'their tags, comments or variations differ. The dropped games are listed.')
+    argp.add_argument('--index', action='store_true',
+                      help='Append a table of where each game starts to the chessdata file, for tools that need to '
+                           'jump straight to a game. The replayer ignores it.')
+    argp.add_argument('--compress', action='store_true',
+                      help='Huffman code the chessdata file, which makes it about half the size. The replayer '
+                           'decodes it as it plays.')
+    argp.add_argument('--openings', action='store_true',
+                      help='Store the opening moves that many games share once, in opening blocks that the replayer '
+                           'keeps in memory, rather than in every game')
+    argp.add_argument('--openings-size', metavar='BYTES', type=int, default=2048,
+                      help='The most memory the opening blocks can take up on the PET (default: 2048)')
+    argp.add_argument('--d64', metavar='FILE',
+                      help='Also write a .d64 disk image holding the replayer and the new chessdata file')
+    argp.add_argument('--prg', metavar='FILE', default='chessreplay.prg',
+                      help='The assembled replayer to put on the --d64 image (default: chessreplay.prg)')
+    argp.add_argument('--verify', action='store_true',
+                      help='Replay every game in the chessdata file and check each piece move against its move '
+                           'text. With no .pgn files, the chessdata file that is already there is checked.')
+    argp.add_argument('--stats', action='store_true',
+                      help='Print the time spent in each stage of the conversion, counts of moves, captures and '
+                           'so on, and how the output bytes split up by token')
+    argp.add_argument('--profile', metavar='FILE',
+                      help='Run the conversion under cProfile and write the report, sorted by cumulative time, to '
+                           'this file. Only the main process is profiled when --jobs is used.')
     args = argp.parse_args()
-
-    ptp = PgnToPet(args.filenames)
-
-    num_bytes = ptp.write_pet_datafile('chessdata')
-    print(f"number of bytes written to chessdata file: {num_bytes}")
+    if len(args.filenames) == 0 and args.verify is False:
+        argp.error('the .pgn files to convert are needed, unless --verify is given')
+    if '-' in args.filenames and (args.where is not None or args.games_db is not None or args.save_offsets is True):
+        argp.error("standard input can't be indexed for --where, --games-db or --save-offsets")
+    if args.d64 is not None and os.path.exists(args.prg) is False:
+        argp.error(f"{args.prg} is needed for --d64 - build it with build.sh, or give its name with --prg")
+
+    profiler = None
+    if args.profile is not None:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    stats = None
+    if args.stats is True:
+        stats = ConversionStats()
+
+    if len(args.filenames) > 0:
+        cache = None
+        if args.cache is not None:
+            cache = ConversionCache(args.cache, max_bytes=args.cache_size * 1024 * 1024)
+
+        if args.save_offsets is True:
+            for filename in args.filenames:
+                with PgnOffsetIndex(filename) as offsets:
+                    if offsets.loaded is False:
+                        print(f"saved the offsets of {len(offsets)} games to {offsets.save()}")
+
+        game_index = None
+        if args.games_db is not None or args.where is not None:
+            game_index = GameIndex(args.games_db if args.games_db is not None else 'pgngames.db')
+
+        # the games are converted as they're written
+        ptp = PgnToPet(args.filenames, jobs=args.jobs, cache=cache, stats=stats, game_index=game_index,
+                       where=args.where, dedupe=args.dedupe)
+        if game_index is not None:
+            for filename in args.filenames:
+                num_games = game_index.update(filename, ptp)
+                if num_games > 0:
+                    print(f"indexed {num_games} games in {filename}")
+            if args.where is not None:
+                print(f"games selected: {game_index.count(args.filenames, args.where)}")
+
+        num_bytes = ptp.write_pet_datafile('chessdata', index=args.index, compress=args.compress,
+                                           openings=args.openings_size if args.openings is True else None)
+
+        if args.dedupe is True:
+            for game_num, description in ptp.duplicates:
+                print(f"dropped duplicate of an earlier game: input game {game_num}, {description}")
+            print(f"duplicate games dropped: {len(ptp.duplicates)}")
+        if game_index is not None:
+            game_index.close()
+        if cache is not None:
+            cache.close()
+            print(f"games taken from the cache: {cache.hits}, games converted: {cache.misses}")
+        print(f"number of bytes written to chessdata file: {num_bytes}")
+
+    problems = []
+    if args.verify is True:
+        num_games, problems = PgnToPet().verify_datafile('chessdata', jobs=args.jobs)
+        for game_num, problem in problems:
+            print(f"game {game_num}: {problem}")
+        print(f"games verified: {num_games}, games with problems: {len(problems)}")
+
+    if profiler is not None:
+        profiler.disable()
+        with open(args.profile, 'w') as fh:
+            pstats.Stats(profiler, stream=fh).sort_stats('cumulative').print_stats()
+        print(f"wrote the profile to {args.profile}")
+
+    if stats is not None and len(args.filenames) > 0:
+        print()
+        stats.print_report()
+
+    if args.d64 is not None:
+        blocks_free = d64image.build_chessreplay_d64(args.d64, args.prg, 'chessdata')
+        print(f"wrote {args.d64}, {blocks_free} blocks free")
+
+    if len(problems) > 0:
+        sys.exit(1)
     # num_bytes = ptp.dump_asm_byte_statements()
     # print(f"number of bytes printed to screen: {num_bytes}")